@@ -1,28 +1,35 @@
 import os
+from collections import OrderedDict
 from typing import Dict, List, Optional, Tuple, Union
 
 import json
 from Agent import BaseAgent
+from Agent.base_agent import MAX_TURN
 from Agent.llm import get_chat_model
 from Agent.llm.base import BaseChatModel
+from Agent.memory import ContextManager
+from Agent.tools import HumanInputRequired
 
-PLANNER_TEMPLATE = """You have assess to the following apis:
+# the templates keep the parts which change least first and end with the history, so
+# the prompts of the turns of a run share their prefix in the prompt cache of the llm
+PLANNER_TEMPLATE = """You are the assistant to plan what to do next and whether is caller's or conclusion's turn to answer. If you find the historical called api is inappropriate, you can give some advice to the caller.
+Answer with a following format:
+The thought of the next step, followed by Next: caller or conclusion or give up.
+You have assess to the following apis:
 {doc}
 The conversation history is:
-{history}
-You are the assistant to plan what to do next and whether is caller's or conclusion's turn to answer. If you find the historical called api is inappropriate, you can give some advice to the caller.
-Answer with a following format:
-The thought of the next step, followed by Next: caller or conclusion or give up."""
+{history}"""
 
-CALLER_TEMPLATE = """You have assess to the following apis:
+CALLER_TEMPLATE = """Base on the thought of this step make an api call in the following format:
+Action: the name of api that should be called in this step, should be exactly in the names of the apis,
+Action Input: the api call request.
+You have assess to the following apis:
 {doc}
+The names of the apis are: [{tool_names}]
 The conversation history is:
 {history}
 The thought of this step is:
-{thought}
-Base on the thought make an api call in the following format:
-Action: the name of api that should be called in this step, should be exactly in [{tool_names}],
-Action Input: the api call request."""
+{thought}"""
 
 SUMMARIZER_TEMPLATE = """Make a conclusion based on the conversation history:
 {history}"""
@@ -32,9 +39,57 @@ ARGS_TOKEN = 'Action Input:'
 OBSERVATION_TOKEN = 'Observation:'
 ANSWER_TOKEN = 'Answer:'
 
+ROLE_PROMPT_CACHE_SIZE = 256
+
+# the decisions of the planner, its output ends at the first of them
+DECISION_MARKERS = ('Next: give up.', 'Next: caller.', 'Next: conclusion.')
+
+# the caller stops before the observation, which is the result of the api call
+CALLER_STOP_WORDS = (OBSERVATION_TOKEN, )
+
+
+def _find_marker_end(text: str, markers: Tuple[str, ...],
+                     start: int) -> Optional[int]:
+    """
+    Find the end of the first marker in text, only the markers overlapping the text
+    after start are searched, since the text before is already searched
+    """
+    end = None
+    for marker in markers:
+        idx = text.find(marker, max(start - len(marker) + 1, 0))
+        if idx >= 0 and (end is None or idx + len(marker) < end):
+            end = idx + len(marker)
+    return end
+
+
+def _find_stop(text: str, stop: Tuple[str, ...], start: int) -> Optional[int]:
+    """
+    Find the start of the first stop word in text, searched like _find_marker_end
+    """
+    cut = None
+    for word in stop:
+        idx = text.find(word, max(start - len(word) + 1, 0))
+        if idx >= 0 and (cut is None or idx < cut):
+            cut = idx
+    return cut
+
+
+def _partial_stop_len(text: str, stop: Tuple[str, ...]) -> int:
+    """
+    The length of the end of text which may be the beginning of a stop word
+    """
+    for size in range(max((len(word) for word in stop), default=1) - 1, 0,
+                      -1):
+        if any(word.startswith(text[-size:]) for word in stop):
+            return size
+    return 0
+
 
 class AlphaUmi(BaseAgent):
 
+    # rendered role prompts shared by all agents
+    _role_prompt_cache: OrderedDict = OrderedDict()
+
     def __init__(self,
                  function_list: Optional[List[Union[str, Dict]]] = None,
                  llm_planner: Optional[Union[Dict, BaseChatModel]] = None,
@@ -59,7 +114,7 @@ class AlphaUmi(BaseAgent):
             name: the name of agent
             description: the description of agent, which is used for multi_agent
             instruction: the system instruction of this agent
-            kwargs: other potential parameters
+            kwargs: other potential parameters, see BaseAgent
         """
         """
         修改：
@@ -83,25 +138,25 @@ class AlphaUmi(BaseAgent):
         else:
             self.llm_summarizer = llm_summarizer
         self.stream = True
-
-        self.function_list = []
-        self.function_map = {}
-        if function_list:
-            for function in function_list:
-                self._register_tool(function)
-
-        self.storage_path = storage_path
-        self.mem = None
-        self.name = name
-        self.description = description
-        self.instruction = instruction
-        self.uuid_str = kwargs.get('uuid_str', None)
+        # the caller is the role which calls tools
+        self.llm = self.llm_caller
+        self._init_runtime(function_list, storage_path, name, description,
+                           instruction, **kwargs)
+
+    def _build_context_manager(self, **kwargs) -> ContextManager:
+        # the budget follows the planner, whose prompt is the longest, and the
+        # summarizer compacts the history
+        return ContextManager(
+            model=getattr(self.llm_planner, 'model', None),
+            llm=self.llm_summarizer,
+            **kwargs.get('context_cfg', {}))
 
     def _run(self,
              user_request,
              history: Optional[List[Dict]] = None,
              ref_doc: str = None,
              lang: str = 'zh',
+             max_turn: int = MAX_TURN,
              **kwargs):
         """
         修改：
@@ -110,15 +165,8 @@ class AlphaUmi(BaseAgent):
             相当于在底层llm.chat的实现时直接把llm.chat传入的prompt参数作为模型输入就行，不要加任何额外信息
         """
 
-        self.tool_descs = '\n'.join(tool.function_plain_text
-                                    for tool in self.function_map.values())
-        self.tool_names = ', '.join(tool.name
-                                    for tool in self.function_map.values())
-
-        self.planner_prompt = PLANNER_TEMPLATE.replace('{doc}',
-                                                       self.tool_descs)
-        self.caller_prompt = CALLER_TEMPLATE.replace(
-            '{doc}', self.tool_descs).replace('{tool_names}', self.tool_names)
+        (self.tool_descs, self.tool_names, self.planner_prompt,
+         self.caller_prompt) = self._build_role_prompts()
         self.summarizer_prompt = SUMMARIZER_TEMPLATE
         # Concat the system as one round of dialogue
 
@@ -129,24 +177,59 @@ class AlphaUmi(BaseAgent):
                 history = history[1:]
         else:
             history = list()
-        history.append({'role': 'user', 'content': user_request})
+        history.append({
+            'role': 'user',
+            'content': self._recall_memory(user_request, lang) + user_request
+        })
+
+        state = {'lang': lang, 'history': history, 'max_turn': max_turn}
+        yield from self._loop(state, **kwargs)
+
+    def _resume(self, state: Dict, answer: str, **kwargs):
+        (self.tool_descs, self.tool_names, self.planner_prompt,
+         self.caller_prompt) = self._build_role_prompts()
+        self.summarizer_prompt = SUMMARIZER_TEMPLATE
+        # the answer of the user is the result of the pending api call
+        yield f'Observation: {answer}'
+        self._add_observation(state['history'], answer)
+        yield from self._loop(state, **kwargs)
+
+    def _loop(self, state: Dict, **kwargs):
+        """
+        The planner-caller-summarizer loop of one run, the state is a json dict so that
+        the run can be suspended and resumed at an api call
+        """
+        lang = state['lang']
+        history = state['history']
+        # the templates are sent together with the history
+        reserved_tokens = self.context_manager.count_tokens(
+            self.caller_prompt)
 
         # concat the new messages
-        max_turn = 10
-        while True and max_turn > 0:
+        while True and state['max_turn'] > 0:
+            history = self.context_manager.fit(
+                history, reserved_tokens=reserved_tokens)
+            state['history'] = history
             dispatch_history = self._concat_history(history)
-            max_turn -= 1
-            planner_output = self.llm_planner.chat(
-                prompt=self.planner_prompt.replace(
-                    '{history}', dispatch_history) + ' assistant: ',
-                max_tokens=2000,
-                stream=False,
+            turn_token = self._turn_token(state['max_turn'])
+            state['max_turn'] -= 1
+            if state.get('conclude'):
+                # the llm repeats itself, the summarizer concludes with what it has
+                yield from self._summarize(history, turn_token, **kwargs)
+                break
+            # the planner is cut off once it decides, the rest would be thrown away
+            planner_output = yield from self._stream_role(
+                self.llm_planner,
+                self.planner_prompt.replace('{history}', dispatch_history)
+                + ' assistant: ',
+                markers=DECISION_MARKERS,
+                cancel_token=turn_token,
+                usage=self._usage_meter('planner'),
                 **kwargs)
 
             decision, planner_result = self._parse_planner_output(
                 planner_output)
-            history.append({'role': 'assistant', 'content': planner_output})
-            yield planner_output
+            history.append({'role': 'assistant', 'content': planner_result})
 
             if decision == 'give_up':
                 break
@@ -154,51 +237,148 @@ class AlphaUmi(BaseAgent):
             elif decision == 'caller':
                 dispatch_history = self._concat_history(history)
 
-                caller_output = self.llm_caller.chat(
-                    prompt=self.caller_prompt.replace(
+                caller_output = yield from self._stream_role(
+                    self.llm_caller,
+                    self.caller_prompt.replace(
                         '{history}', dispatch_history).replace(
                             '{thought}', history[-1]['content']) + ' caller: ',
-                    stream=False,
-                    max_tokens=2000,
+                    stop=CALLER_STOP_WORDS,
+                    cancel_token=turn_token,
+                    usage=self._usage_meter('caller'),
                     **kwargs)
 
                 use_tool, action, action_input, caller_output = self.llm_caller._detect_tool(
-                    caller_output, self.function_map)
+                    caller_output, self.function_map, self.tool_index)
 
                 history.append({'role': 'caller', 'content': caller_output})
-                yield caller_output
 
                 if use_tool:
-                    yield f'Action: {action}\nAction Input: {action_input}'
-                    observation = self._call_tool(action, action_input)
+                    # the action is streamed to the user in the output of the caller
+                    try:
+                        observation = self._call_tool(
+                            action,
+                            action_input,
+                            lang=lang,
+                            cancel_token=turn_token)
+                    except HumanInputRequired as e:
+                        # release the run while the user answers, it goes on in resume
+                        self._suspend(state, e.question)
+                        yield f'\n{e.question}'
+                        return
                     yield f'Observation: {observation}'
-                    if isinstance(observation, dict) or isinstance(
-                            observation, list):
-                        observation_str = json.dumps(observation)
-                    elif isinstance(observation, str):
-                        observation_str = observation
-                    else:
-                        observation_str = str(observation)
-                    history.append({
-                        'role': 'observation',
-                        'content': observation_str
-                    })
+                    self._add_observation(history, observation)
+                    if self.action_tracker.should_conclude:
+                        state['conclude'] = True
             else:
-                dispatch_history = self._concat_history(history)
-                summarizer_output = self.llm_summarizer.chat(
-                    prompt=self.summarizer_prompt.replace(
-                        '{history}', dispatch_history) + ' conclusion: ',
-                    stream=False,
-                    max_tokens=2000,
-                    **kwargs)
-                yield summarizer_output
-
-                history.append({
-                    'role': 'conclusion',
-                    'content': summarizer_output
-                })
+                yield from self._summarize(history, turn_token, **kwargs)
                 break
 
+    def _summarize(self, history: List[Dict], turn_token, **kwargs):
+        dispatch_history = self._concat_history(history)
+        summarizer_output = yield from self._stream_role(
+            self.llm_summarizer,
+            self.summarizer_prompt.replace('{history}', dispatch_history)
+            + ' conclusion: ',
+            cancel_token=turn_token,
+            usage=self._usage_meter('summarizer'),
+            **kwargs)
+        history.append({'role': 'conclusion', 'content': summarizer_output})
+
+    def _stream_role(self,
+                     llm: BaseChatModel,
+                     prompt: str,
+                     markers: Tuple[str, ...] = (),
+                     stop: Tuple[str, ...] = (),
+                     **kwargs):
+        """
+        Stream the output of one role to the user
+
+        Args:
+            llm: the llm of the role
+            prompt: the prompt of the role
+            markers: the stream is closed as soon as one of them appears, and the text
+                after it is dropped
+            stop: the stop words of the llm, the stream is also closed before one of
+                them in case the llm does not stop, and they are never streamed
+
+        Returns:
+            the whole text of the role, up to and including the marker, or up to the
+            stop word
+        """
+        output = llm.chat(
+            prompt=prompt,
+            max_tokens=2000,
+            stream=True,
+            stop=list(stop) or None,
+            **kwargs)
+        if isinstance(output, str):
+            output = [output]
+        text = ''
+        sent = 0
+        try:
+            for chunk in output:
+                start = len(text)
+                text += chunk
+                end = _find_marker_end(text, markers, start)
+                cut = _find_stop(text, stop, start)
+                if cut is not None and (end is None or cut < end):
+                    end = cut
+                if end is not None:
+                    text = text[:end]
+                    if text[sent:]:
+                        yield text[sent:]
+                    break
+                # hold back what may be the beginning of a stop word
+                safe = len(text) - _partial_stop_len(text, stop)
+                if safe > sent:
+                    yield text[sent:safe]
+                    sent = safe
+            else:
+                if text[sent:]:
+                    yield text[sent:]
+        finally:
+            # stop the generation of the llm
+            if hasattr(output, 'close'):
+                output.close()
+        return text
+
+    def _add_observation(self, history: List[Dict], observation):
+        if isinstance(observation, dict) or isinstance(observation, list):
+            observation_str = json.dumps(observation)
+        elif isinstance(observation, str):
+            observation_str = observation
+        else:
+            observation_str = str(observation)
+        # kept whole, the older observations are elided first by fit
+        history.append({'role': 'observation', 'content': observation_str})
+
+    def _build_role_prompts(self) -> Tuple[str, str, str, str]:
+        """
+        Render the planner and caller prompts, which are cached by the sorted tool
+        set and shared by all agents.
+
+        Returns:
+            tool_descs, tool_names, planner_prompt, caller_prompt
+        """
+        tools = sorted(self.function_map.values(), key=lambda tool: tool.name)
+        key = tuple(tool.function_plain_text for tool in tools)
+        cached = self._role_prompt_cache.get(key)
+        if cached is not None:
+            self._role_prompt_cache.move_to_end(key)
+            return cached
+
+        tool_descs = '\n'.join(tool.function_plain_text for tool in tools)
+        tool_names = ', '.join(tool.name for tool in tools)
+        planner_prompt = PLANNER_TEMPLATE.replace('{doc}', tool_descs)
+        caller_prompt = CALLER_TEMPLATE.replace('{doc}', tool_descs).replace(
+            '{tool_names}', tool_names)
+
+        cached = (tool_descs, tool_names, planner_prompt, caller_prompt)
+        self._role_prompt_cache[key] = cached
+        while len(self._role_prompt_cache) > ROLE_PROMPT_CACHE_SIZE:
+            self._role_prompt_cache.popitem(last=False)
+        return cached
+
     def _parse_role_config(self, config: dict, lang: str = 'zh') -> str:
         """
         Parsing role config dict to str.
@@ -1,8 +1,11 @@
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 from Agent import BaseAgent
+from Agent.base_agent import MAX_TURN
+from Agent.tools import HumanInputRequired
 
-import json5
+import json
 
 
 TOOL_TEMPLATE_ZH = """
@@ -86,6 +89,8 @@ SPECIAL_PREFIX_TEMPLATE_TOOL = {
     'en': '. you can use tools: [{tool_names}]',
 }
 
+SYSTEM_PROMPT_CACHE_SIZE = 256
+
 DEFAULT_EXEC_TEMPLATE = """\nObservation: <result>{exec_result}</result>\nAnswer:"""
 
 # ACTION_TOKEN = 'Action:'
@@ -96,49 +101,21 @@ DEFAULT_EXEC_TEMPLATE = """\nObservation: <result>{exec_result}</result>\nAnswer
 
 class RolePlay(BaseAgent):
 
+    # rendered system prompts shared by all agents
+    _system_prompt_cache: OrderedDict = OrderedDict()
+
     def _run(self,
              user_request,
              history: Optional[List[Dict]] = None,
              lang: str = 'zh',
+             max_turn: int = MAX_TURN,
              **kwargs):
 
-        self.tool_descs = '\n\n'.join(tool.function_plain_text
-                                      for tool in self.function_map.values())
-        self.tool_names = ','.join(tool.name
-                                   for tool in self.function_map.values())
+        (self.system_prompt, self.query_prefix, self.role_name,
+         self.tool_descs, self.tool_names) = self._build_system_prompt(lang)
 
         print(f"候选工具：{self.tool_names}")
 
-        self.system_prompt = ''
-        self.query_prefix = ''
-        self.query_prefix_dict = {'role': '', 'tool': ''}
-        
-        # only openai interface support function calling, so for other llm, 
-        # we need to concat the function information to the prompt and use chat_with_raw_prompt
-        if self.function_map and not self.llm.support_function_calling():
-            self.system_prompt += TOOL_TEMPLATE[lang].format(
-                tool_descs=self.tool_descs, tool_names=self.tool_names)
-            self.query_prefix_dict['tool'] = SPECIAL_PREFIX_TEMPLATE_TOOL[
-                lang].format(tool_names=self.tool_names)
-
-        # concat instruction
-        if isinstance(self.instruction, dict):
-            self.role_name = self.instruction['name']
-            self.query_prefix_dict['role'] = SPECIAL_PREFIX_TEMPLATE_ROLE[
-                lang].format(role_name=self.role_name)
-            self.system_prompt += PROMPT_TEMPLATE[lang].format(
-                role_prompt=self._parse_role_config(self.instruction, lang))
-        else:
-            # string can not parser role name
-            self.role_name = ''
-            self.system_prompt += PROMPT_TEMPLATE[lang].format(
-                role_prompt=self.instruction)
-
-        self.query_prefix += self.query_prefix_dict['role']
-        self.query_prefix += self.query_prefix_dict['tool']
-        if self.query_prefix:
-            self.query_prefix = '(' + self.query_prefix + ')'
-
         # Concat the system as one round of dialogue
         messages = [{'role': 'system', 'content': self.system_prompt}]
 
@@ -149,39 +126,72 @@ class RolePlay(BaseAgent):
                 history = history[1:]
             messages.extend(history)
 
-        # concat the new messages
+        # concat the new messages, the reminder of the role and the tools is in the
+        # system prompt, so the earlier turns are sent the same in the later runs
         messages.append({
             'role': 'user',
-            'content': self.query_prefix + user_request
+            'content': self._recall_memory(user_request, lang) + user_request
         })
+        messages = self.context_manager.fit(messages)
 
         planning_prompt = ''
         if self.llm.support_raw_prompt():
             planning_prompt = self.llm.build_raw_prompt(messages)
 
-        max_turn = 10
-        while True and max_turn > 0:
+        state = {
+            'lang': lang,
+            'messages': messages,
+            'planning_prompt': planning_prompt,
+            'max_turn': max_turn
+        }
+        yield from self._loop(state, **kwargs)
+
+    def _resume(self, state: Dict, answer: str, **kwargs):
+        (self.system_prompt, self.query_prefix, self.role_name,
+         self.tool_descs, self.tool_names) = self._build_system_prompt(
+             state['lang'])
+        pending = state.pop('pending')
+        # the answer of the user is the result of the pending tool call
+        yield from self._add_observation(state, pending['output'], answer)
+        yield from self._loop(state, **kwargs)
+
+    def _loop(self, state: Dict, **kwargs):
+        """
+        The planning loop of one run, the state is a json dict so that the run can be
+        suspended and resumed at a tool call
+        """
+        lang = state['lang']
+        messages = state['messages']
+        while True and state['max_turn'] > 0:
             # print('=====one input planning_prompt======')
             # print(planning_prompt)
             # print('=============Answer=================')
-            max_turn -= 1
+            turn_token = self._turn_token(state['max_turn'])
+            state['max_turn'] -= 1
 
             # for openai
             if self.llm.support_function_calling():
+                messages = self.context_manager.fit(messages)
+                state['messages'] = messages
+                # no more tools are offered once the run should conclude
                 output = self.llm.chat_with_functions(
                     messages=messages,
                     stream=True,
-                    functions=[
+                    functions=[] if state.get('conclude') else [
                         func.function for func in self.function_map.values()
                     ],
+                    cancel_token=turn_token,
+                    usage=self._usage_meter('assistant'),
                 )
             # for other llm
             else:
                 output = self.llm.chat(
-                    prompt=planning_prompt,
+                    prompt=state['planning_prompt'],
                     stream=True,
                     stop=['Observation:', 'Observation:\n'],
                     messages=messages,
+                    cancel_token=turn_token,
+                    usage=self._usage_meter('assistant'),
                     **kwargs)
 
             llm_result = ''
@@ -206,26 +216,129 @@ class RolePlay(BaseAgent):
             #     assert 'llm_result must be an instance of dict or str'
 
             use_tool, action, action_input, output = self.llm._detect_tool(
-                llm_result, function_map=self.function_map)
+                llm_result,
+                function_map=self.function_map,
+                tool_index=self.tool_index)
 
             # yield output
             print(output)
+            if use_tool and state.get('conclude'):
+                # the llm goes on repeating itself, the run ends with what it has
+                state['planning_prompt'] += output
+                break
             if use_tool:
                 if self.llm.support_function_calling():
                     yield f'Action: {action}\nAction Input: {action_input}'
-                observation = self._call_tool(action, action_input)
-                format_observation = DEFAULT_EXEC_TEMPLATE.format(
-                    exec_result=observation)
-                yield format_observation
-                if self.llm.support_function_calling():
-                    messages.append({'role': 'tool', 'content': observation})
-                else:
-                    planning_prompt += output + format_observation
+                try:
+                    observation = self._call_tool(
+                        action,
+                        action_input,
+                        lang=lang,
+                        cancel_token=turn_token)
+                except HumanInputRequired as e:
+                    # release the run while the user answers, it goes on in resume
+                    state['pending'] = {
+                        'action': action,
+                        'action_input': action_input,
+                        'output': output
+                    }
+                    self._suspend(state, e.question)
+                    yield f'\n{e.question}'
+                    return
+                yield from self._add_observation(state, output, observation)
+                if self.action_tracker.should_conclude:
+                    # the llm repeats itself, the next turn is the last one
+                    state['conclude'] = True
+                    state['max_turn'] = min(state['max_turn'], 1)
 
             else:
-                planning_prompt += output
+                state['planning_prompt'] += output
                 break
 
+    def _add_observation(self, state: Dict, output: str, observation):
+        format_observation = DEFAULT_EXEC_TEMPLATE.format(
+            exec_result=observation)
+        yield format_observation
+        # the latest observation is sent whole, the older ones are elided first
+        # once the context exceeds its budget
+        if self.llm.support_function_calling():
+            state['messages'].append({
+                'role': 'tool',
+                'content': str(observation)
+            })
+        else:
+            state['planning_prompt'] = self.context_manager.fit_prompt(
+                state['planning_prompt'] + output
+                + DEFAULT_EXEC_TEMPLATE.format(exec_result=observation))
+
+    def _build_system_prompt(self, lang: str = 'zh') -> Tuple[str, ...]:
+        """
+        Render the system prompt and the query prefix, which are cached by
+        (sorted tool set, lang, instruction) and shared by all agents.
+
+        The prompt is laid out from the most to the least stable part, so that prompts
+        share the longest prefix for the prompt cache of the provider: the instruction,
+        then the sorted tool docs, then the query prefix reminding of the role and
+        the tools.
+
+        Returns:
+            system_prompt, query_prefix, role_name, tool_descs, tool_names
+        """
+        tools = sorted(self.function_map.values(), key=lambda tool: tool.name)
+        support_fn_call = self.llm.support_function_calling()
+        if isinstance(self.instruction, dict):
+            instruction_key = json.dumps(
+                self.instruction, ensure_ascii=False, sort_keys=True)
+        else:
+            instruction_key = self.instruction
+        key = (type(self), tuple(tool.function_plain_text for tool in tools),
+               lang, instruction_key, support_fn_call)
+        cached = self._system_prompt_cache.get(key)
+        if cached is not None:
+            self._system_prompt_cache.move_to_end(key)
+            return cached
+
+        tool_descs = '\n\n'.join(tool.function_plain_text for tool in tools)
+        tool_names = ','.join(tool.name for tool in tools)
+
+        system_prompt = ''
+        query_prefix = ''
+        query_prefix_dict = {'role': '', 'tool': ''}
+
+        # concat instruction
+        if isinstance(self.instruction, dict):
+            role_name = self.instruction['name']
+            query_prefix_dict['role'] = SPECIAL_PREFIX_TEMPLATE_ROLE[
+                lang].format(role_name=role_name)
+            system_prompt += PROMPT_TEMPLATE[lang].format(
+                role_prompt=self._parse_role_config(self.instruction, lang))
+        else:
+            # string can not parser role name
+            role_name = ''
+            system_prompt += PROMPT_TEMPLATE[lang].format(
+                role_prompt=self.instruction)
+
+        # only openai interface support function calling, so for other llm,
+        # we need to concat the function information to the prompt and use chat_with_raw_prompt
+        if tools and not support_fn_call:
+            system_prompt += TOOL_TEMPLATE[lang].format(
+                tool_descs=tool_descs, tool_names=tool_names)
+            query_prefix_dict['tool'] = SPECIAL_PREFIX_TEMPLATE_TOOL[
+                lang].format(tool_names=tool_names)
+
+        query_prefix += query_prefix_dict['role']
+        query_prefix += query_prefix_dict['tool']
+        if query_prefix:
+            query_prefix = '(' + query_prefix + ')'
+            system_prompt += query_prefix + '\n'
+
+        cached = (system_prompt, query_prefix, role_name, tool_descs,
+                  tool_names)
+        self._system_prompt_cache[key] = cached
+        while len(self._system_prompt_cache) > SYSTEM_PROMPT_CACHE_SIZE:
+            self._system_prompt_cache.popitem(last=False)
+        return cached
+
     # def _detect_tool(self, message: Union[str,
     #                                       dict]) -> Tuple[bool, str, str, str]:
     #     assert isinstance(message, str)
@@ -1,13 +1,41 @@
+import hashlib
+import os
+import time
+import uuid
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from Agent.llm import get_chat_model
 from Agent.llm.base import BaseChatModel
-from Agent.tools import TOOL_REGISTRY
-from Agent.utils.utils import has_chinese_chars
+from Agent.memory import (ContextManager, LongTermMemory, ResponseCache,
+                          get_response_cache)
+from Agent.storage.artifact_storage import ARTIFACT_PREFIX, ArtifactStorage
+from Agent.storage.continuation_storage import ContinuationStorage
+from Agent.storage.session_storage import SessionStorage, get_session_storage
+from Agent.tools import TOOL_REGISTRY, BaseTool
+from Agent.tools.action_tracker import ActionTracker
+from Agent.tools.arg_validator import parse_json_args
+from Agent.tools.name_index import ToolNameIndex
+from Agent.utils.cancellation import CancellationToken, RunCancelled
+from Agent.utils.logger import agent_logger as logger
+from Agent.utils.profiling import profiled
+from Agent.utils.usage import UsageMeter, UsageTracker, get_usage_tracker
+from Agent.utils.utils import detect_lang
 
+import json
 import json5
 
+# the default size of the working set of the retrieved tools
+MAX_RETRIEVED_TOOLS = 4
+
+# the default number of turns of a run
+MAX_TURN = 10
+
+# a turn may use the remaining time budget divided by this number of turns, so the
+# turns after it always have some of the budget left
+RESERVED_TURNS = 2
+
 
 class BaseAgent(ABC):
 
@@ -33,7 +61,29 @@ class BaseAgent(ABC):
             name: the name of agent
             description: the description of agent, which is used for multi_agent
             instruction: the system instruction of this agent
-            kwargs: other potential parameters
+            kwargs: other potential parameters, such as
+                context_cfg: the config of the ContextManager, such as {'max_tokens': 6000, 'summarize': True}
+                lang: the language of the agent, zh or en, which skips the language detection
+                artifact_cfg: the config of the ArtifactStorage, such as {'max_memory_bytes': 1024 ** 3}
+                uuid_str: the id of the session, which is also the id of its continuation when suspended
+                session_cfg: the config of the SessionStorage, such as {'flush_interval': 1.0},
+                    the history of the session is persisted when storage_path is given
+                memory_cfg: the config of the LongTermMemory, such as {'top_k': 5, 'max_tokens': 1000},
+                    the long-term memory is enabled when it is given
+                user_id: the id of the user, whose long-term memory is the index {index_name}_{user_id}
+                    shared by all the sessions of the user, such as memory_{user_id}, the index
+                    of memory_cfg is shared by all the sessions without it
+                max_retrieved_tools: the size of the working set of the tools retrieved with use_vs,
+                    the least recently retrieved or used ones are evicted beyond it
+                repeat_cfg: the config of the ActionTracker of a run, such as {'max_repeats': 2},
+                    a repeated tool call is answered from the earlier one, and the run concludes
+                    after max_repeats of them
+                usage_cfg: the config of the UsageTracker of the session, such as
+                    {'prices': {'qwen-max': {'prompt': 0.02, 'completion': 0.06}}, 'max_tokens': 100000},
+                    a run stops early once the session is over its quota
+                cache_cfg: the config of the ResponseCache, such as {'threshold': 0.92, 'ttl': 3600},
+                    a request without history is answered from a near-duplicate earlier one when
+                    it is given
         """
         # assign a model to the agent given config or an instantiated model
         if isinstance(llm, Dict):
@@ -43,13 +93,29 @@ class BaseAgent(ABC):
             self.llm = llm
 
         self.stream = True
+        self._init_runtime(function_list, storage_path, name, description,
+                           instruction, **kwargs)
 
+    def _init_runtime(self,
+                      function_list: Optional[List[Union[str, Dict]]] = None,
+                      storage_path: Optional[str] = None,
+                      name: Optional[str] = None,
+                      description: Optional[str] = None,
+                      instruction: Union[str, dict] = None,
+                      **kwargs):
+        """
+        Set up the tools, the stores and the per-run state shared by all agents, the
+        llm should be set before, see __init__ for the args
+        """
         # register and instantiate tools into function_map
         self.function_list = []
         self.function_map = {}
+        self.tool_index = ToolNameIndex()
+        self._init_tool_scope(**kwargs)
         if function_list:
             for function in function_list:
                 self._register_tool(function)
+        self._base_tools = set(self.function_map)
 
         self.storage_path = storage_path
         self.mem = None
@@ -57,27 +123,90 @@ class BaseAgent(ABC):
         self.description = description
         self.instruction = instruction
         self.uuid_str = kwargs.get('uuid_str', None)
+        # the session of an agent without uuid_str, which is never shared
+        self._agent_session = uuid.uuid4().hex
+        # the user of the sessions, whose long-term memory is recalled
+        self.user_id = kwargs.get('user_id', None)
+        self.lang = kwargs.get('lang', None)
+        self._session_lang = {}
+
+        # keep the context sent to llm under the token budget of the model
+        self.context_manager = self._build_context_manager(**kwargs)
 
+        # the configs of the stores which are rebuilt when the session changes
+        self._session_kwargs = {
+            key: kwargs[key]
+            for key in ('artifact_cfg', 'memory_cfg') if key in kwargs
+        }
+        # large tool inputs and results are passed by handle instead of in the prompt
+        self.artifact_store = self._build_artifact_store(**kwargs)
+
+        # the sessions suspended while waiting for the user
+        self.continuation_store = self._build_continuation_store()
+        self.continuation_id = None
+        # the cancellation and the deadline of the current run
+        self.cancel_token: Optional[CancellationToken] = None
+        self.cancel_reason: Optional[str] = None
+        # the tool calls of the current run
+        self.repeat_cfg = kwargs.get('repeat_cfg', {})
+        self.action_tracker = ActionTracker(**self.repeat_cfg)
+        # the token usage and cost of the session, set when a run starts
+        self.usage_cfg = kwargs.get('usage_cfg', {})
+        self.usage: Optional[UsageTracker] = None
+
+        # the persistent history, so callers do not resend it on every run
+        self.session_store = self._build_session_store(**kwargs)
+        # the relevant facts of the past sessions of the user
+        self.long_term_memory = self._build_long_term_memory(**kwargs)
+        # the responses of the earlier requests, and the hit of the current run
+        self.response_cache = self._build_response_cache(**kwargs)
+        self.cache_hit: Optional[Dict] = None
+        self._used_side_effects = False
+        self._bound_session = self.session_id
+        self._bound_user = self.user_id
+
+    def _build_context_manager(self, **kwargs) -> ContextManager:
+        return ContextManager(
+            model=getattr(self.llm, 'model', None),
+            llm=self.llm,
+            **kwargs.get('context_cfg', {}))
+
+    @profiled
     def run(self, *args, **kwargs) -> Union[str, Iterator[str]]:
+        """
+        Run the agent on a user request
+
+        Besides the kwargs of _run, it takes
+            timeout: the time budget of the run in seconds, shared by its turns
+            cancel_token: a CancellationToken, so the caller can cancel the run
+            reserved_turns: a turn may use the remaining budget divided by this number
+            profile: whether to write the CPU and memory profiles of the run under
+                PROFILE_PATH/uuid_str, by default a sample of PROFILE_SAMPLE_RATE of the
+                runs is profiled when the environment variable PROFILE_ENABLE is on
+        The run stops as soon as it is cancelled or out of budget, or when the caller
+        closes the stream, and the reason is set to self.cancel_reason. The usage of
+        the run and its session is in self.usage.
+        """
+        self.continuation_id = None
+        self._bind_session()
+        self._start_cancellation(kwargs)
+        self._start_usage()
+        self.action_tracker = ActionTracker(**self.repeat_cfg)
+        self._used_side_effects = False
+        user_request = args[0] if args else kwargs.get('user_request', '')
+        if self.session_store is not None and kwargs.get('history') is None:
+            kwargs['history'] = self._load_history()
         if 'lang' not in kwargs:
-            if has_chinese_chars([args, kwargs]):
-                kwargs['lang'] = 'zh'
-            else:
-                kwargs['lang'] = 'en'
-        
+            kwargs['lang'] = self._get_lang(*args, **kwargs)
+
+        retrieved = []
         if kwargs.get('use_vs', None) is not None:
             use_vs = kwargs['use_vs']
             if use_vs:
                 if kwargs.get('vs_cfg', None) is None:
                     raise ValueError('Please specify the vs_cfg when use_vs is True')
                 
-                vs_cfg = kwargs['vs_cfg']
-                from Agent.storage.vector_storage import VectorStorage
-                if getattr(self, 'function_retriever', None) is None:
-                    if vs_cfg.get('index_name') is None:
-                        vs_cfg['index_name'] = 'tool'
-                    self.function_retriever = VectorStorage(**vs_cfg,)
-                    self.function_retriever.load()
+                self.load_function_retriever(kwargs['vs_cfg'])
             
             if use_vs:
                 matched_tools = self.function_retriever.search(args[0], top_k=2)
@@ -85,16 +214,214 @@ class BaseAgent(ABC):
                 for tool in matched_tools:
                     tool_name = json5.loads(tool)['name']
                     function_list.append(tool_name)
-                if function_list:
-                    for function in function_list:
-                        self._register_tool(function)
+                self._scope_retrieved_tools(function_list)
+                retrieved = function_list
+
+        cache_scope = self._lookup_response(
+            user_request,
+            tools=sorted(self._base_tools.union(retrieved)),
+            **kwargs)
+        if self.cache_hit is not None and not self.cache_hit['sampled']:
+            # a near-duplicate request is answered without running the agent
+            return self._finish_run(iter([self.cache_hit['response']]),
+                                    user_request)
+
+        response = self._guard_cancellation(self._run(*args, **kwargs))
+        if cache_scope is not None:
+            response = self._cache_response(response, user_request,
+                                            cache_scope)
+        return self._finish_run(response, user_request)
+
+    def _finish_run(self, response: Union[str, Iterator[str]],
+                    user_request: str) -> Union[str, Iterator[str]]:
+        if self.session_store is None and self.long_term_memory is None:
+            return response
+        return self._save_turn(response, user_request)
+
+    def cancel(self, reason: str = 'cancelled'):
+        """
+        Cancel the current run, which may be called from another thread
+        """
+        if self.cancel_token is not None:
+            self.cancel_token.cancel(reason)
+
+    def _start_cancellation(self, kwargs: Dict):
+        # a token of the run itself, so that stopping the run does not cancel the token
+        # of the caller
+        parent = kwargs.pop('cancel_token', None) or CancellationToken()
+        self.cancel_token = parent.child(kwargs.pop('timeout', None))
+        self.reserved_turns = kwargs.pop('reserved_turns', RESERVED_TURNS)
+        self.cancel_reason = None
+
+    @property
+    def session_id(self) -> str:
+        """
+        The key of the persistent state of the session, which is the uuid_str, or the
+        id of this agent when it has none, so unrelated runs never share a session
+        """
+        return self.uuid_str or self._agent_session
+
+    def _bind_session(self):
+        """
+        Rebuild the stores of the session when uuid_str changed after they were built,
+        and the long-term memory when user_id changed, such as when the batch runner
+        reuses one agent for the sessions of its requests
+        """
+        if self._bound_session != self.session_id:
+            self._bound_session = self.session_id
+            self.artifact_store = self._build_artifact_store(
+                **self._session_kwargs)
+        if self._bound_user != self.user_id:
+            self._bound_user = self.user_id
+            if self.long_term_memory is not None:
+                self.long_term_memory.close()
+                self.long_term_memory = self._build_long_term_memory(
+                    **self._session_kwargs)
+
+    def _start_usage(self):
+        # the quotas of the session stop the run through its token
+        self.usage = get_usage_tracker(self.session_id,
+                                       **self.usage_cfg)
+        self.usage.start_run(self.cancel_token)
+
+    def _usage_meter(self, role: str) -> Optional[UsageMeter]:
+        """
+        The usage kwarg of the llm calls of one role, None when _run is called
+        without run
+        """
+        if self.usage is None:
+            return None
+        return self.usage.meter(role)
+
+    def _guard_cancellation(self, response):
+        """
+        End the run quietly once it is cancelled, and cancel it when the caller stops
+        reading it, which closes the streams of the llm still open
+        """
+        if isinstance(response, str):
+            return response
+        return self._guarded(response, self.cancel_token)
 
-        return self._run(*args, **kwargs)
+    def _guarded(self, response: Iterator, token: CancellationToken):
+        finished = False
+        try:
+            yield from response
+            finished = True
+        except RunCancelled as e:
+            self.cancel_reason = e.reason
+            logger.warning(f'The run of {self.uuid_str} stopped: {e.reason}')
+            token.cancel(e.reason)
+            finished = True
+        finally:
+            if not finished:
+                token.cancel('abandoned')
+
+    def _turn_token(self, turns_left: int) -> CancellationToken:
+        """
+        The token of one turn, whose deadline is its share of the remaining budget
+        """
+        if self.cancel_token is None:
+            # _run is called without run
+            self._start_cancellation({})
+        remaining = self.cancel_token.remaining()
+        if remaining is None:
+            return self.cancel_token.child()
+        return self.cancel_token.child(
+            remaining / max(1, min(turns_left, self.reserved_turns)))
+
+    def load_function_retriever(self, vs_cfg: Dict):
+        """
+        Load the retriever of tools once, which is reused by the later runs
+        """
+        if getattr(self, 'function_retriever', None) is None:
+            from Agent.storage.vector_storage import VectorStorage
+            if vs_cfg.get('index_name') is None:
+                vs_cfg['index_name'] = 'tool'
+            self.function_retriever = VectorStorage(**vs_cfg, )
+            self.function_retriever.load()
+        return self.function_retriever
+
+    def _get_lang(self, *args, **kwargs) -> str:
+        """
+        Get the language of one run. The language of the agent is used if specified,
+        otherwise it is detected from the user request only and cached per session.
+        """
+        if self.lang:
+            return self.lang
+        if self.uuid_str in self._session_lang:
+            return self._session_lang[self.uuid_str]
+        user_request = args[0] if args else kwargs.get('user_request', '')
+        lang = detect_lang(user_request)
+        if self.uuid_str is not None:
+            self._session_lang[self.uuid_str] = lang
+        return lang
 
     @abstractmethod
     def _run(self, *args, **kwargs) -> Union[str, Iterator[str]]:
         raise NotImplementedError
 
+    @profiled
+    def resume(self,
+               answer: str,
+               continuation_id: Optional[str] = None,
+               **kwargs) -> Union[str, Iterator[str]]:
+        """
+        Resume a session suspended by a tool waiting for the user, such as ask_human_for_help
+
+        Args:
+            answer: the answer of the user, which is used as the result of the pending tool call
+            continuation_id: the id returned in self.continuation_id of the suspended run,
+                the uuid_str of the agent by default
+
+        Returns:
+            the rest of the run, in the same format as run
+        """
+        continuation_id = continuation_id or self.uuid_str
+        continuation = self.continuation_store.pop(continuation_id)
+        if continuation is None:
+            raise KeyError(f'No suspended session: {continuation_id}')
+        if continuation['agent'] != type(self).__name__:
+            raise ValueError(
+                f'The session is suspended by {continuation["agent"]}, '
+                f'it can not be resumed by {type(self).__name__}')
+        self.continuation_id = None
+        self._bind_session()
+        self._start_cancellation(kwargs)
+        self._start_usage()
+        # the answer of the user is the observation of the pending call
+        self.action_tracker = ActionTracker(**self.repeat_cfg)
+        self.action_tracker.load_state_dict(continuation['state'].pop(
+            'actions', None))
+        self.action_tracker.record_answer(answer)
+        self.cache_hit = None
+        response = self._guard_cancellation(
+            self._resume(continuation['state'], answer, **kwargs))
+        return self._finish_run(response, answer)
+
+    def _resume(self, state: Dict, answer: str,
+                **kwargs) -> Union[str, Iterator[str]]:
+        raise NotImplementedError
+
+    def _suspend(self, state: Dict, question: str) -> str:
+        """
+        Save the state of a run waiting for the user as a continuation, the run should
+        return right after so that it holds no thread or connection while waiting
+
+        Returns:
+            the continuation id, which is also set to self.continuation_id
+        """
+        continuation_id = self.uuid_str or uuid.uuid4().hex
+        state['actions'] = self.action_tracker.state_dict()
+        self.continuation_store.add(
+            continuation_id, {
+                'agent': type(self).__name__,
+                'question': question,
+                'state': state
+            })
+        self.continuation_id = continuation_id
+        logger.info(f'Suspend the session {continuation_id} for: {question}')
+        return continuation_id
+
     def _call_llm(self,
                   prompt: Optional[str] = None,
                   messages: Optional[List[Dict]] = None,
@@ -111,8 +438,250 @@ class BaseAgent(ABC):
         """
         Use when calling tools in bot()
 
+        The handles of artifacts in tool_args are replaced with their values, and a large
+        result is stored as an artifact and returned as its handle with a short preview.
+        The cancel_token in kwargs and the lang of the run are passed to the tool, which
+        may stop early with the token and answer in the lang.
+        A call repeated with the same arguments in the run is answered from the earlier
+        one, unless the tool is repeatable.
+        """
+        lang = kwargs.pop('lang', 'en')
+        if kwargs.get('cancel_token') is not None:
+            kwargs['cancel_token'].raise_if_cancelled()
+        tool = self.function_map[tool_name]
+        if tool.side_effects:
+            self._used_side_effects = True
+        if not tool.repeatable:
+            observation = self.action_tracker.lookup(tool_name, tool_args)
+            if observation is not None:
+                logger.info(f'Repeated call of {tool_name}: {tool_args}')
+                return self.action_tracker.format_repeat(observation, lang)
+        call_args = tool_args
+        if isinstance(tool_args, str) and ARTIFACT_PREFIX in tool_args:
+            try:
+                tool_args = self.artifact_store.resolve(
+                    parse_json_args(tool_args))
+            except ValueError:
+                # leave the invalid arguments to the tool to report
+                pass
+        if tool_name in self._retrieved_tools:
+            # a used tool stays in the working set
+            self._retrieved_tools.move_to_end(tool_name)
+        self.action_tracker.start(tool_name, call_args)
+        started_at = time.time()
+        result = tool.call(tool_args, lang=lang, **kwargs)
+        latency = time.time() - started_at
+        observation = self.artifact_store.wrap(result, lang=lang)
+        if self.long_term_memory is not None:
+            # the handles and the preview of a large result, not its whole value
+            self.long_term_memory.add_observation(tool_name, call_args,
+                                                  str(observation))
+        self.action_tracker.record(tool_name, call_args, observation)
+        if self.usage is not None:
+            self.usage.record_tool(tool_name, latency, observation)
+        return observation
+
+    def _lookup_response(self, user_request: str, tools: List[str],
+                         **kwargs) -> Optional[str]:
+        """
+        Look up the response cache for a request without history, the hit is set to
+        self.cache_hit
+
+        Args:
+            user_request: the request of the run
+            tools: the tools of the request, which are the tools given at init and the
+                ones retrieved for it, not the ones left from earlier runs
+
+        Returns:
+            the scope of the request in the cache, None when the cache is not used
+        """
+        self.cache_hit = None
+        if self.response_cache is None or kwargs.get('history'):
+            return None
+        # the response depends on the agent, its tools and the language
+        scope = hashlib.md5(
+            json.dumps([
+                type(self).__name__,
+                getattr(self.llm, 'model', None), self.instruction, tools,
+                kwargs.get('lang')
+            ],
+                       ensure_ascii=False,
+                       sort_keys=True,
+                       default=str).encode('utf-8')).hexdigest()
+        try:
+            self.cache_hit = self.response_cache.lookup(user_request, scope)
+        except Exception as e:
+            logger.warning(f'Failed to look up the response cache: {e}')
+        return scope
+
+    def _cache_response(self, response: Union[str, Iterator[str]],
+                        user_request: str,
+                        scope: str) -> Union[str, Iterator[str]]:
+        """
+        Cache the response of a run when it ends, or compare it with the cached one
+        of a sampled hit
+        """
+        if isinstance(response, str):
+            self._store_response(response, user_request, scope)
+            return response
+        return self._stream_and_cache(response, user_request, scope)
+
+    def _stream_and_cache(self, response: Iterator[str], user_request: str,
+                          scope: str):
+        text = ''
+        for chunk in response:
+            if isinstance(chunk, str):
+                text += chunk
+            yield chunk
+        self._store_response(text, user_request, scope)
+
+    def _store_response(self, response: str, user_request: str, scope: str):
+        # a cancelled, suspended or side-effecting run is not answered again
+        if not response or self.cancel_reason or self.continuation_id \
+                or self._used_side_effects:
+            return
+        try:
+            if self.cache_hit is not None:
+                self.response_cache.check_sample(self.cache_hit, user_request,
+                                                 response)
+            else:
+                self.response_cache.add(user_request, response, scope)
+        except Exception as e:
+            logger.warning(f'Failed to cache the response: {e}')
+
+    def _recall_memory(self, user_request: str, lang: str = 'en') -> str:
+        """
+        The memories relevant to the user request formatted as a prefix of the request,
+        empty if the long-term memory is disabled
+        """
+        if self.long_term_memory is None:
+            return ''
+        return self.long_term_memory.build_prompt(user_request, lang)
+
+    def _build_artifact_store(self, **kwargs) -> ArtifactStorage:
+        artifact_cfg = dict(kwargs.get('artifact_cfg', {}))
+        if self.storage_path and 'storage_path' not in artifact_cfg:
+            artifact_cfg['storage_path'] = os.path.join(
+                self.storage_path, 'artifacts', self.session_id)
+        return ArtifactStorage(**artifact_cfg)
+
+    def _load_history(self) -> List[Dict]:
+        """
+        Load the tail of the persistent history which fits the context budget
+        """
+        return self.session_store.search(
+            self.session_id,
+            max_tokens=self.context_manager.max_tokens,
+            token_counter=self.context_manager.count_tokens)
+
+    def _save_turn(self, response: Union[str, Iterator[str]],
+                   user_request: str) -> Union[str, Iterator[str]]:
+        """
+        Append the user request and the response of one run to the persistent history,
+        a streamed response is passed through and saved when it ends
+        """
+        if isinstance(response, str):
+            self._append_turn(user_request, response)
+            return response
+        return self._stream_and_save(response, user_request)
+
+    def _stream_and_save(self, response: Iterator[str], user_request: str):
+        text = ''
+        for chunk in response:
+            if isinstance(chunk, str):
+                text += chunk
+            yield chunk
+        self._append_turn(user_request, text)
+
+    def _append_turn(self, user_request: str, response: str):
+        if self.session_store is not None:
+            self.session_store.add(self.session_id, [{
+                'role': 'user',
+                'content': user_request
+            }, {
+                'role': 'assistant',
+                'content': response
+            }])
+        if self.long_term_memory is not None:
+            self.long_term_memory.add_turn(user_request, response)
+
+    def _build_session_store(self, **kwargs) -> Optional[SessionStorage]:
+        if not self.storage_path:
+            return None
+        return get_session_storage(
+            os.path.join(self.storage_path, 'sessions.sqlite'),
+            **kwargs.get('session_cfg', {}))
+
+    def _build_long_term_memory(self, **kwargs) -> Optional[LongTermMemory]:
+        memory_cfg = kwargs.get('memory_cfg')
+        if memory_cfg is None:
+            return None
+        memory_cfg = dict(memory_cfg)
+        if 'storage_path' not in memory_cfg:
+            memory_cfg['storage_path'] = os.path.join(self.storage_path or '.',
+                                                      'memory')
+        if self.user_id is not None:
+            # one index per user, which is recalled in all the sessions of the user
+            memory_cfg['index_name'] = (
+                f'{memory_cfg.get("index_name", "memory")}_{self.user_id}')
+        memory_cfg.setdefault('token_counter',
+                              self.context_manager.count_tokens)
+        return LongTermMemory(**memory_cfg)
+
+    def _build_response_cache(self, **kwargs) -> Optional[ResponseCache]:
+        cache_cfg = kwargs.get('cache_cfg')
+        if cache_cfg is None:
+            return None
+        cache_cfg = dict(cache_cfg)
+        if 'storage_path' not in cache_cfg:
+            cache_cfg['storage_path'] = os.path.join(self.storage_path or '.',
+                                                     'response_cache')
+        return get_response_cache(**cache_cfg)
+
+    def _build_continuation_store(self) -> ContinuationStorage:
+        continuation_path = None
+        if self.storage_path:
+            continuation_path = os.path.join(self.storage_path, 'continuations')
+        return ContinuationStorage(continuation_path)
+
+    def _init_tool_scope(self, **kwargs):
+        # the tools retrieved by use_vs, from the least to the most recently used
+        self._retrieved_tools: OrderedDict = OrderedDict()
+        self.max_retrieved_tools = kwargs.get('max_retrieved_tools',
+                                              MAX_RETRIEVED_TOOLS)
+        # the instantiated tools, so a tool evicted and retrieved again is not rebuilt
+        self._tool_instances: Dict[str, BaseTool] = {}
+        self._base_tools = set()
+
+    def _scope_retrieved_tools(self, function_list: List[Union[str, Dict]]):
+        """
+        Add the tools retrieved for this run to the working set, and evict the least
+        recently retrieved or used ones beyond max_retrieved_tools, so the prompt only
+        grows with the relevant tools. The tools given at init are never evicted.
         """
-        return self.function_map[tool_name].call(tool_args, **kwargs)
+        for function in function_list:
+            tool_name = function if isinstance(function,
+                                               str) else next(iter(function))
+            if tool_name in self._base_tools:
+                continue
+            self._register_tool(function)
+            self._retrieved_tools[tool_name] = None
+            self._retrieved_tools.move_to_end(tool_name)
+        while len(self._retrieved_tools) > max(self.max_retrieved_tools,
+                                               len(function_list)):
+            tool_name, _ = self._retrieved_tools.popitem(last=False)
+            self._unregister_tool(tool_name)
+
+    def _unregister_tool(self, tool_name: str):
+        tool = self.function_map.pop(tool_name, None)
+        if tool is None:
+            return
+        self.function_list = [
+            function for function in self.function_list
+            if (function if isinstance(function, str) else next(
+                iter(function))) != tool_name
+        ]
+        self.tool_index.remove(tool_name)
 
     def _register_tool(self, tool: Union[str, Dict]):
         """
@@ -134,18 +703,25 @@ class BaseAgent(ABC):
             tool_cfg = tool[tool_name]
         if tool_name not in TOOL_REGISTRY:
             raise NotImplementedError
-        if tool not in self.function_list:
-            self.function_list.append(tool)
+        if tool_name in self.function_map:
+            return
+        self.function_list.append(tool)
+        instance_key = json.dumps(tool, sort_keys=True, default=str)
+        tool_instance = self._tool_instances.get(instance_key)
+        if tool_instance is None:
             tool_class = TOOL_REGISTRY[tool_name]
             try:
-                self.function_map[tool_name] = tool_class(tool_cfg)
+                tool_instance = tool_class(tool_cfg)
             except TypeError:
                 # When using OpenAPI, tool_class is already an instantiated object, not a corresponding class
-                self.function_map[tool_name] = tool_class
+                tool_instance = tool_class
             except Exception as e:
                 raise RuntimeError(e)
-            
+
             if self.llm.model_server == 'openai':
-                self.function_map[tool_name].schema = 'oai'
+                tool_instance.schema = 'oai'
             else:
-                self.function_map[tool_name].schema = ''
+                tool_instance.schema = ''
+            self._tool_instances[instance_key] = tool_instance
+        self.function_map[tool_name] = tool_instance
+        self.tool_index.add(tool_name, getattr(tool_instance, 'aliases', []))
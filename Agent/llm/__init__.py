@@ -3,6 +3,7 @@ import re
 from .base import LLM_REGISTRY, BaseChatModel
 from .dashscope import DashScopeLLM, QwenChatAtDS
 from .openai import OpenAi
+from .router import RouterLLM
 
 
 def get_chat_model(model: str, model_server: str, **kwargs) -> BaseChatModel:
@@ -23,4 +24,5 @@ def get_chat_model(model: str, model_server: str, **kwargs) -> BaseChatModel:
 
 __all__ = [
     'LLM_REGISTRY', 'BaseChatModel', 'OpenAi', 'DashScopeLLM', 'QwenChatAtDS',
+    'RouterLLM'
 ]
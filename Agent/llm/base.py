@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
 from typing import Dict, Iterator, List, Optional, Union, Tuple
 
+from Agent.tools.name_index import ToolNameIndex
+from Agent.utils.cancellation import cancellable
+from Agent.utils.logger import agent_logger as logger
 from Agent.utils.retry import retry
+from Agent.utils.usage import metered
 from Agent.utils.utils import print_traceback
 
 LLM_REGISTRY = {}
@@ -48,6 +52,8 @@ class BaseChatModel(ABC):
     # ```
 
     @retry(max_retries=3, delay_seconds=0.5)
+    @cancellable
+    @metered
     def chat(self,
              prompt: Optional[str] = None,
              messages: Optional[List[Dict]] = None,
@@ -62,6 +68,10 @@ class BaseChatModel(ABC):
             messages: The inputted messages, such as [{'role': 'user', 'content': 'hello'}]
             stop: The stop words list. The model will stop when outputted to them.
             stream: Requires streaming or non-streaming output
+            cancel_token: the CancellationToken of the run, which stops the call and
+                the retries when cancelled
+            usage: the UsageMeter into which the call is recorded, the backend gets
+                the CallUsage of the call instead to report the usage of the provider
 
         Returns:
             (1) When str: Generated str response from llm in non-streaming
@@ -79,6 +89,8 @@ class BaseChatModel(ABC):
             return self._chat_no_stream(messages, stop=stop, **kwargs)
 
     @retry(max_retries=3, delay_seconds=0.5)
+    @cancellable
+    @metered
     def chat_with_functions(self,
                             messages: List[Dict],
                             functions: Optional[List[Dict]] = None,
@@ -217,8 +229,11 @@ class BaseChatModel(ABC):
         except Exception:
             return False
         
-    def _detect_tool(self, message: Union[str,
-                                        dict], function_map) -> Tuple[bool, str, str, str]:
+    def _detect_tool(self,
+                     message: Union[str, dict],
+                     function_map,
+                     tool_index: Optional[ToolNameIndex] = None
+                     ) -> Tuple[bool, str, str, str]:
         """
         A built-in tool call detection for func_call format
 
@@ -227,6 +242,8 @@ class BaseChatModel(ABC):
                 (1) When dict: Determine whether to call the tool through the function call format.
                 (2) When str: The tool needs to be parsed from the string, and at this point, the agent subclass needs
                                 to implement a custom _detect_tool function.
+            function_map: the tools registered in the agent
+            tool_index: the name index of function_map, it is built on the fly if not given
 
         Returns:
             - bool: need to call tool or not
@@ -251,14 +268,34 @@ class BaseChatModel(ABC):
         text = message.get('content', '')
 
         # can detect hallucination and in some way correct it
-        # TODO add logger for hallucination
+        find_tool = False
         if func_name is not None:
-            find_tool = False
-            for tool in function_map.values():
-                if tool.name.endswith(func_name):
-                    func_name = tool.name
-                    find_tool = True
-                    break
+            resolved_name = self._resolve_tool_name(func_name, function_map,
+                                                    tool_index)
+            if resolved_name is not None:
+                func_name = resolved_name
+                find_tool = True
 
         return (func_name is not None
                 and find_tool), func_name, func_args, text
+
+    def _resolve_tool_name(
+            self,
+            func_name: str,
+            function_map,
+            tool_index: Optional[ToolNameIndex] = None) -> Optional[str]:
+        """
+        Resolve a possibly hallucinated tool name to a registered tool name
+        """
+        if tool_index is None:
+            tool_index = ToolNameIndex()
+            for tool in function_map.values():
+                tool_index.add(tool.name, getattr(tool, 'aliases', []))
+        resolved_name = tool_index.resolve(func_name)
+        if resolved_name is None:
+            logger.warning(f'Failed to resolve the tool name: {func_name}')
+        elif resolved_name != func_name:
+            logger.info(
+                f'Corrected the hallucinated tool name: {func_name} -> {resolved_name}'
+            )
+        return resolved_name
@@ -3,12 +3,14 @@ from http import HTTPStatus
 from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import dashscope
+from Agent.tools.name_index import ToolNameIndex
 from Agent.utils.logger import agent_logger as logger
 
 from .base import BaseChatModel, register_llm
 
 
 def stream_output(response, **kwargs):
+    usage = kwargs.get('usage')
     last_len = 0
     delay_len = 5
     in_delay = False
@@ -21,6 +23,8 @@ def stream_output(response, **kwargs):
                     f'call dashscope generation api success, '
                     f'request_id: { trunk.request_id}, output: { trunk.output}'
                 )
+            # the usage of every trunk counts the whole output so far
+            _report_usage(usage, trunk)
             text = trunk.output.choices[0].message.content
             if (len(text) - last_len) <= delay_len:
                 in_delay = True
@@ -44,6 +48,15 @@ def stream_output(response, **kwargs):
         yield text[last_len:]
 
 
+def _report_usage(usage, response):
+    if usage is None or not getattr(response, 'usage', None):
+        return
+    # the prompt tokens served from the prompt cache of the provider, if it tells
+    details = response.usage.get('prompt_tokens_details') or {}
+    usage.report(response.usage.input_tokens, response.usage.output_tokens,
+                 details.get('cached_tokens'))
+
+
 @register_llm('dashscope')
 class DashScopeLLM(BaseChatModel):
     """
@@ -96,6 +109,7 @@ class DashScopeLLM(BaseChatModel):
             top_p=top_p,
         )
         if response.status_code == HTTPStatus.OK:
+            _report_usage(kwargs.get('usage'), response)
             return response.output.choices[0].message.content
         else:
             err = 'Error code: %s, error message: %s' % (
@@ -104,9 +118,12 @@ class DashScopeLLM(BaseChatModel):
             )
             return err
     
-    def _detect_tool(self, message: Union[str,
-                                          dict], function_map) -> Tuple[bool, str, str, str]:
-        
+    def _detect_tool(self,
+                     message: Union[str, dict],
+                     function_map,
+                     tool_index: Optional[ToolNameIndex] = None
+                     ) -> Tuple[bool, str, str, str]:
+
         assert isinstance(message, str)
         ACTION_TOKEN = 'Action:'
         ARGS_TOKEN = 'Action Input:'
@@ -128,14 +145,13 @@ class DashScopeLLM(BaseChatModel):
             text = text[:k]  # Discard '\nObservation:'.
 
         # can detect hallucination and in some way correct it
-        # TODO add logger for hallucination
+        find_tool = False
         if func_name is not None:
-            find_tool = False
-            for tool in function_map.values():
-                if tool.name.endswith(func_name):
-                    func_name = tool.name
-                    find_tool = True
-                    break
+            resolved_name = self._resolve_tool_name(func_name, function_map,
+                                                    tool_index)
+            if resolved_name is not None:
+                func_name = resolved_name
+                find_tool = True
 
         return (func_name is not None
                 and find_tool), func_name, func_args, text
@@ -171,6 +187,7 @@ class QwenChatAtDS(DashScopeLLM):
         if response.status_code == HTTPStatus.OK:
             # with open('debug.json', 'w', encoding='utf-8') as writer:
             #     writer.write(json.dumps(response, ensure_ascii=False))
+            _report_usage(kwargs.get('usage'), response)
             return response.output.choices[0].message.content
         else:
             err = 'Error code: %s, error message: %s' % (
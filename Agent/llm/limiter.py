@@ -0,0 +1,139 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from Agent.tools.name_index import ToolNameIndex
+from Agent.utils.cancellation import CancellationToken
+
+from .base import BaseChatModel
+
+# the seconds between the checks of the cancellation while waiting for a slot
+ACQUIRE_POLL_SECONDS = 0.5
+
+
+class _LimitedStream:
+    """
+    A streamed output which holds a slot of the semaphore until it is exhausted, closed
+    or collected
+    """
+
+    def __init__(self, output: Iterator, semaphore):
+        self._output = output
+        self._semaphore = semaphore
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._output)
+        except BaseException:
+            self._release()
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._output, 'close'):
+                self._output.close()
+        finally:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._semaphore.release()
+
+    def __del__(self):
+        self._release()
+
+
+class ConcurrencyLimitedLLM(BaseChatModel):
+    """
+    An llm whose concurrent requests are capped by a semaphore, which can be shared
+    by the worker processes of a batch run to cap the requests per backend.
+    A streamed request holds its slot until the stream ends, and a request waiting for
+    a slot stops when its cancel_token is cancelled or runs out of its time budget.
+    """
+
+    def __init__(self, llm: BaseChatModel, semaphore):
+        super().__init__(llm.model, llm.model_server)
+        self.llm = llm
+        self.semaphore = semaphore
+
+    def chat(self,
+             prompt: Optional[str] = None,
+             messages: Optional[List[Dict]] = None,
+             stop: Optional[List[str]] = None,
+             stream: bool = False,
+             **kwargs) -> Union[str, Iterator[str]]:
+        return self._limited(
+            kwargs.get('cancel_token'), lambda: self.llm.chat(
+                prompt=prompt,
+                messages=messages,
+                stop=stop,
+                stream=stream,
+                **kwargs))
+
+    def chat_with_functions(self,
+                            messages: List[Dict],
+                            functions: Optional[List[Dict]] = None,
+                            stream: bool = True,
+                            **kwargs):
+        return self._limited(
+            kwargs.get('cancel_token'), lambda: self.llm.chat_with_functions(
+                messages=messages, functions=functions, stream=stream, **kwargs))
+
+    def chat_with_raw_prompt(self,
+                             prompt: str,
+                             stop: Optional[List[str]] = None,
+                             **kwargs) -> str:
+        if prompt == '':
+            return self.llm.chat_with_raw_prompt(prompt, stop=stop, **kwargs)
+        return self._limited(
+            kwargs.get('cancel_token'), lambda: self.llm.chat_with_raw_prompt(
+                prompt, stop=stop, **kwargs))
+
+    def build_raw_prompt(self, messages):
+        return self.llm.build_raw_prompt(messages)
+
+    def support_function_calling(self) -> bool:
+        return self.llm.support_function_calling()
+
+    def support_raw_prompt(self) -> bool:
+        return self.llm.support_raw_prompt()
+
+    def _detect_tool(self,
+                     message: Union[str, dict],
+                     function_map,
+                     tool_index: Optional[ToolNameIndex] = None
+                     ) -> Tuple[bool, str, str, str]:
+        return self.llm._detect_tool(message, function_map, tool_index)
+
+    def _chat_stream(self, messages, stop=None, **kwargs):
+        return self.chat(messages=messages, stop=stop, stream=True, **kwargs)
+
+    def _chat_no_stream(self, messages, stop=None, **kwargs):
+        return self.chat(messages=messages, stop=stop, stream=False, **kwargs)
+
+    def _acquire(self, cancel_token: Optional[CancellationToken]):
+        if cancel_token is None:
+            self.semaphore.acquire()
+            return
+        while True:
+            cancel_token.raise_if_cancelled()
+            remaining = cancel_token.remaining()
+            timeout = ACQUIRE_POLL_SECONDS if remaining is None else min(
+                ACQUIRE_POLL_SECONDS, remaining)
+            if self.semaphore.acquire(timeout=timeout):
+                return
+
+    def _limited(self, cancel_token: Optional[CancellationToken], func):
+        self._acquire(cancel_token)
+        try:
+            output = func()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        if isinstance(output, (str, dict)) or not hasattr(output, '__next__'):
+            self.semaphore.release()
+            return output
+        return _LimitedStream(output, self.semaphore)
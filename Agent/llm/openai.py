@@ -2,7 +2,9 @@ import os
 from typing import Dict, Iterator, List, Optional, Union
 
 from Agent.llm.base import BaseChatModel, register_llm
+from Agent.utils.cancellation import cancellable
 from Agent.utils.retry import retry
+from Agent.utils.usage import metered
 from openai import OpenAI
 
 
@@ -15,7 +17,14 @@ class OpenAi(BaseChatModel):
                  is_chat: bool = True,
                  is_function_call: Optional[bool] = None,
                  support_stream: Optional[bool] = None,
+                 stream_usage: bool = False,
                  **kwargs):
+        """
+        Args:
+            stream_usage: ask for the usage in the last chunk of a streamed output, which
+                needs a server supporting stream_options, otherwise the usage of streams
+                is counted locally
+        """
         super().__init__(model, model_server)
 
         api_base = kwargs.get('api_base', 'https://api.openai.com/v1').strip()
@@ -26,11 +35,15 @@ class OpenAi(BaseChatModel):
         self.is_function_call = is_function_call
         self.is_chat = is_chat
         self.support_stream = support_stream
+        self.stream_usage = stream_usage
 
     def _chat_stream(self,
                      messages: List[Dict],
                      stop: Optional[List[str]] = None,
                      **kwargs) -> Iterator[str]:
+        usage = kwargs.pop('usage', None)
+        if self.stream_usage:
+            kwargs['stream_options'] = {'include_usage': True}
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
@@ -39,13 +52,16 @@ class OpenAi(BaseChatModel):
             **kwargs)
         # TODO: error handling
         for chunk in response:
-            if hasattr(chunk.choices[0].delta, 'content'):
+            _report_usage(usage, chunk)
+            # the chunk of the usage has no choices
+            if chunk.choices and hasattr(chunk.choices[0].delta, 'content'):
                 yield chunk.choices[0].delta.content
 
     def _chat_no_stream(self,
                         messages: List[Dict],
                         stop: Optional[List[str]] = None,
                         **kwargs) -> str:
+        usage = kwargs.pop('usage', None)
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
@@ -53,6 +69,7 @@ class OpenAi(BaseChatModel):
             stream=False,
             **kwargs)
         # TODO: error handling
+        _report_usage(usage, response)
         return response.choices[0].message.content
 
     def support_function_calling(self):
@@ -69,6 +86,8 @@ class OpenAi(BaseChatModel):
             return not self.is_chat
 
     @retry(max_retries=3, delay_seconds=0.5)
+    @cancellable
+    @metered
     def chat(self,
              prompt: Optional[str] = None,
              messages: Optional[List[Dict]] = None,
@@ -85,9 +104,10 @@ class OpenAi(BaseChatModel):
         return super().chat(
             messages=messages, stop=stop, stream=stream, **kwargs)
 
-    def _out_generator(self, response):
+    def _out_generator(self, response, usage=None):
         for chunk in response:
-            if hasattr(chunk.choices[0], 'text'):
+            _report_usage(usage, chunk)
+            if chunk.choices and hasattr(chunk.choices[0], 'text'):
                 yield chunk.choices[0].text
 
     def chat_with_raw_prompt(self,
@@ -95,22 +115,31 @@ class OpenAi(BaseChatModel):
                              stream: bool = True,
                              **kwargs) -> str:
         max_tokens = kwargs.get('max_tokens', 2000)
+        usage = kwargs.get('usage')
+        extra = {}
+        if stream and self.stream_usage:
+            extra['stream_options'] = {'include_usage': True}
         response = self.client.completions.create(
             model=self.model,
             prompt=prompt,
             stream=stream,
-            max_tokens=max_tokens)
+            max_tokens=max_tokens,
+            **extra)
 
         # TODO: error handling
         if stream:
-            return self._out_generator(response)
+            return self._out_generator(response, usage)
         else:
+            _report_usage(usage, response)
             return response.choices[0].text
 
+    @cancellable
+    @metered
     def chat_with_functions(self,
                             messages: List[Dict],
                             functions: Optional[List[Dict]] = None,
                             **kwargs) -> Dict:
+        usage = kwargs.pop('usage', None)
         if functions:
             response = self.client.completions.create(
                 model=self.model,
@@ -121,5 +150,15 @@ class OpenAi(BaseChatModel):
             response = self.client.completions.create(
                 model=self.model, messages=messages, **kwargs)
         # TODO: error handling
+        _report_usage(usage, response)
         # return a dict which will be parsed by the agent using _detect_tool()
         return response.choices[0].message
+
+
+def _report_usage(usage, response):
+    if usage is None or not getattr(response, 'usage', None):
+        return
+    # the prompt tokens served from the prompt cache of the provider, if it tells
+    details = getattr(response.usage, 'prompt_tokens_details', None)
+    usage.report(response.usage.prompt_tokens, response.usage.completion_tokens,
+                 getattr(details, 'cached_tokens', None))
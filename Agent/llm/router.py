@@ -0,0 +1,380 @@
+import queue
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from Agent.tools.name_index import ToolNameIndex
+from Agent.utils.logger import agent_logger as logger
+
+from .base import BaseChatModel, register_llm
+
+# dashscope returns the errors as text instead of raising them
+ERROR_TEXT_PATTERN = re.compile(r'^\s*Error code: ')
+
+
+class BackendStats:
+    """
+    The observed latency and error rate of one backend
+    """
+
+    def __init__(self,
+                 window: int = 200,
+                 alpha: float = 0.2,
+                 failure_threshold: int = 3,
+                 cooldown: float = 30.0):
+        """
+        Args:
+            window: the number of recent latencies kept for the percentiles
+            alpha: the weight of the newest sample in the moving averages
+            failure_threshold: the backend is skipped after this many failures in a row
+            cooldown: the seconds a failing backend is skipped
+        """
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=window)
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += self.alpha * (latency - self.latency_ewma)
+            self.error_rate *= 1 - self.alpha
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+            self.error_rate += self.alpha * (1 - self.error_rate)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self.unhealthy_until = time.time() + self.cooldown
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def record_hedge_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def is_healthy(self) -> bool:
+        return time.time() >= self.unhealthy_until
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self.latencies:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def snapshot(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'error_rate': round(self.error_rate, 4),
+            'latency_ewma': self.latency_ewma,
+            'latency_p50': self.percentile(0.5),
+            'latency_p95': self.percentile(0.95),
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'healthy': self.is_healthy(),
+        }
+
+
+class _Attempt:
+    """
+    One request to one backend running in a background thread, its events are put
+    into the queue shared by all the attempts of the same call
+    """
+
+    def __init__(self, backend: BaseChatModel, stats: BackendStats,
+                 events: queue.Queue, func, hedged: bool):
+        self.backend = backend
+        self.stats = stats
+        self.hedged = hedged
+        self.cancelled = threading.Event()
+        self.first_token_at: Optional[float] = None
+        self._events = events
+        self._func = func
+        self._started_at = time.time()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            output = self._func(self.backend)
+            if isinstance(output, (str, dict)) or output is None:
+                output = [output]
+            for chunk in output:
+                if self.first_token_at is None:
+                    if isinstance(chunk, str) and ERROR_TEXT_PATTERN.match(
+                            chunk):
+                        raise RuntimeError(chunk.strip())
+                    # recorded even when the attempt lost a hedge, so the slow
+                    # backend is ranked down
+                    self.first_token_at = time.time()
+                    self.stats.record_success(self.first_token_at
+                                              - self._started_at)
+                if self.cancelled.is_set():
+                    return
+                self._events.put((self, 'chunk', chunk))
+            self._events.put((self, 'done', None))
+        except Exception as e:
+            if self.first_token_at is None:
+                self.stats.record_failure()
+            self._events.put((self, 'error', e))
+
+
+@register_llm('router')
+class RouterLLM(BaseChatModel):
+    """
+    A composite llm over several backends. Each request goes to the backend with the
+    best observed latency and error rate, fails over to the next one when a backend
+    errors before its first token, and optionally hedges: when the first token is
+    later than the p95 of the backend, a duplicate request is sent to the next backend
+    and whichever streams first is kept.
+
+    Example config:
+        {'model': 'router', 'model_server': 'router', 'hedge': True,
+         'backends': [{'model': 'qwen-max', 'model_server': 'dashscope'},
+                      {'model': 'qwen-max', 'model_server': 'openai', 'api_base': '...'}]}
+    """
+
+    def __init__(self,
+                 model: str,
+                 model_server: str,
+                 backends: List[Union[Dict, BaseChatModel]] = None,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 10,
+                 error_penalty: float = 10.0,
+                 stats_cfg: Optional[Dict] = None,
+                 **kwargs):
+        """
+        Args:
+            backends: the llm configs or instances to route between
+            hedge: send a duplicate request when the first token is late
+            hedge_quantile: the quantile of the time to first token after which to hedge
+            hedge_min_samples: hedge only after this many latencies are observed
+            error_penalty: how much the error rate weighs against the latency in routing
+            stats_cfg: the config of BackendStats
+        """
+        from Agent.llm import get_chat_model
+        assert backends, 'at least one backend is required'
+        self.backends = [
+            get_chat_model(**backend) if isinstance(backend, Dict) else backend
+            for backend in backends
+        ]
+        # the budgets and the prompt format follow the primary backend
+        super().__init__(self.backends[0].model,
+                         self.backends[0].model_server)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.error_penalty = error_penalty
+        self.stats = [BackendStats(**(stats_cfg or {})) for _ in self.backends]
+        self.names = []
+        for backend in self.backends:
+            name = f'{backend.model_server}/{backend.model}'
+            while name in self.names:
+                name += "'"
+            self.names.append(name)
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """
+        The statistics of each backend, keyed by model_server/model
+        """
+        return {
+            name: stats.snapshot()
+            for name, stats in zip(self.names, self.stats)
+        }
+
+    def chat(self,
+             prompt: Optional[str] = None,
+             messages: Optional[List[Dict]] = None,
+             stop: Optional[List[str]] = None,
+             stream: bool = False,
+             **kwargs) -> Union[str, Iterator[str]]:
+        # the retries are replaced by the failover to other backends
+        return self._route(
+            lambda backend: _unwrap(type(backend).chat)(
+                backend,
+                prompt=prompt,
+                messages=messages,
+                stop=stop,
+                stream=stream,
+                **kwargs), stream)
+
+    def chat_with_functions(self,
+                            messages: List[Dict],
+                            functions: Optional[List[Dict]] = None,
+                            stream: bool = True,
+                            **kwargs):
+        return self._route(
+            lambda backend: _unwrap(type(backend).chat_with_functions)(
+                backend,
+                messages=messages,
+                functions=functions,
+                stream=stream,
+                **kwargs), stream)
+
+    def chat_with_raw_prompt(self,
+                             prompt: str,
+                             stop: Optional[List[str]] = None,
+                             **kwargs) -> str:
+        if prompt == '':
+            return ''
+        return self._route(
+            lambda backend: backend.chat_with_raw_prompt(
+                prompt, stop=stop, **kwargs), False)
+
+    def build_raw_prompt(self, messages):
+        return self.backends[0].build_raw_prompt(messages)
+
+    def support_function_calling(self) -> bool:
+        return all(
+            backend.support_function_calling() for backend in self.backends)
+
+    def support_raw_prompt(self) -> bool:
+        return all(backend.support_raw_prompt() for backend in self.backends)
+
+    def _detect_tool(self,
+                     message: Union[str, dict],
+                     function_map,
+                     tool_index: Optional[ToolNameIndex] = None
+                     ) -> Tuple[bool, str, str, str]:
+        return self.backends[0]._detect_tool(message, function_map,
+                                             tool_index)
+
+    def _chat_stream(self, messages, stop=None, **kwargs):
+        return self.chat(messages=messages, stop=stop, stream=True, **kwargs)
+
+    def _chat_no_stream(self, messages, stop=None, **kwargs):
+        return self.chat(messages=messages, stop=stop, stream=False, **kwargs)
+
+    def _ranked(self) -> List[int]:
+        """
+        The backends ordered by the expected latency, the unhealthy ones last and the
+        ones never used first, so that every backend gets observed
+        """
+
+        def score(i):
+            stats = self.stats[i]
+            latency = stats.latency_ewma or 0.0
+            return (not stats.is_healthy(),
+                    latency * (1 + self.error_penalty * stats.error_rate))
+
+        return sorted(range(len(self.backends)), key=score)
+
+    def _hedge_delay(self, i: int) -> Optional[float]:
+        stats = self.stats[i]
+        if not self.hedge or len(stats.latencies) < self.hedge_min_samples:
+            return None
+        return stats.percentile(self.hedge_quantile)
+
+    def _route(self, func, stream: bool):
+        output = self._race(func)
+        if stream:
+            return output
+        chunks = list(output)
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunks)
+
+    def _race(self, func) -> Iterator:
+        order = self._ranked()
+        events = queue.Queue()
+        attempts = []
+        errors = []
+
+        def start(hedged=False):
+            i = order.pop(0)
+            attempt = _Attempt(self.backends[i], self.stats[i], events, func,
+                               hedged)
+            attempt.index = i
+            attempts.append(attempt)
+            if hedged:
+                self.stats[i].record_hedge()
+            return attempt
+
+        primary = start()
+        hedge_at = None
+        delay = self._hedge_delay(primary.index)
+        if delay is not None and order:
+            hedge_at = time.time() + delay
+
+        winner = None
+        while winner is None:
+            timeout = None if hedge_at is None else max(
+                hedge_at - time.time(), 0)
+            try:
+                attempt, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                logger.info(f'Hedge the request of {self.names[primary.index]}'
+                            f' after {delay:.2f}s')
+                start(hedged=True)
+                hedge_at = None
+                continue
+            if attempt.cancelled.is_set():
+                continue
+            if kind == 'error':
+                attempt.cancelled.set()
+                errors.append(f'{self.names[attempt.index]}: {value}')
+                logger.warning(
+                    f'Backend {self.names[attempt.index]} failed: {value}')
+                if all(a.cancelled.is_set() for a in attempts):
+                    if not order:
+                        raise RuntimeError('All backends failed: '
+                                           + '; '.join(errors))
+                    # fail over to the next backend
+                    hedge_at = None
+                    start()
+                continue
+            winner = attempt
+            for other in attempts:
+                if other is not winner:
+                    other.cancelled.set()
+            if winner.hedged:
+                self.stats[winner.index].record_hedge_win()
+            first = (kind, value)
+
+        return self._stream_winner(winner, events, first)
+
+    @staticmethod
+    def _stream_winner(winner: _Attempt, events: queue.Queue,
+                       first: Tuple) -> Iterator:
+        kind, value = first
+        try:
+            while kind != 'done':
+                if kind == 'error':
+                    # the output is already partly sent, so it can not fail over
+                    raise value
+                yield value
+                attempt, kind, value = events.get()
+                while attempt is not winner:
+                    attempt, kind, value = events.get()
+        finally:
+            # the caller may close the stream early, then the backend is not read anymore
+            winner.cancelled.set()
+
+
+def _unwrap(method):
+    """
+    Get the method without the retry decorator
+    """
+    return getattr(method, '__wrapped__', method)
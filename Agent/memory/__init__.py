@@ -0,0 +1,7 @@
+from .context_manager import ContextManager
+from .long_term_memory import LongTermMemory
+from .response_cache import ResponseCache, get_response_cache
+
+__all__ = [
+    'ContextManager', 'LongTermMemory', 'ResponseCache', 'get_response_cache'
+]
@@ -0,0 +1,342 @@
+import hashlib
+import re
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from Agent.utils.logger import agent_logger as logger
+from Agent.utils.tokenization_utils import get_token_counter
+
+# the input budget in tokens of each model, matched by the longest prefix
+MODEL_CONTEXT_BUDGET = {
+    'qwen-turbo': 6000,
+    'qwen-plus': 30000,
+    'qwen-max': 6000,
+    'qwen-max-longcontext': 28000,
+    'gpt-3.5-turbo': 16000,
+    'gpt-4': 8000,
+    'gpt-4-turbo': 120000,
+    'gpt-4o': 120000,
+}
+DEFAULT_CONTEXT_BUDGET = 6000
+
+OBSERVATION_ROLES = ('tool', 'function', 'observation')
+
+# observations embedded in assistant replies by the ReAct style prompt
+INLINE_OBSERVATION_PATTERN = re.compile(r'(<result>)(.*?)(</result>)', re.S)
+
+ELIDED_TEMPLATE = '\n...({num} tokens omitted)...\n'
+
+SUMMARY_PROMPT_TEMPLATE = """Summarize the following conversation in a few sentences. \
+Keep the facts, numbers and decisions that may be needed later.
+{history}
+Summary:"""
+
+SUMMARY_TEMPLATE = {
+    'user': 'Summary of the earlier conversation: {summary}',
+    'assistant': 'OK.',
+}
+
+
+def get_context_budget(model: Optional[str]) -> int:
+    """
+    Get the input token budget of a model by the longest matched prefix
+    """
+    if not model:
+        return DEFAULT_CONTEXT_BUDGET
+    matched = ''
+    for prefix in MODEL_CONTEXT_BUDGET:
+        if model.startswith(prefix) and len(prefix) > len(matched):
+            matched = prefix
+    return MODEL_CONTEXT_BUDGET.get(matched, DEFAULT_CONTEXT_BUDGET)
+
+
+class ContextManager:
+    """
+    Keep the messages sent to llm under a token budget.
+
+    When the messages exceed the budget, the following steps are applied in order
+    until they fit, and the system prompt and the latest user turn are never touched:
+        1. elide the middle of old observations, oldest first
+        2. replace older turns with their summary, which is generated by a background
+           worker off the critical path, so a summary is only used once it is ready
+        3. drop the oldest turns
+    """
+
+    def __init__(self,
+                 max_tokens: Optional[int] = None,
+                 model: Optional[str] = None,
+                 token_counter: Union[str, Callable[[str], int], None] = None,
+                 llm=None,
+                 summarize: bool = False,
+                 summarizer: Optional[Callable[[List[Dict]], str]] = None,
+                 max_observation_tokens: int = 512,
+                 keep_recent_messages: int = 2,
+                 max_summaries: int = 128):
+        """
+        Args:
+            max_tokens: the token budget, defaults to the budget of the model
+            model: the model name used to look up the default budget
+            token_counter: the name of a registered token counter or a callable
+            llm: the llm used by the default summarizer
+            summarize: compact older turns into a summary in the background
+            summarizer: a custom callable mapping messages to their summary
+            max_observation_tokens: the size an observation is elided to
+            keep_recent_messages: the number of recent messages that are never dropped
+            max_summaries: the number of summaries kept in cache
+        """
+        self.max_tokens = max_tokens or get_context_budget(model)
+        if callable(token_counter):
+            self.count_tokens = token_counter
+        else:
+            self.count_tokens = get_token_counter(token_counter)
+        if summarizer is None and summarize and llm is not None:
+            summarizer = self._build_llm_summarizer(llm)
+        self.summarizer = summarizer
+        self.max_observation_tokens = max_observation_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.max_summaries = max_summaries
+
+        self._summaries: OrderedDict = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def count_messages(self, messages: List[Dict]) -> int:
+        return sum(
+            self.count_tokens(msg.get('content') or '') for msg in messages)
+
+    def truncate_text(self, text: str, max_tokens: int) -> str:
+        """
+        Keep the head and the tail of a text and elide its middle
+        """
+        num_tokens = self.count_tokens(text)
+        if num_tokens <= max_tokens:
+            return text
+        keep_chars = max(int(len(text) * max_tokens / num_tokens), 0)
+        head = text[:keep_chars // 2]
+        tail = text[len(text) - (keep_chars - keep_chars // 2):]
+        return head + ELIDED_TEMPLATE.format(
+            num=num_tokens - max_tokens) + tail
+
+    def truncate_observation(self, observation: str) -> str:
+        return self.truncate_text(observation, self.max_observation_tokens)
+
+    def fit(self,
+            messages: List[Dict],
+            reserved_tokens: int = 0) -> List[Dict]:
+        """
+        Fit the messages into the token budget.
+
+        Args:
+            messages: the messages, such as [{'role': 'system', 'content': '...'}, ...]
+            reserved_tokens: the tokens consumed outside the messages, such as a prompt template
+
+        Returns:
+            The messages itself when it fits, otherwise a compacted copy
+        """
+        budget = self.max_tokens - reserved_tokens
+        total = self.count_messages(messages)
+        if total <= budget or not messages:
+            return messages
+
+        messages = [dict(msg) for msg in messages]
+
+        # 1. elide observations, oldest first
+        for idx in self._droppable_indices(messages, keep_recent=0):
+            if total <= budget:
+                return messages
+            total -= self._elide_observation(messages[idx])
+        if total <= budget:
+            return messages
+
+        # 2. replace the turns before the latest user turn with their summary
+        if self.summarizer is not None:
+            last_user = self._last_user_index(messages)
+            older = [
+                i for i in self._droppable_indices(messages) if i < last_user
+            ]
+            if older:
+                start = 1 if messages[0].get('role') == 'system' else 0
+                summarized = self._get_summary(messages[start:older[-1] + 1])
+                if summarized is not None:
+                    num_turns, summary = summarized
+                    summary_messages = [{
+                        'role': role,
+                        'content': template.format(summary=summary)
+                    } for role, template in SUMMARY_TEMPLATE.items()]
+                    messages = messages[:start] + summary_messages + messages[
+                        start + num_turns:]
+                    total = self.count_messages(messages)
+                    if total <= budget:
+                        return messages
+
+        # 3. drop the oldest turns, a previous turn is dropped as a whole
+        last_user = self._last_user_index(messages)
+        droppable = self._droppable_indices(messages)
+        drop = set()
+        for idx in droppable:
+            if total <= budget:
+                break
+            if idx in drop:
+                continue
+            group = [idx]
+            if idx < last_user and messages[idx].get('role') == 'user':
+                nxt = idx + 1
+                while nxt < last_user and messages[nxt].get(
+                        'role') != 'user' and nxt in droppable:
+                    group.append(nxt)
+                    nxt += 1
+            for i in group:
+                drop.add(i)
+                total -= self.count_tokens(messages[i].get('content') or '')
+        if total > budget:
+            logger.warning(
+                f'The context still exceeds the budget after compaction: {total} > {budget}'
+            )
+        return [msg for i, msg in enumerate(messages) if i not in drop]
+
+    def fit_prompt(self, prompt: str, reserved_tokens: int = 0) -> str:
+        """
+        Fit a raw prompt into the token budget by eliding its inline observations,
+        oldest first, the latest observation is kept whole.
+
+        Args:
+            prompt: the raw prompt with observations in <result></result>
+            reserved_tokens: the tokens consumed outside the prompt
+
+        Returns:
+            The prompt itself when it fits, otherwise the elided prompt
+        """
+        budget = self.max_tokens - reserved_tokens
+        total = self.count_tokens(prompt)
+        if total <= budget:
+            return prompt
+        matches = list(INLINE_OBSERVATION_PATTERN.finditer(prompt))[:-1]
+        if not matches:
+            return prompt
+        parts = []
+        end = 0
+        for match in matches:
+            observation = match.group(2)
+            if total > budget:
+                elided = self.truncate_observation(observation)
+                total -= self.count_tokens(observation) - self.count_tokens(
+                    elided)
+                observation = elided
+            parts.append(prompt[end:match.start(2)] + observation)
+            end = match.end(2)
+        parts.append(prompt[end:])
+        return ''.join(parts)
+
+    @staticmethod
+    def _last_user_index(messages: List[Dict]) -> int:
+        for idx in range(len(messages) - 1, -1, -1):
+            if messages[idx].get('role') == 'user':
+                return idx
+        return len(messages)
+
+    def _droppable_indices(self,
+                           messages: List[Dict],
+                           keep_recent: Optional[int] = None) -> List[int]:
+        """
+        The indices of messages except the system prompt, the latest user turn and
+        the most recent messages, in order from oldest to newest
+        """
+        if keep_recent is None:
+            keep_recent = self.keep_recent_messages
+        protected = {self._last_user_index(messages)}
+        if messages[0].get('role') == 'system':
+            protected.add(0)
+        candidates = [i for i in range(len(messages)) if i not in protected]
+        return candidates[:max(len(candidates) - keep_recent, 0)]
+
+    def _elide_observation(self, message: Dict) -> int:
+        """
+        Elide the observations of a message in place and return the number of saved tokens
+        """
+        content = message.get('content') or ''
+        if not isinstance(content, str):
+            return 0
+        if message.get('role') in OBSERVATION_ROLES:
+            new_content = self.truncate_observation(content)
+        elif '<result>' in content:
+            new_content = INLINE_OBSERVATION_PATTERN.sub(
+                lambda m: m.group(1) + self.truncate_observation(m.group(2)) +
+                m.group(3), content)
+        else:
+            return 0
+        if new_content == content:
+            return 0
+        message['content'] = new_content
+        return self.count_tokens(content) - self.count_tokens(new_content)
+
+    def _get_summary(self, turns: List[Dict]) -> Optional[Tuple[int, str]]:
+        """
+        Get the summary of the longest summarized prefix of turns, and schedule the
+        summary of all turns in the background if it is not ready yet.
+
+        Returns:
+            The number of turns covered by the summary and the summary itself
+        """
+        # the prefix keys are rolling hashes, so a summary generated in an earlier
+        # run is still found after new turns are appended
+        md5 = hashlib.md5()
+        keys = []
+        for idx, msg in enumerate(turns):
+            md5.update(
+                f'{msg.get("role")}:{msg.get("content")}\n'.encode('utf-8'))
+            # only cut the turns at the boundary of a user turn
+            if idx == len(turns) - 1 or turns[idx + 1].get('role') == 'user':
+                keys.append((idx + 1, md5.hexdigest()))
+
+        num_turns, key = keys[-1]
+        if key not in self._summaries and key not in self._pending:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='context_compaction')
+            future = self._executor.submit(self.summarizer, turns)
+            self._pending[key] = future
+            future.add_done_callback(
+                lambda f, key=key: self._on_summary_done(key, f))
+
+        for num_turns, key in reversed(keys):
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return num_turns, self._summaries[key]
+        return None
+
+    def _on_summary_done(self, key: str, future: Future):
+        self._pending.pop(key, None)
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.warning(f'Failed to summarize the history: {e}')
+            return
+        if summary:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+
+    @staticmethod
+    def _build_llm_summarizer(llm) -> Callable[[List[Dict]], str]:
+
+        def summarizer(turns: List[Dict]) -> str:
+            history = '\n'.join(f'{msg.get("role")}: {msg.get("content")}'
+                                for msg in turns)
+            result = llm.chat(
+                prompt=SUMMARY_PROMPT_TEMPLATE.format(history=history),
+                messages=[{
+                    'role':
+                    'user',
+                    'content':
+                    SUMMARY_PROMPT_TEMPLATE.format(history=history)
+                }],
+                stream=False)
+            return result if isinstance(result, str) else ''.join(result)
+
+        return summarizer
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,172 @@
+import atexit
+import threading
+from typing import Callable, List, Optional, Union
+
+from Agent.utils.logger import agent_logger as logger
+from Agent.utils.tokenization_utils import get_token_counter
+
+from .context_manager import INLINE_OBSERVATION_PATTERN
+
+MEMORY_TEMPLATE = {
+    'zh': '以下是与当前问题可能相关的历史记忆：\n{memories}\n\n',
+    'en': 'The following memories may be relevant to the request:\n{memories}\n\n',
+}
+
+TURN_TEMPLATE = 'user: {user}\nassistant: {assistant}'
+
+OBSERVATION_TEMPLATE = 'tool {name} was called with {args} and returned: {result}'
+
+
+class LongTermMemory:
+    """
+    The long-term memory of a user in a VectorStorage index.
+
+    Completed turns and tool observations are embedded incrementally with add() of
+    the index in batches, and the most relevant ones are recalled into the prompt under
+    a token budget, so the prompt does not grow with the whole transcript.
+    """
+
+    def __init__(self,
+                 storage_path: str,
+                 index_name: str = 'memory',
+                 max_tokens: int = 1000,
+                 top_k: int = 5,
+                 max_memory_tokens: int = 256,
+                 batch_size: int = 8,
+                 save_every: int = 4,
+                 token_counter: Optional[Union[str, Callable[[str],
+                                                             int]]] = None,
+                 storage: Optional[object] = None,
+                 **kwargs):
+        """
+        Args:
+            storage_path: the directory of the index
+            index_name: the name of the index, one index per user
+            max_tokens: the token budget of the recalled memories in the prompt
+            top_k: the number of memories searched for a request
+            max_memory_tokens: a longer memory is truncated before embedded
+            batch_size: the number of memories embedded together
+            save_every: the index is saved to disk once per this number of batches
+            token_counter: a registered token counter name or a callable
+            storage: the VectorStorage, built from storage_path and kwargs by default
+            kwargs: the other config of the VectorStorage, such as embedding
+        """
+        if storage is None:
+            from Agent.storage.vector_storage import VectorStorage
+            storage = VectorStorage(
+                storage_path=storage_path, index_name=index_name, **kwargs)
+        self.storage = storage
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.max_memory_tokens = max_memory_tokens
+        self.batch_size = batch_size
+        self.save_every = save_every
+        if callable(token_counter):
+            self.count_tokens = token_counter
+        else:
+            self.count_tokens = get_token_counter(token_counter)
+
+        self._pending: List[str] = []
+        self._seen = set()
+        self._unsaved_batches = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def add(self, texts: List[str]):
+        """
+        Queue memories, which are embedded once a batch is full
+        """
+        with self._lock:
+            for text in texts:
+                text = self._truncate(text.strip())
+                # the same fact repeated in a session is stored once
+                if text and text not in self._seen:
+                    self._seen.add(text)
+                    self._pending.append(text)
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def add_turn(self, user_request: str, response: str):
+        # the observations in the response are remembered by add_observation
+        response = INLINE_OBSERVATION_PATTERN.sub(r'\1\3', response)
+        self.add([TURN_TEMPLATE.format(user=user_request, assistant=response)])
+
+    def add_observation(self, tool_name: str, tool_args: str, result: str):
+        self.add([
+            OBSERVATION_TEMPLATE.format(
+                name=tool_name, args=tool_args, result=result)
+        ])
+
+    def recall(self, query: str, max_tokens: Optional[int] = None) -> List[str]:
+        """
+        Search the memories relevant to the query, most relevant first, within the
+        token budget
+        """
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        with self._lock:
+            if self._pending:
+                self._flush()
+            try:
+                results = self.storage.search(query, top_k=self.top_k)
+            except Exception as e:
+                logger.warning(f'Failed to recall the memory: {e}')
+                return []
+
+        memories = []
+        tokens = 0
+        for memory in results:
+            tokens += self.count_tokens(memory)
+            if tokens > max_tokens:
+                break
+            memories.append(memory)
+        return memories
+
+    def build_prompt(self, query: str, lang: str = 'en') -> str:
+        """
+        The recalled memories formatted to prefix the user request, empty if none
+        """
+        memories = self.recall(query)
+        if not memories:
+            return ''
+        return MEMORY_TEMPLATE.get(lang, MEMORY_TEMPLATE['en']).format(
+            memories='\n'.join(f'- {memory}' for memory in memories))
+
+    def close(self):
+        """
+        Write the pending memories, the memory is not used after it is closed
+        """
+        # so a closed memory is not kept alive until exit
+        atexit.unregister(self.close)
+        with self._lock:
+            if self._pending:
+                self._flush()
+            if self._unsaved_batches:
+                self._save()
+
+    def _truncate(self, text: str) -> str:
+        if self.count_tokens(text) <= self.max_memory_tokens:
+            return text
+        # cut by the average chars per token of the text
+        ratio = self.max_memory_tokens / self.count_tokens(text)
+        return text[:int(len(text) * ratio)] + '...'
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        try:
+            if self.storage.vs is None:
+                self.storage.construct(pending)
+            else:
+                self.storage.add(pending)
+        except Exception as e:
+            logger.warning(f'Failed to add {len(pending)} memories: {e}')
+            return
+        self._unsaved_batches += 1
+        if self._unsaved_batches >= self.save_every:
+            self._save()
+
+    def _save(self):
+        try:
+            self.storage.save()
+            self._unsaved_batches = 0
+        except Exception as e:
+            logger.warning(f'Failed to save the memory: {e}')
@@ -0,0 +1,209 @@
+import atexit
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+from Agent.utils.logger import agent_logger as logger
+
+
+class ResponseCache:
+    """
+    A semantic cache of the final responses of the agents in a VectorStorage index.
+
+    The requests are embedded as unit vectors, so a near-duplicate request, such as a
+    paraphrase, finds the response of an earlier one when the cosine similarity is over
+    the threshold. The entries are scoped, such as by the agent, its tools and the
+    language, and expire after the ttl. A sample of the hits is answered by a full run
+    anyway, to measure how often a hit gives another answer than the run would.
+    """
+
+    def __init__(self,
+                 storage_path: str,
+                 index_name: str = 'response_cache',
+                 threshold: float = 0.92,
+                 ttl: Optional[float] = 24 * 3600,
+                 sample_rate: float = 0.0,
+                 top_k: int = 4,
+                 save_every: int = 8,
+                 storage: Optional[object] = None,
+                 **kwargs):
+        """
+        Args:
+            storage_path: the directory of the index
+            index_name: the name of the index
+            threshold: the least cosine similarity of the requests of a hit
+            ttl: the seconds an entry is served, None for no expiry
+            sample_rate: the fraction of the hits which are checked by a full run
+            top_k: the number of entries searched for a request
+            save_every: the index is saved to disk once per this number of entries
+            storage: the VectorStorage, built from storage_path and kwargs by default
+            kwargs: the other config of the VectorStorage, such as embedding_cfg
+        """
+        if storage is None:
+            from Agent.storage.vector_storage import VectorStorage
+            storage = VectorStorage(
+                storage_path=storage_path, index_name=index_name, **kwargs)
+        self.storage = storage
+        self.threshold = threshold
+        self.ttl = ttl
+        self.sample_rate = sample_rate
+        self.top_k = top_k
+        self.save_every = save_every
+        self.stats = {
+            'lookups': 0,
+            'hits': 0,
+            'expired': 0,
+            'added': 0,
+            'sampled': 0,
+            'false_positives': 0,
+        }
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def lookup(self, request: str, scope: str) -> Optional[Dict]:
+        """
+        Find the response of the most similar earlier request in the scope
+
+        Returns:
+            the hit as {'id', 'request', 'response', 'similarity', 'sampled'}, None if
+            no entry is similar enough, a sampled hit should be checked by a full run
+            with check_sample
+        """
+        embedding = self._embed(request)
+        with self._lock:
+            self.stats['lookups'] += 1
+            try:
+                results = self.storage.search_by_vector(
+                    embedding, top_k=self.top_k, filter={'scope': scope})
+            except Exception as e:
+                logger.warning(f'Failed to search the response cache: {e}')
+                return None
+            expired = []
+            hit = None
+            for doc, distance in results:
+                # the squared distance of unit vectors is 2 - 2 * cosine
+                similarity = 1 - distance / 2
+                if similarity < self.threshold:
+                    break
+                if self.ttl is not None and time.time(
+                ) - doc.metadata['created_at'] > self.ttl:
+                    expired.append(doc.metadata['id'])
+                    continue
+                hit = {
+                    'id': doc.metadata['id'],
+                    'request': doc.page_content,
+                    'response': doc.metadata['response'],
+                    'similarity': similarity,
+                    'sampled': random.random() < self.sample_rate,
+                }
+                break
+            if expired:
+                self.stats['expired'] += len(expired)
+                self.storage.delete(expired)
+                self._unsaved += 1
+            if hit is None:
+                return None
+            self.stats['hits'] += 1
+            if hit['sampled']:
+                self.stats['sampled'] += 1
+        logger.info(f'Response cache hit ({hit["similarity"]:.3f}): {request} '
+                    f'-> {hit["request"]}')
+        return hit
+
+    def add(self, request: str, response: str, scope: str):
+        embedding = self._embed(request)
+        with self._lock:
+            entry_id = uuid.uuid4().hex
+            try:
+                self.storage.add_embeddings([(request, embedding)],
+                                            metadatas=[{
+                                                'id': entry_id,
+                                                'scope': scope,
+                                                'response': response,
+                                                'created_at': time.time(),
+                                            }],
+                                            ids=[entry_id])
+            except Exception as e:
+                logger.warning(f'Failed to add to the response cache: {e}')
+                return
+            self.stats['added'] += 1
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self._save()
+
+    def check_sample(self, hit: Dict, request: str, response: str) -> bool:
+        """
+        Compare the response of a full run with the cached one of a sampled hit, the
+        hit is a false positive when their responses are not similar
+
+        Returns:
+            whether the hit is right
+        """
+        cached, fresh = self.storage.embedding.embed_documents(
+            [hit['response'], response])
+        similarity = float(np.dot(_normalize(cached), _normalize(fresh)))
+        right = similarity >= self.threshold
+        if not right:
+            with self._lock:
+                self.stats['false_positives'] += 1
+            logger.warning(
+                f'Response cache false positive ({similarity:.3f}): {request} '
+                f'-> {hit["request"]}')
+        return right
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['hit_rate'] = stats['hits'] / max(1, stats['lookups'])
+        stats['false_positive_rate'] = stats['false_positives'] / max(
+            1, stats['sampled'])
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._unsaved:
+                self._save()
+
+    def _embed(self, text: str) -> List[float]:
+        return _normalize(self.storage.embedding.embed_query(text)).tolist()
+
+    def _save(self):
+        try:
+            self.storage.save()
+            self._unsaved = 0
+        except Exception as e:
+            logger.warning(f'Failed to save the response cache: {e}')
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype='float32')
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+_RESPONSE_CACHES: Dict[str, ResponseCache] = {}
+_RESPONSE_CACHES_LOCK = threading.Lock()
+
+
+def get_response_cache(storage_path: str, **kwargs) -> ResponseCache:
+    """
+    Get the response cache shared by all agents with the same config in this process
+    """
+    key = json.dumps({
+        'storage_path': os.path.abspath(storage_path),
+        **kwargs
+    },
+                     sort_keys=True,
+                     default=str)
+    with _RESPONSE_CACHES_LOCK:
+        cache = _RESPONSE_CACHES.get(key)
+        if cache is None:
+            cache = ResponseCache(storage_path, **kwargs)
+            _RESPONSE_CACHES[key] = cache
+        return cache
@@ -0,0 +1,215 @@
+import math
+from typing import Dict, Optional
+
+ANN_INDEX_TYPES = ('flat', 'ivf', 'hnsw')
+
+# sq8 keeps an int8 code per dimension, pq a few bits per group of dimensions
+QUANTIZER_TYPES = ('sq8', 'pq')
+
+# the keys of vs_params which configure the faiss index instead of the vector store
+INDEX_PARAM_KEYS = ('index_type', 'metric', 'nlist', 'nprobe', 'hnsw_m',
+                    'ef_construction', 'ef_search', 'quantizer', 'pq_m',
+                    'pq_nbits', 'rerank', 'mmap')
+
+# the index params which choose how a process loads the index, not saved with it
+LOAD_PARAM_KEYS = ('mmap', )
+
+# the query-time knobs and their names in faiss.ParameterSpace
+SEARCH_PARAM_NAMES = {
+    'nprobe': 'nprobe',
+    'ef_search': 'efSearch',
+    'rerank': 'k_factor_rf'
+}
+
+# faiss warns when an ivf index is trained with fewer points per list
+MIN_POINTS_PER_LIST = 39
+
+
+def split_index_params(vs_params: Dict):
+    """
+    Split vs_params into the params of the faiss index and the rest, which are
+    passed to the vector store
+
+    Returns:
+        index_params, store_params
+    """
+    index_params = {
+        key: value
+        for key, value in vs_params.items() if key in INDEX_PARAM_KEYS
+    }
+    store_params = {
+        key: value
+        for key, value in vs_params.items() if key not in INDEX_PARAM_KEYS
+    }
+    return index_params, store_params
+
+
+def default_nlist(num_vectors: int) -> int:
+    """
+    The number of ivf lists, about 4 * sqrt(n) and enough points to train each list
+    """
+    nlist = int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // MIN_POINTS_PER_LIST))
+
+
+def is_custom_index(index_params: Dict) -> bool:
+    """
+    Whether the index params ask for another index than the flat one of the vector store
+    """
+    return (index_params.get('index_type', 'flat') != 'flat'
+            or bool(index_params.get('quantizer'))
+            or bool(index_params.get('rerank')))
+
+
+def default_pq_m(dim: int) -> int:
+    """
+    The number of pq sub-vectors, a byte for every 4 dimensions, which is 16x smaller
+    than float32
+    """
+    pq_m = max(1, dim // 4)
+    while dim % pq_m:
+        pq_m -= 1
+    return pq_m
+
+
+def default_pq_nbits(num_vectors: int) -> int:
+    """
+    The bits per pq code, 8 unless there are too few vectors to train 256 centroids
+    """
+    return max(1, min(8, int(math.log2(max(2, num_vectors // MIN_POINTS_PER_LIST)))))
+
+
+def faiss_factory_string(dim: int,
+                         num_vectors: int,
+                         index_type: str = 'flat',
+                         nlist: Optional[int] = None,
+                         hnsw_m: int = 32,
+                         quantizer: Optional[str] = None,
+                         pq_m: Optional[int] = None,
+                         pq_nbits: Optional[int] = None,
+                         rerank: int = 0,
+                         **kwargs) -> str:
+    """
+    The description of the index for faiss.index_factory, such as 'IVF256,PQ192x8,RFlat'
+    """
+    if index_type not in ANN_INDEX_TYPES:
+        raise ValueError(f'Unknown index type: {index_type}, '
+                         f'should be one of {ANN_INDEX_TYPES}')
+    if quantizer and quantizer not in QUANTIZER_TYPES:
+        raise ValueError(f'Unknown quantizer: {quantizer}, '
+                         f'should be one of {QUANTIZER_TYPES}')
+
+    if quantizer == 'sq8':
+        codec = 'SQ8'
+    elif quantizer == 'pq':
+        codec = (f'PQ{pq_m or default_pq_m(dim)}'
+                 f'x{pq_nbits or default_pq_nbits(num_vectors)}')
+    else:
+        codec = 'Flat'
+
+    if index_type == 'ivf':
+        description = f'IVF{nlist or default_nlist(num_vectors)},{codec}'
+    elif index_type == 'hnsw':
+        description = f'HNSW{hnsw_m}' + ('' if codec == 'Flat' else f'_{codec}')
+    else:
+        description = codec
+    if rerank:
+        # the full vectors are kept to re-rank rerank * k candidates exactly
+        description += ',RFlat'
+    return description
+
+
+def build_faiss_index(vectors,
+                      index_type: str = 'flat',
+                      metric: str = 'l2',
+                      nlist: Optional[int] = None,
+                      nprobe: int = 8,
+                      hnsw_m: int = 32,
+                      ef_construction: int = 64,
+                      ef_search: int = 64,
+                      quantizer: Optional[str] = None,
+                      pq_m: Optional[int] = None,
+                      pq_nbits: Optional[int] = None,
+                      rerank: int = 0,
+                      **kwargs):
+    """
+    Build an empty faiss index for the vectors, trained if the index type or the
+    quantizer needs it
+
+    Args:
+        vectors: the float32 array of shape (n, d) to train on
+        index_type: flat for the exact search, ivf for the inverted lists, or hnsw for the graph
+        metric: l2 or ip (inner product)
+        nlist: the number of inverted lists of ivf, derived from n by default
+        nprobe: the number of lists searched by ivf per query
+        hnsw_m: the number of neighbors per node of hnsw
+        ef_construction: the search depth of hnsw when building
+        ef_search: the search depth of hnsw per query
+        quantizer: None to store float32 vectors, sq8 or pq to store compressed codes
+        pq_m: the number of pq sub-vectors, dim // 4 by default
+        pq_nbits: the bits per pq code, 8 by default
+        rerank: re-rank rerank * k candidates with the full vectors, 0 for no re-rank
+
+    Returns:
+        the faiss index
+    """
+    import faiss
+
+    num_vectors, dim = vectors.shape
+    metric_type = faiss.METRIC_INNER_PRODUCT if metric == 'ip' else faiss.METRIC_L2
+    description = faiss_factory_string(
+        dim,
+        num_vectors,
+        index_type=index_type,
+        nlist=nlist,
+        hnsw_m=hnsw_m,
+        quantizer=quantizer,
+        pq_m=pq_m,
+        pq_nbits=pq_nbits,
+        rerank=rerank)
+    index = faiss.index_factory(dim, description, metric_type)
+
+    base_index = faiss.downcast_index(index.base_index) if rerank else index
+    if hasattr(base_index, 'hnsw'):
+        base_index.hnsw.efConstruction = ef_construction
+    if not index.is_trained:
+        index.train(vectors)
+
+    set_search_params(
+        index, nprobe=nprobe, ef_search=ef_search, rerank=rerank or None)
+    return index
+
+
+def read_faiss_index(index_file: str, mmap: bool = False):
+    """
+    Read a faiss index, with mmap the vectors stay in the page cache and are shared by
+    the processes reading the same file, an ivf index read with mmap can not be added to
+    """
+    import faiss
+
+    if mmap:
+        return faiss.read_index(index_file, faiss.IO_FLAG_MMAP)
+    return faiss.read_index(index_file)
+
+
+def set_search_params(index, **params) -> Dict:
+    """
+    Set the query-time knobs, such as nprobe and ef_search, which apply to the index
+
+    Returns:
+        the knobs set
+    """
+    import faiss
+
+    applied = {}
+    space = faiss.ParameterSpace()
+    for key, value in params.items():
+        if value is None or key not in SEARCH_PARAM_NAMES:
+            continue
+        try:
+            space.set_index_parameter(index, SEARCH_PARAM_NAMES[key], value)
+            applied[key] = value
+        except RuntimeError:
+            # the knob does not apply to this index type
+            pass
+    return applied
@@ -0,0 +1,255 @@
+import array
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from .base import BaseStorage
+
+ARTIFACT_PREFIX = 'artifact://'
+
+ARTIFACT_TEMPLATE = {
+    'zh': '{preview}\n(完整结果已保存为 {handle}，后续调用工具时可直接将 "{handle}" 作为参数值传入)',
+    'en': '{preview}\n(The full result is saved as {handle}, pass "{handle}" as an argument value to use it in later tool calls)',
+}
+
+
+def _to_typed_array(value) -> Optional[array.array]:
+    """
+    Convert a list of ints or floats to a compact array, whose buffer can be shared
+    without copy, return None for other values
+    """
+    if isinstance(value, array.array):
+        return value
+    if isinstance(value, memoryview):
+        return array.array(value.format, value)
+    if not isinstance(value, (list, tuple)) or not value:
+        return None
+    first = type(value[0])
+    if first is int:
+        typecode = 'q'
+    elif first is float:
+        typecode = 'd'
+    else:
+        return None
+    if any(type(x) is not first for x in value):
+        return None
+    try:
+        return array.array(typecode, value)
+    except OverflowError:
+        return None
+
+
+class ArtifactStorage(BaseStorage):
+    """
+    The per-session storage of large tool inputs and results. A stored value is
+    referred by a short handle, such as artifact://3f2a9c0d1b7e, so that the value
+    does not need to be pasted into the prompt and copied back by llm.
+
+    Numeric lists are stored as compact arrays. When the memory budget is exceeded,
+    the least recently used artifacts are spilled to disk, and spilled arrays are
+    memory-mapped back as zero-copy buffers.
+    """
+
+    def __init__(self,
+                 storage_path: Optional[str] = None,
+                 max_memory_bytes: int = 64 * 1024 * 1024,
+                 inline_max_chars: int = 2048,
+                 inline_max_items: int = 64,
+                 preview_items: int = 8,
+                 **kwargs):
+        """
+        Args:
+            storage_path: the directory to spill artifacts to, a temporary directory by default
+            max_memory_bytes: the bytes of artifacts kept in memory
+            inline_max_chars: results with more chars are stored as artifacts
+            inline_max_items: sequences with more items are stored as artifacts
+            preview_items: the number of items shown in the preview
+        """
+        self.storage_path = storage_path
+        self.max_memory_bytes = max_memory_bytes
+        self.inline_max_chars = inline_max_chars
+        self.inline_max_items = inline_max_items
+        self.preview_items = preview_items
+
+        self._artifacts: OrderedDict = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._tmp_dir = None
+        # the spilled files and the temporary directory are removed when the storage
+        # is cleared or collected, or at exit, the handles do not outlive the process
+        self._spilled_paths = set()
+        self._tmp_dirs = []
+        weakref.finalize(self, _remove_spilled, self._spilled_paths,
+                         self._tmp_dirs)
+
+    def __contains__(self, handle: str) -> bool:
+        return handle in self._artifacts
+
+    def __len__(self) -> int:
+        return len(self._artifacts)
+
+    def add(self, value: Any) -> str:
+        """
+        Store a value and return its handle
+        """
+        handle = f'{ARTIFACT_PREFIX}{uuid.uuid4().hex[:12]}'
+        typed = _to_typed_array(value)
+        if typed is not None:
+            entry = {'value': typed, 'nbytes': typed.itemsize * len(typed)}
+        else:
+            entry = {'value': value, 'nbytes': self._estimate_nbytes(value)}
+        with self._lock:
+            self._artifacts[handle] = entry
+            self._memory_bytes += entry['nbytes']
+            self._spill()
+        return handle
+
+    def search(self, handle: str, default: Any = None) -> Any:
+        """
+        Get the value of a handle
+        """
+        with self._lock:
+            entry = self._artifacts.get(handle.strip())
+            if entry is None:
+                return default
+            self._artifacts.move_to_end(handle.strip())
+            if 'value' in entry:
+                return entry['value']
+            return self._load(entry)
+
+    get = search
+
+    def is_handle(self, value: Any) -> bool:
+        return isinstance(value, str) and value.strip() in self._artifacts
+
+    def resolve(self, args: Any) -> Any:
+        """
+        Replace the handles in the parsed arguments of a tool call with their values
+        """
+        if isinstance(args, str):
+            return self.search(args) if self.is_handle(args) else args
+        if isinstance(args, dict):
+            return {key: self.resolve(value) for key, value in args.items()}
+        if isinstance(args, list):
+            return [self.resolve(value) for value in args]
+        return args
+
+    def wrap(self, result: Any, lang: str = 'en') -> Any:
+        """
+        Store a large tool result and return its handle with a short preview instead,
+        small results are returned as they are
+        """
+        if isinstance(result, (list, tuple, array.array, memoryview)):
+            if len(result) <= self.inline_max_items:
+                return result
+        elif isinstance(result, str):
+            if len(result) <= self.inline_max_chars:
+                return result
+        else:
+            return result
+        handle = self.add(result)
+        return ARTIFACT_TEMPLATE.get(lang, ARTIFACT_TEMPLATE['en']).format(
+            preview=self.preview(result), handle=handle)
+
+    def preview(self, value: Any) -> str:
+        if isinstance(value, str):
+            head = value[:self.inline_max_chars // 4]
+            return f'{head} ...({len(value)} chars)'
+        half = max(self.preview_items // 2, 1)
+        items = [repr(x) for x in value[:half]] + ['...'] + [
+            repr(x) for x in value[len(value) - half:]
+        ]
+        return f'[{", ".join(items)}] ({len(value)} items)'
+
+    def clear(self):
+        with self._lock:
+            for entry in self._artifacts.values():
+                self._close(entry)
+            self._artifacts.clear()
+            self._memory_bytes = 0
+            _remove_spilled(self._spilled_paths, self._tmp_dirs)
+            self._tmp_dir = None
+
+    @staticmethod
+    def _estimate_nbytes(value: Any) -> int:
+        if isinstance(value, (str, bytes)):
+            return len(value)
+        if isinstance(value, (list, tuple)):
+            # the size of the pointers and the small objects they point to
+            return 40 * len(value)
+        return 64
+
+    def _spill_dir(self) -> str:
+        if self.storage_path:
+            os.makedirs(self.storage_path, exist_ok=True)
+            return self.storage_path
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='artifacts_')
+            self._tmp_dirs.append(self._tmp_dir)
+        return self._tmp_dir
+
+    def _spill(self):
+        """
+        Spill the least recently used artifacts to disk until the memory budget fits
+        """
+        for handle, entry in self._artifacts.items():
+            if self._memory_bytes <= self.max_memory_bytes:
+                break
+            if 'value' not in entry:
+                continue
+            value = entry.pop('value')
+            path = os.path.join(self._spill_dir(),
+                                handle[len(ARTIFACT_PREFIX):])
+            with open(path, 'wb') as f:
+                if isinstance(value, array.array):
+                    value.tofile(f)
+                    entry['typecode'] = value.typecode
+                else:
+                    pickle.dump(value, f)
+            entry['path'] = path
+            self._spilled_paths.add(path)
+            self._memory_bytes -= entry['nbytes']
+
+    def _load(self, entry: Dict) -> Any:
+        if 'typecode' in entry:
+            if 'buffer' not in entry:
+                with open(entry['path'], 'rb') as f:
+                    mapped = mmap.mmap(
+                        f.fileno(), 0, access=mmap.ACCESS_READ)
+                entry['mmap'] = mapped
+                entry['buffer'] = memoryview(mapped).cast(entry['typecode'])
+            return entry['buffer']
+        with open(entry['path'], 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def _close(entry: Dict):
+        if 'buffer' in entry:
+            try:
+                entry.pop('buffer').release()
+                entry.pop('mmap').close()
+            except BufferError:
+                # the buffer is still referred by a tool, it is closed when collected
+                pass
+        if 'path' in entry and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+
+def _remove_spilled(paths: set, tmp_dirs: list):
+    """
+    Remove the spilled files and the temporary directories of an ArtifactStorage
+    """
+    for path in list(paths):
+        if os.path.exists(path):
+            os.remove(path)
+    paths.clear()
+    for tmp_dir in tmp_dirs:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dirs.clear()
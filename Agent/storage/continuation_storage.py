@@ -0,0 +1,88 @@
+import os
+import threading
+from typing import Dict, Optional
+
+import json
+
+from .base import BaseStorage
+
+
+class ContinuationStorage(BaseStorage):
+    """
+    The storage of suspended sessions. A continuation is the json state an agent needs
+    to resume a run, such as the messages and the pending action, so a session waiting
+    for the user costs only its stored state instead of a thread and a connection.
+
+    Continuations are kept as json files under storage_path, or as json strings in
+    memory when storage_path is not given.
+    """
+
+    def __init__(self, storage_path: Optional[str] = None, **kwargs):
+        self.storage_path = storage_path
+        self._continuations: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        if self.storage_path:
+            return os.path.exists(self._path(key))
+        return key in self._continuations
+
+    def add(self, key: str, continuation: Dict) -> str:
+        """
+        Store a continuation, replacing the former one of the same key
+
+        Returns:
+            the key
+        """
+        data = json.dumps(continuation, ensure_ascii=False)
+        if not self.storage_path:
+            with self._lock:
+                self._continuations[key] = data
+            return key
+
+        os.makedirs(self.storage_path, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        # a reader never sees a partially written continuation
+        os.replace(tmp_path, path)
+        return key
+
+    def search(self, key: str) -> Optional[Dict]:
+        """
+        Get the continuation of a key, or None if there is no suspended session
+        """
+        if not self.storage_path:
+            data = self._continuations.get(key)
+            return None if data is None else json.loads(data)
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def pop(self, key: str) -> Optional[Dict]:
+        """
+        Get and remove the continuation of a key, so a session is resumed only once
+        """
+        if not self.storage_path:
+            with self._lock:
+                data = self._continuations.pop(key, None)
+            return None if data is None else json.loads(data)
+        path = self._path(key)
+        claimed = f'{path}.{os.getpid()}.{threading.get_ident()}.claimed'
+        try:
+            # the rename is atomic, only one of the concurrent resumes gets the file
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(claimed, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        finally:
+            os.remove(claimed)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.storage_path,
+                            key.replace(os.sep, '_') + '.json')
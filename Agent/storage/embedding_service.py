@@ -0,0 +1,270 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import json
+from langchain_core.embeddings import Embeddings
+
+from Agent.utils.logger import agent_logger as logger
+
+DEFAULT_EMBEDDING_MODEL = 'damo/nlp_gte_sentence-embedding_chinese-base'
+
+
+class _Request:
+    __slots__ = ('texts', 'future', 'created')
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future = Future()
+        self.created = time.monotonic()
+
+
+class EmbeddingService(Embeddings):
+    """
+    An embedding model shared by all VectorStorage users of a process.
+
+    The concurrent requests are collected by one worker thread into micro-batches, which
+    wait at most max_wait for more texts. The identical texts of a batch are embedded
+    once and recent vectors are kept in an LRU cache. The model is loaded on first use,
+    or by warmup(), and is only called from the worker thread.
+    Queries are embedded with embed_documents of the model, which suits the symmetric
+    models such as GTE.
+    """
+
+    def __init__(self,
+                 model: Optional[Embeddings] = None,
+                 model_id: str = DEFAULT_EMBEDDING_MODEL,
+                 max_batch_size: int = 32,
+                 max_wait: float = 0.005,
+                 cache_size: int = 4096,
+                 latency_window: int = 1024,
+                 **kwargs):
+        """
+        Args:
+            model: the embedding model, a ModelScopeEmbeddings of model_id by default
+            model_id: the modelscope model loaded when model is not given
+            max_batch_size: the maximum number of texts embedded in one call
+            max_wait: the seconds a batch waits for more requests
+            cache_size: the number of vectors kept, 0 to disable the cache
+            latency_window: the number of recent requests the latency stats cover
+        """
+        self.model = model
+        self.model_id = model_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+
+        self._model_lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'texts': 0,
+            'cache_hits': 0,
+            'deduplicated': 0,
+            'embedded': 0,
+            'batches': 0,
+            'model_seconds': 0.0,
+        }
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # a long list is split, so that the requests of others are not held up
+        futures = [
+            self._submit(texts[i:i + self.max_batch_size])
+            for i in range(0, len(texts), self.max_batch_size)
+        ]
+        vectors = []
+        for future in futures:
+            vectors.extend(future.result())
+        return vectors
+
+    def warmup(self) -> Embeddings:
+        """
+        Load the model now, such as before the worker processes are forked
+        """
+        return self._get_model()
+
+    def get_stats(self) -> Dict:
+        """
+        The counters of the service, with the batch size, the throughput of the model
+        and the latency percentiles of the recent requests in seconds
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['mean_batch_size'] = stats['embedded'] / max(1, stats['batches'])
+        stats['texts_per_second'] = stats['embedded'] / max(
+            1e-9, stats['model_seconds'])
+        latencies = sorted(self._latencies) or [0.0]
+        for quantile in (50, 95, 99):
+            index = min(len(latencies) - 1, len(latencies) * quantile // 100)
+            stats[f'p{quantile}'] = latencies[index]
+        return stats
+
+    def close(self):
+        if not self._closed and self._pid == os.getpid():
+            self._queue.put(None)
+        self._closed = True
+
+    def _get_model(self) -> Embeddings:
+        with self._model_lock:
+            if self.model is None:
+                from langchain_community.embeddings import \
+                    ModelScopeEmbeddings
+                self.model = ModelScopeEmbeddings(model_id=self.model_id)
+            return self.model
+
+    def _submit(self, texts: List[str]) -> Future:
+        self._count(requests=1, texts=len(texts))
+        cached = self._get_cached(texts)
+        if len(cached) == len(texts):
+            self._count(cache_hits=len(texts))
+            future = Future()
+            future.set_result([list(cached[text]) for text in texts])
+            self._latencies.append(0.0)
+            return future
+
+        request = _Request(texts)
+        self._ensure_worker()
+        self._queue.put(request)
+        return request.future
+
+    def _ensure_worker(self):
+        # the thread does not survive a fork, a forked process starts its own
+        if self._pid == os.getpid() and not self._closed:
+            return
+        with self._model_lock:
+            if self._pid != os.getpid() or self._closed:
+                self._queue = queue.Queue()
+                self._worker = threading.Thread(
+                    target=self._work_loop,
+                    name='embedding_service',
+                    daemon=True)
+                self._worker.start()
+                self._pid = os.getpid()
+                self._closed = False
+
+    def _work_loop(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            num_texts = len(request.texts)
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while num_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                num_texts += len(request.texts)
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _run_batch(self, batch: List[_Request]):
+        texts = [text for request in batch for text in request.texts]
+        vectors = self._get_cached(texts)
+        num_missing = sum(1 for text in texts if text not in vectors)
+        missing = list(
+            dict.fromkeys(text for text in texts if text not in vectors))
+        self._count(
+            cache_hits=len(texts) - num_missing,
+            deduplicated=num_missing - len(missing))
+
+        if missing:
+            start = time.monotonic()
+            try:
+                embedded = self._get_model().embed_documents(missing)
+            except Exception as e:
+                logger.error(f'Embedding {len(missing)} texts failed: {e}')
+                for request in batch:
+                    request.future.set_exception(e)
+                return
+            self._count(
+                model_seconds=time.monotonic() - start,
+                embedded=len(missing),
+                batches=1)
+            vectors.update(zip(missing, embedded))
+            self._put_cached(zip(missing, embedded))
+
+        now = time.monotonic()
+        for request in batch:
+            self._latencies.append(now - request.created)
+            request.future.set_result(
+                [list(vectors[text]) for text in request.texts])
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, delta in deltas.items():
+                self._stats[key] += delta
+
+    def _get_cached(self, texts: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not self.cache_size:
+            return found
+        with self._cache_lock:
+            for text in texts:
+                if text in self._cache:
+                    self._cache.move_to_end(text)
+                    found[text] = self._cache[text]
+        return found
+
+    def _put_cached(self, items):
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            for text, vector in items:
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+_EMBEDDING_SERVICES: Dict[str, EmbeddingService] = {}
+_EMBEDDING_SERVICES_LOCK = threading.Lock()
+
+
+def get_embedding_service(model_id: str = DEFAULT_EMBEDDING_MODEL,
+                          **kwargs) -> EmbeddingService:
+    """
+    Get the embedding service shared by all users of the same model and config in this
+    process, so that the model is loaded once and their requests are batched together
+    """
+    key = json.dumps({'model_id': model_id, **kwargs}, sort_keys=True)
+    with _EMBEDDING_SERVICES_LOCK:
+        service = _EMBEDDING_SERVICES.get(key)
+        if service is None:
+            service = EmbeddingService(model_id=model_id, **kwargs)
+            _EMBEDDING_SERVICES[key] = service
+        return service
+
+
+def warmup_embedding_services():
+    """
+    Load the models of the embedding services created so far
+    """
+    with _EMBEDDING_SERVICES_LOCK:
+        services = list(_EMBEDDING_SERVICES.values())
+    for service in services:
+        service.warmup()
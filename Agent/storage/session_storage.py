@@ -0,0 +1,212 @@
+import atexit
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import json
+
+from .base import BaseStorage
+
+
+class SessionStorage(BaseStorage):
+    """
+    The persistent history of sessions keyed by uuid_str, in a SQLite database.
+
+    Turns are appended in the background with write-behind batching, and a run loads
+    only the tail of the history it needs, so a request costs the I/O of its new turns
+    instead of the whole conversation. The database is in WAL mode, so worker processes
+    can serve different sessions on the same file concurrently.
+    """
+
+    def __init__(self,
+                 storage_path: str,
+                 flush_interval: float = 1.0,
+                 max_batch: int = 64,
+                 page_size: int = 32,
+                 **kwargs):
+        """
+        Args:
+            storage_path: the path of the SQLite database
+            flush_interval: the seconds turns wait in memory before written
+            max_batch: the number of pending turns which triggers a write at once
+            page_size: the number of turns read at a time when loading a tail
+        """
+        self.storage_path = storage_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.page_size = page_size
+
+        dirname = os.path.dirname(os.path.abspath(storage_path))
+        os.makedirs(dirname, exist_ok=True)
+        self._connect()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS turns ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'session_id TEXT NOT NULL, message TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS turns_session '
+                           'ON turns (session_id, id)')
+        self._conn.commit()
+
+        self._pending: List[Tuple[str, Dict]] = []
+        self._closed = False
+        self._start_writer()
+        atexit.register(self.close)
+
+    def add(self, session_id: str, messages: List[Dict]):
+        """
+        Append the new turns of a session, they are written in the background
+        """
+        with self._lock:
+            self._pending.extend((session_id, message) for message in messages)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def search(self,
+               session_id: str,
+               max_turns: Optional[int] = None,
+               max_tokens: Optional[int] = None,
+               token_counter: Optional[Callable[[str], int]] = None
+               ) -> List[Dict]:
+        """
+        Load the tail of the history of a session, in the order of time
+
+        Args:
+            session_id: the uuid_str of the session
+            max_turns: the maximum number of messages to load
+            max_tokens: stop loading older messages once they exceed this budget
+            token_counter: counts the tokens of a message content, required by max_tokens
+
+        Returns:
+            the messages
+        """
+        with self._lock:
+            pending = [
+                message for sid, message in self._pending if sid == session_id
+            ]
+            tail = []
+            tokens = 0
+            # the pending turns are the newest, then the database is read backwards by page
+            rows = reversed(pending)
+            last_id = None
+            while True:
+                for message in rows:
+                    if max_turns is not None and len(tail) >= max_turns:
+                        return tail[::-1]
+                    if max_tokens is not None:
+                        tokens += token_counter(message.get('content') or '')
+                        if tokens > max_tokens and tail:
+                            return tail[::-1]
+                    tail.append(message)
+                page = self._read_page(session_id, last_id)
+                if not page:
+                    return tail[::-1]
+                last_id = page[-1][0]
+                rows = [json.loads(message) for _, message in page]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._pending = [(sid, message) for sid, message in self._pending
+                             if sid != session_id]
+            self._conn.execute('DELETE FROM turns WHERE session_id = ?',
+                               (session_id, ))
+            self._conn.commit()
+
+    def flush(self):
+        """
+        Write the pending turns now
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            self._conn.executemany(
+                'INSERT INTO turns (session_id, message) VALUES (?, ?)',
+                [(sid, json.dumps(message, ensure_ascii=False))
+                 for sid, message in pending])
+            self._conn.commit()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        self._conn.close()
+
+    def _connect(self):
+        self._conn = sqlite3.connect(
+            self.storage_path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+    def _start_writer(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = threading.Thread(
+            target=self._write_loop, name='session_writer', daemon=True)
+        self._writer.start()
+
+    def _reopen_after_fork(self):
+        """
+        A forked process can not use the connection and the writer of its parent, it
+        opens its own, and the pending turns are left to the parent to write
+        """
+        if self._closed:
+            return
+        self._pending = []
+        # closing the inherited connection could checkpoint the database of the
+        # parent, it is kept open and unused
+        self._inherited_conn = self._conn
+        self._connect()
+        self._start_writer()
+
+    def _read_page(self, session_id: str,
+                   before_id: Optional[int]) -> List[Tuple[int, str]]:
+        if before_id is None:
+            cursor = self._conn.execute(
+                'SELECT id, message FROM turns WHERE session_id = ? '
+                'ORDER BY id DESC LIMIT ?', (session_id, self.page_size))
+        else:
+            cursor = self._conn.execute(
+                'SELECT id, message FROM turns WHERE session_id = ? AND id < ? '
+                'ORDER BY id DESC LIMIT ?',
+                (session_id, before_id, self.page_size))
+        return cursor.fetchall()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_SESSION_STORAGES: Dict[str, SessionStorage] = {}
+_SESSION_STORAGES_LOCK = threading.Lock()
+
+
+def _reopen_session_storages():
+    global _SESSION_STORAGES_LOCK
+    _SESSION_STORAGES_LOCK = threading.Lock()
+    for storage in _SESSION_STORAGES.values():
+        storage._reopen_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reopen_session_storages)
+
+
+def get_session_storage(storage_path: str, **kwargs) -> SessionStorage:
+    """
+    Get the storage shared by all agents on the same database in this process, so
+    that they share one connection and one background writer
+    """
+    storage_path = os.path.abspath(storage_path)
+    with _SESSION_STORAGES_LOCK:
+        storage = _SESSION_STORAGES.get(storage_path)
+        if storage is None or storage._closed:
+            storage = SessionStorage(storage_path, **kwargs)
+            _SESSION_STORAGES[storage_path] = storage
+        return storage
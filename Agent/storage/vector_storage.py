@@ -1,12 +1,16 @@
 import os
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+import json
 from langchain.schema import Document
-from langchain_community.embeddings import ModelScopeEmbeddings
 from langchain_community.vectorstores import FAISS, VectorStore
 from langchain_core.embeddings import Embeddings
 
+from .ann_index import (LOAD_PARAM_KEYS, build_faiss_index, is_custom_index,
+                        read_faiss_index, set_search_params,
+                        split_index_params)
 from .base import BaseStorage
+from .embedding_service import get_embedding_service
 
 
 class VectorStorage(BaseStorage):
@@ -19,15 +23,23 @@ class VectorStorage(BaseStorage):
                  vs_params: Dict = {},
                  index_ext: str = '.faiss',
                  use_cache: bool = True,
+                 embedding_cfg: Optional[Dict] = None,
                  **kwargs):
         # index name used for storage
         self.storage_path = storage_path
         self.index_name = index_name
-        self.embedding = embedding or ModelScopeEmbeddings(
-            model_id='damo/nlp_gte_sentence-embedding_chinese-base')
+        # the embedding model is shared by the storages with the same embedding_cfg,
+        # such as {'model_id': ..., 'max_batch_size': 32, 'max_wait': 0.005}
+        self.embedding = embedding or get_embedding_service(
+            **(embedding_cfg or {}))
         self.vs_cls = vs_cls
-        self.vs_params = vs_params
+        # the index params, such as {'index_type': 'hnsw', 'ef_search': 128} or
+        # {'quantizer': 'pq', 'rerank': 4, 'mmap': True}, choose the faiss index and
+        # how it is loaded, and the rest are passed to the vector store
+        self.index_params, self.vs_params = split_index_params(vs_params)
         self.index_ext = index_ext
+        # the index loaded with mmap, which is read only until it is reopened
+        self._mmap_index = None
         if use_cache:
             self.vs = self.load()
         else:
@@ -35,28 +47,104 @@ class VectorStorage(BaseStorage):
 
     def construct(self, docs):
         assert len(docs) > 0
-        if isinstance(docs[0], str):
+        if is_custom_index(self.index_params):
+            self.vs = self._construct_ann(docs)
+        elif isinstance(docs[0], str):
             self.vs = self.vs_cls.from_texts(docs, self.embedding,
                                              **self.vs_params)
         elif isinstance(docs[0], Document):
             self.vs = self.vs_cls.from_documents(docs, self.embedding,
                                                  **self.vs_params)
 
+    def _construct_ann(self, docs) -> VectorStore:
+        """
+        Build an approximate or quantized index chosen by the index params, the index
+        is trained on the embeddings of the docs
+        """
+        import numpy as np
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+
+        if isinstance(docs[0], Document):
+            texts = [doc.page_content for doc in docs]
+            metadatas = [doc.metadata for doc in docs]
+        else:
+            texts, metadatas = docs, None
+        embeddings = self.embedding.embed_documents(texts)
+        index = build_faiss_index(
+            np.asarray(embeddings, dtype='float32'), **self.index_params)
+        vs = FAISS(self.embedding, index, InMemoryDocstore(), {},
+                   **self._get_store_params())
+        vs.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas)
+        return vs
+
+    def _get_store_params(self) -> Dict:
+        from langchain_community.vectorstores.utils import DistanceStrategy
+
+        store_params = dict(self.vs_params)
+        if self.index_params.get('metric') == 'ip':
+            store_params.setdefault('distance_strategy',
+                                    DistanceStrategy.MAX_INNER_PRODUCT)
+        return store_params
+
     def search(self, query: str, top_k=5) -> List[str]:
         if self.vs is None:
             return []
         res = self.vs.similarity_search(query, k=top_k)
-        if 'page' in res[0].metadata:
+        if res and 'page' in res[0].metadata:
             res.sort(key=lambda doc: doc.metadata['page'])
         return [r.page_content for r in res]
 
     def add(self, docs: Union[List[str], List[Document]]):
         assert len(docs) > 0
+        self._reopen_writable()
         if isinstance(docs[0], str):
             self.vs.add_texts(docs, **self.vs_params)
         elif isinstance(docs[0], Document):
             self.vs.add_documents(docs, **self.vs_params)
 
+    def add_embeddings(self,
+                       text_embeddings: List[Tuple[str, List[float]]],
+                       metadatas: Optional[List[Dict]] = None,
+                       ids: Optional[List[str]] = None):
+        """
+        Add the texts with the embeddings computed by the caller, the store is built
+        on the first call
+        """
+        assert len(text_embeddings) > 0
+        if self.vs is None:
+            self.vs = self.vs_cls.from_embeddings(
+                text_embeddings,
+                self.embedding,
+                metadatas=metadatas,
+                ids=ids,
+                **self.vs_params)
+        else:
+            self._reopen_writable()
+            self.vs.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+
+    def search_by_vector(self,
+                         embedding: List[float],
+                         top_k: int = 5,
+                         **kwargs) -> List[Tuple[Document, float]]:
+        """
+        Search with an embedding computed by the caller
+
+        Returns:
+            the documents and their distances, nearest first
+        """
+        if self.vs is None:
+            return []
+        return self.vs.similarity_search_with_score_by_vector(
+            embedding, k=top_k, **kwargs)
+
+    def delete(self, ids: List[str]):
+        if self.vs is not None and ids:
+            self._reopen_writable()
+            self.vs.delete(ids)
+
+    def _get_params_file(self) -> str:
+        return os.path.join(self.storage_path, f'{self.index_name}.json')
+
     def _get_index_and_store_name(self, index_ext='.faiss', pkl_ext='.pkl'):
         index_file = os.path.join(self.storage_path,
                                   f'{self.index_name}{index_ext}')
@@ -73,12 +161,78 @@ class VectorStorage(BaseStorage):
         if not (os.path.exists(index_file) and os.path.exists(store_file)):
             return None
 
-        return self.vs_cls.load_local(self.storage_path, self.embedding,
-                                      self.index_name)
+        self._load_index_params()
+        if self.index_params.get('mmap') and self.vs_cls is FAISS:
+            vs = self._load_mmap(index_file, store_file)
+        elif self.index_params.get('metric') == 'ip':
+            vs = self.vs_cls.load_local(
+                self.storage_path,
+                self.embedding,
+                self.index_name,
+                distance_strategy=self._get_store_params()['distance_strategy'])
+        else:
+            vs = self.vs_cls.load_local(self.storage_path, self.embedding,
+                                        self.index_name)
+        if self.index_params and hasattr(vs, 'index'):
+            set_search_params(vs.index, **self.index_params)
+        return vs
+
+    def _load_mmap(self, index_file: str, store_file: str) -> VectorStore:
+        """
+        Load the index with mmap, so the workers reading the same index share its pages
+        """
+        import pickle
+
+        index = read_faiss_index(index_file, mmap=True)
+        self._mmap_index = index
+        with open(store_file, 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(self.embedding, index, docstore, index_to_docstore_id,
+                     **self._get_store_params())
+
+    def _reopen_writable(self):
+        """
+        Read the index loaded with mmap into memory before it is modified, the
+        inverted lists of an ivf index read with mmap can not be modified
+        """
+        if self._mmap_index is None or self.vs.index is not self._mmap_index:
+            return
+        index_file, _ = self._get_index_and_store_name(
+            index_ext=self.index_ext)
+        self.vs.index = read_faiss_index(index_file)
+        if self.index_params:
+            set_search_params(self.vs.index, **self.index_params)
+        self._mmap_index = None
 
     def save(self):
         if self.vs:
+            # the file mapped by the index is not written over while it is mapped
+            self._reopen_writable()
             self.vs.save_local(self.storage_path, self.index_name)
+            saved_params = {
+                key: value
+                for key, value in self.index_params.items()
+                if key not in LOAD_PARAM_KEYS
+            }
+            if saved_params:
+                # the index type and the query-time knobs are kept with the index
+                with open(self._get_params_file(), 'w') as f:
+                    json.dump(saved_params, f)
+
+    def _load_index_params(self):
+        """
+        Read the index params saved with the index, overridden by those given in
+        vs_params
+        """
+        params_file = self._get_params_file()
+        saved_params = {}
+        if os.path.exists(params_file):
+            with open(params_file, 'r') as f:
+                saved_params = json.load(f)
+        # mmap saved by the former versions is up to the loading process
+        for key in LOAD_PARAM_KEYS:
+            saved_params.pop(key, None)
+        self.index_params = {**saved_params, **self.index_params}
 
 
 if __name__ == '__main__':
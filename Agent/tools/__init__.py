@@ -1,9 +1,10 @@
+from .arg_validator import ToolArgumentError
 from .base import TOOL_REGISTRY, BaseTool, register_tool
 
 from .algorithm_tools.binary_search import BinarySearchTool
 from .algorithm_tools.quick_sort import QuickSortTool
 
-from .ask_human_for_help import AskHumanForHelpTool
+from .ask_human_for_help import AskHumanForHelpTool, HumanInputRequired
 
 from .finishing_failure import FinishingFailureTool
 from .finishing_success import FinishingSuccessTool
@@ -19,4 +20,7 @@ from .dashscope_tools.image_generator import TextToImageTool
 #         raise NotImplementedError
 
 
-__all__ = ['BaseTool', 'TOOL_REGISTRY', 'register_tool']
+__all__ = [
+    'BaseTool', 'TOOL_REGISTRY', 'register_tool', 'ToolArgumentError',
+    'HumanInputRequired'
+]
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import json
+
+from .arg_validator import parse_json_args
+
+REPEAT_HINT = {
+    'zh': '（该工具已经用相同的参数调用过，以上是之前的结果。请不要重复调用，根据已有的结果继续。）',
+    'en': '(The tool was already called with the same arguments, the result above is '
+    'from that call. Do not call it again, go on with the results you have.)',
+}
+
+CONCLUDE_HINT = {
+    'zh': '（请不要再调用工具，根据以上的结果直接给出最终答案。）',
+    'en': '(Do not call any more tools, give the final answer from the results above.)',
+}
+
+
+class ActionTracker:
+    """
+    The recent tool calls of one run, keyed by the tool and its canonical arguments.
+
+    A call repeated with the same arguments is answered with the earlier observation
+    and a hint instead of running the tool again, and once the llm repeats itself
+    max_repeats times the run should conclude. The state is a json dict, so it is kept
+    with a suspended run.
+    """
+
+    def __init__(self, max_repeats: int = 2, window: int = 16, **kwargs):
+        """
+        Args:
+            max_repeats: the number of repeated calls after which the run should conclude
+            window: the number of recent distinct calls remembered
+        """
+        self.max_repeats = max_repeats
+        self.window = window
+        self.repeats = 0
+        # the call waiting for the answer of the user
+        self.pending: Optional[str] = None
+        self._observations: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def fingerprint(tool_name: str, tool_args) -> str:
+        try:
+            args = parse_json_args(tool_args)
+        except ValueError:
+            args = tool_args.strip() if isinstance(tool_args,
+                                                   str) else tool_args
+        return json.dumps([tool_name, args],
+                          ensure_ascii=False,
+                          sort_keys=True,
+                          default=str)
+
+    @property
+    def should_conclude(self) -> bool:
+        return self.max_repeats is not None and self.repeats >= self.max_repeats
+
+    def lookup(self, tool_name: str, tool_args) -> Optional[str]:
+        """
+        The observation of the same call made before, which counts as a repeat
+
+        Returns:
+            the earlier observation, or None if the call is new
+        """
+        key = self.fingerprint(tool_name, tool_args)
+        if key not in self._observations:
+            return None
+        self._observations.move_to_end(key)
+        self.repeats += 1
+        return self._observations[key]
+
+    def start(self, tool_name: str, tool_args):
+        self.pending = self.fingerprint(tool_name, tool_args)
+
+    def record(self, tool_name: str, tool_args, observation):
+        self._put(self.fingerprint(tool_name, tool_args), observation)
+        self.pending = None
+
+    def record_answer(self, answer: str):
+        """
+        Record the answer of the user as the observation of the pending call
+        """
+        if self.pending is not None:
+            self._put(self.pending, answer)
+            self.pending = None
+
+    def format_repeat(self, observation: str, lang: str = 'en') -> str:
+        hints = CONCLUDE_HINT if self.should_conclude else REPEAT_HINT
+        return f'{observation}\n{hints.get(lang, hints["en"])}'
+
+    def state_dict(self) -> Dict:
+        return {
+            'repeats': self.repeats,
+            'pending': self.pending,
+            'observations': list(self._observations.items())
+        }
+
+    def load_state_dict(self, state: Optional[Dict]):
+        if not state:
+            return
+        self.repeats = state['repeats']
+        self.pending = state['pending']
+        self._observations = OrderedDict(
+            (key, observation) for key, observation in state['observations'])
+
+    def _put(self, key: str, observation):
+        self._observations[key] = str(observation)
+        self._observations.move_to_end(key)
+        while len(self._observations) > self.window:
+            self._observations.popitem(last=False)
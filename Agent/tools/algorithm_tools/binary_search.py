@@ -1,5 +1,29 @@
+import array
+import bisect
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import json
+from Agent.tools.arg_validator import TYPE_COERCERS, ToolArgumentError
 from Agent.tools.base import BaseTool, register_tool
-import json5
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SEARCH_MODES = ['leftmost', 'rightmost', 'count', 'range']
+
+# numpy is only worth the conversion for a batch of targets
+NUMPY_MIN_TARGETS = 16
+
+# the number of validated arrays cached by one tool instance
+SORTED_CACHE_SIZE = 8
+
+# the flat array value of the top level key arr in the raw json arguments, a quote
+# in json can only start or end a string, so the key is never matched in a string
+RAW_ARR_PATTERN = re.compile(r'[{,]\s*"arr"\s*:\s*(\[[^\[\]]*\])')
 
 
 def binary_search(arr, target):
@@ -18,10 +42,51 @@ def binary_search(arr, target):
 
     return -1
 
+
+def search_sorted(arr: Sequence,
+                  targets: Sequence,
+                  mode: str = 'leftmost',
+                  np_arr=None) -> List:
+    """
+    Search many targets in a sorted array
+
+    Args:
+        arr: the sorted array
+        targets: the targets to search
+        mode: leftmost and rightmost return the index of the first and the last match
+            or -1, count returns the number of matches, range returns [first, last] or [-1, -1]
+        np_arr: arr as a numpy array, which vectorizes the search when given
+
+    Returns:
+        the result of each target
+    """
+    if np_arr is not None:
+        np_targets = np.asarray(targets)
+        lefts = np.searchsorted(np_arr, np_targets, side='left').tolist()
+        rights = np.searchsorted(np_arr, np_targets, side='right').tolist()
+    else:
+        lefts = [bisect.bisect_left(arr, target) for target in targets]
+        rights = [bisect.bisect_right(arr, target) for target in targets]
+
+    results = []
+    for left, right in zip(lefts, rights):
+        found = left < right
+        if mode == 'count':
+            results.append(right - left)
+        elif mode == 'range':
+            results.append([left, right - 1] if found else [-1, -1])
+        elif mode == 'rightmost':
+            results.append(right - 1 if found else -1)
+        else:
+            results.append(left if found else -1)
+    return results
+
+
 @register_tool('binary_search')
 class BinarySearchTool(BaseTool):
     name = 'binary_search'
-    description = '二分查找工具，输入一个有序数组和目标值，返回目标值在数组中的索引。若不存在则返回-1。'
+    description = ('二分查找工具，输入一个有序数组和目标值，返回目标值在数组中的索引。若不存在则返回-1。'
+                   '有多个目标值时请通过targets一次性查找，不要多次调用。')
     parameters = [{
         'name': 'arr',
         'description': '有序数组',
@@ -30,16 +95,154 @@ class BinarySearchTool(BaseTool):
     }, {
         'name': 'target',
         'description': '待查找的目标值',
-        'required': True,
+        'required': False,
         'type': 'number'
+    }, {
+        'name': 'targets',
+        'description': '批量查找的多个目标值，返回每个目标值的结果',
+        'required': False,
+        'type': 'array'
+    }, {
+        'name': 'mode',
+        'description':
+        '查找方式，默认leftmost。leftmost/rightmost返回第一个/最后一个匹配的索引，count返回匹配的个数，range返回匹配的索引范围[起始, 结束]',
+        'required': False,
+        'type': 'string',
+        'enum': SEARCH_MODES
     }]
 
-    def call(self, params: str, **kwargs) -> int:
-        params = self._verify_args(params)
-        if isinstance(params, str):
-            return "Parameter Error"
-        
-        arr = json5.loads(params['arr'])
-        target = json5.loads(params['target'])
+    def __init__(self, cfg: Optional[Dict] = {}):
+        super().__init__(cfg)
+        # the validated arrays keyed by their raw json, by their items, or by the object
+        # resolved from an artifact, so repeated lookups against the same array skip
+        # its parsing and validation. The tool instance belongs to the agent, so the
+        # cache is shared by all the sessions of the agent, which is safe since an
+        # array is only found by its own content.
+        self._sorted_cache = OrderedDict()
+
+    def call(self, params: Union[str, Dict], **kwargs) -> str:
+        args, key = self._parse_without_arr(params)
+        entry = self._get_cached(key)
+        if entry is None:
+            args = self._verify_args(params)
+            if isinstance(args, ToolArgumentError):
+                return f'Parameter Error: {args}'
+            if key is None:
+                key = _array_key(args['arr'])
+            try:
+                entry = _validate_sorted(args['arr'])
+            except ValueError as e:
+                return f'Parameter Error: {e}'
+            if key is not None:
+                self._sorted_cache[key] = entry
+                while len(self._sorted_cache) > SORTED_CACHE_SIZE:
+                    self._sorted_cache.popitem(last=False)
+
+        mode = args.get('mode') or 'leftmost'
+        if 'targets' in args:
+            name, targets = 'targets', list(args['targets'])
+        elif 'target' in args:
+            name, targets = 'target', [args['target']]
+        else:
+            return 'Parameter Error: missing argument `target` or `targets`'
+        try:
+            targets = _convert_targets(targets, entry['kind'])
+        except ValueError as e:
+            return f'Parameter Error: invalid argument `{name}`: {e}'
+
+        np_arr = None
+        if len(targets) >= NUMPY_MIN_TARGETS and entry['kind'] == 'number':
+            if entry['np_arr'] is None and np is not None:
+                entry['np_arr'] = np.asarray(entry['arr'])
+            np_arr = entry['np_arr']
+
+        results = search_sorted(entry['arr'], targets, mode, np_arr)
+        if name == 'target':
+            return json.dumps(results[0])
+        return json.dumps({
+            json.dumps(target): result
+            for target, result in zip(targets, results)
+        })
+
+    def _parse_without_arr(self, params: Union[str, Dict]) -> Tuple:
+        """
+        Parse the raw json arguments with the value of arr cut out, so only the targets
+        and the mode are parsed when the array is cached
+
+        Returns:
+            the arguments without arr and the key of the raw arr, or None, None when
+            arr can not be cut out, such as for the relaxed json of json5
+        """
+        if not isinstance(params, str):
+            return None, None
+        match = RAW_ARR_PATTERN.search(params)
+        if match is None:
+            return None, None
+        args = self._verify_args(params[:match.start(1)] + '[]'
+                                 + params[match.end(1):])
+        # the value cut out is not the one of arr, such as with duplicated keys
+        if isinstance(args, ToolArgumentError) or args.get('arr') != []:
+            return None, None
+        return args, ('raw', match.group(1))
+
+    def _get_cached(self, key) -> Optional[Dict]:
+        if key is None:
+            return None
+        entry = self._sorted_cache.get(key)
+        if entry is not None:
+            self._sorted_cache.move_to_end(key)
+        return entry
+
+
+def _array_key(arr: Sequence) -> Optional[Tuple]:
+    if isinstance(arr, (array.array, memoryview)):
+        # the buffers resolved from the same artifact are the same object, which is
+        # kept alive by the cache, so its id is not reused
+        return ('artifact', id(arr))
+    key = ('items', tuple(arr))
+    try:
+        hash(key)
+    except TypeError:
+        # the items are not numbers or strings, which is reported by the validation
+        return None
+    return key
+    
+
+def _validate_sorted(arr: Sequence) -> Dict:
+    """
+    Validate that arr is an array of numbers or of strings sorted in ascending order
+
+    Returns:
+        the entry of the cache, whose kind is the type of the items, None when empty
+    """
+    if isinstance(arr, (array.array, memoryview)):
+        kind = 'number'
+    elif not arr:
+        kind = None
+    elif all(isinstance(x, str) for x in arr):
+        kind = 'string'
+    elif all(
+            isinstance(x, (int, float)) and not isinstance(x, bool)
+            for x in arr):
+        kind = 'number'
+    else:
+        raise ValueError('arr should be an array of numbers or strings')
+    if not all(arr[i] <= arr[i + 1] for i in range(len(arr) - 1)):
+        raise ValueError('arr should be sorted in ascending order')
+    return {'arr': arr, 'kind': kind, 'np_arr': None}
+
+
+def _convert_string(value):
+    if not isinstance(value, str):
+        raise ValueError('expected a string like the items of arr')
+    return value
+
 
-        return str(binary_search(arr, target))
+def _convert_targets(targets: List, kind: Optional[str]) -> List:
+    """
+    Convert the targets to the type of the items of arr, so they are comparable
+    """
+    if kind is None:
+        return targets
+    convert = TYPE_COERCERS['number'] if kind == 'number' else _convert_string
+    return [convert(target) for target in targets]
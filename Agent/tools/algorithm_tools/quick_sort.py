@@ -1,5 +1,5 @@
+from Agent.tools.arg_validator import ToolArgumentError
 from Agent.tools.base import BaseTool, register_tool
-import json5
 
 
 def quick_sort(arr) -> list[int]:
@@ -22,9 +22,10 @@ class QuickSortTool(BaseTool):
         'type': 'array'
     }]
 
-    def call(self, params: str, **kwargs) -> str:
+    def call(self, params: str, **kwargs) -> list:
         params = self._verify_args(params)
-        if isinstance(params, str):
-            return "Parameter Error"
+        if isinstance(params, ToolArgumentError):
+            return f'Parameter Error: {params}'
 
-        return str(quick_sort(json5.loads(params['arr'])))
+        # the list is returned as it is, so a large result can be kept as an artifact
+        return quick_sort(params['arr'])
@@ -0,0 +1,150 @@
+import array
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import json
+import json5
+
+
+class ToolArgumentError(ValueError):
+    """
+    The arguments of a tool call are invalid, errors holds one message per argument
+    """
+
+    def __init__(self, errors: List[str]):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def parse_json_args(params: Union[str, Dict]) -> Any:
+    """
+    Parse the arguments of a tool call, the stdlib json is tried first and json5 is
+    only used for the relaxed syntax llm may produce, such as single quotes
+    """
+    if not isinstance(params, str):
+        return params
+    try:
+        return json.loads(params)
+    except ValueError:
+        return json5.loads(params)
+
+
+def _coerce_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _coerce_number(value):
+    if isinstance(value, bool):
+        raise ValueError('expected a number')
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        for number_type in (int, float):
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+    raise ValueError('expected a number')
+
+
+def _coerce_integer(value):
+    value = _coerce_number(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError('expected an integer')
+        value = int(value)
+    return value
+
+
+def _coerce_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+        return value.strip().lower() == 'true'
+    raise ValueError('expected a boolean')
+
+
+def _coerce_container(expected_type: Union[type, Tuple[type, ...]],
+                      type_name: str):
+
+    def coerce(value):
+        # llm often quotes the array or object as a string
+        if isinstance(value, str):
+            value = parse_json_args(value)
+        if not isinstance(value, expected_type):
+            raise ValueError(f'expected an {type_name}')
+        return value
+
+    return coerce
+
+
+TYPE_COERCERS: Dict[str, Callable[[Any], Any]] = {
+    'string': _coerce_string,
+    'number': _coerce_number,
+    'integer': _coerce_integer,
+    'boolean': _coerce_boolean,
+    # arrays resolved from artifacts are compact buffers instead of lists
+    'array': _coerce_container((list, tuple, array.array, memoryview),
+                               'array'),
+    'object': _coerce_container(dict, 'object'),
+}
+
+
+class ArgumentValidator:
+    """
+    The parameters of a tool compiled into a validator, which parses, checks and
+    coerces the arguments of a tool call in one pass.
+    """
+
+    def __init__(self, parameters: List[Dict]):
+        self._fields: List[Tuple[str, bool, Callable, Tuple]] = []
+        for param in parameters:
+            param_type = param.get('type') or param.get('schema', {}).get(
+                'type')
+            coerce = TYPE_COERCERS.get(param_type, lambda value: value)
+            enum = tuple(param.get('enum') or ())
+            self._fields.append(
+                (param['name'], bool(param.get('required')), coerce, enum))
+
+    def validate(self, params: Union[str, Dict]) -> Dict:
+        """
+        Args:
+            params: the arguments of a tool call, in json string or dict
+
+        Returns:
+            the coerced arguments
+
+        Raises:
+            ToolArgumentError: when the arguments are invalid
+        """
+        try:
+            args = parse_json_args(params)
+        except ValueError as e:
+            raise ToolArgumentError([f'the arguments are not valid json: {e}'])
+        if not isinstance(args, dict):
+            raise ToolArgumentError(['the arguments should be a json object'])
+        if args is params:
+            # never modify the arguments of the caller
+            args = dict(args)
+
+        errors = []
+        for name, required, coerce, enum in self._fields:
+            if name not in args:
+                if required:
+                    errors.append(f'missing required argument `{name}`')
+                continue
+            try:
+                args[name] = coerce(args[name])
+            except ValueError as e:
+                errors.append(f'invalid argument `{name}`: {e}')
+                continue
+            if enum and args[name] not in enum:
+                errors.append(
+                    f'invalid argument `{name}`: should be one of {list(enum)}')
+        if errors:
+            raise ToolArgumentError(errors)
+        return args
@@ -1,9 +1,22 @@
+from .arg_validator import ToolArgumentError
 from .base import BaseTool, register_tool
 
 
+class HumanInputRequired(Exception):
+    """
+    Raised by a tool which needs an answer from the user. The agent suspends the
+    session instead of blocking, and resumes it when the answer arrives.
+    """
+
+    def __init__(self, question: str):
+        super().__init__(question)
+        self.question = question
+
+
 @register_tool('ask_human_for_help')
 class AskHumanForHelpTool(BaseTool):
     name = 'ask_human_for_help'
+    side_effects = True
     description = """用户求助工具，如果你对于要解决的任务有任何不清楚的地方，可以用这个工具向用户询问相关信息。
     例如：用户问你今天天气如何，但是你不知道该用户所在的地理位置，你可以使用这个工具向用户询问地理位置。"""
     parameters = [{
@@ -15,9 +28,11 @@ class AskHumanForHelpTool(BaseTool):
 
     def call(self, params: str, **kwargs) -> str:
         params = self._verify_args(params)
-        if isinstance(params, str):
-            return "Parameter Error"
-        
+        if isinstance(params, ToolArgumentError):
+            return f'Parameter Error: {params}'
+
         question = params['question']
-        human_answer = input(question + '\n')
-        return human_answer
+        if self.cfg.get('interactive', False):
+            # only for a local terminal, it blocks the agent until the user answers
+            return input(question + '\n')
+        raise HumanInputRequired(question)
@@ -2,11 +2,17 @@ from abc import ABC, abstractmethod
 from typing import Dict, List, Optional, Union
 
 import json
-import json5
-from Agent.utils.utils import has_chinese_chars
+from Agent.utils.utils import detect_lang
+
+from .arg_validator import ArgumentValidator, ToolArgumentError
 
 TOOL_REGISTRY = {}
 
+# the function dict, its text description and the argument validator only depend
+# on the tool class and the schema, so they are built once and shared by all instances
+_FUNCTION_CACHE = {}
+_VALIDATOR_CACHE = {}
+
 
 def register_tool(name):
 
@@ -21,6 +27,14 @@ class BaseTool(ABC):
     name: str
     description: str
     parameters: List[Dict]
+    # other names llm may use for the tool, used to correct hallucinated names
+    aliases: List[str] = []
+    # a call repeated with the same arguments may get a new result, such as polling,
+    # so it is not answered from the earlier call of the run
+    repeatable: bool = False
+    # the call changes something outside the run or depends on the user, such as a
+    # question to the user, so the response of the run is not cached
+    side_effects: bool = False
 
     def __init__(self, cfg: Optional[Dict] = {}):
         """
@@ -29,12 +43,42 @@ class BaseTool(ABC):
         self.cfg = cfg.get(self.name, {})
 
         self.schema = self.cfg.get('schema', 'oai')
+        # the function is rendered with the schema of the config, the schema set by
+        # the agent later only tells the format of its llm
+        self._function_schema = self.schema
 
-        # construct the function_call given specific format
-        self.function = self._build_function()
+    @property
+    def function(self) -> dict:
+        """
+        The function_call given specific format, built once per tool class and schema
+        """
+        return self._get_cached_function()[0]
 
-        # create the text description of the function which is used in prompt
-        self.function_plain_text = self._parser_function()
+    @property
+    def function_plain_text(self) -> str:
+        """
+        The text description of the function which is used in prompt
+        """
+        return self._get_cached_function()[1]
+
+    def _cache_key(self) -> tuple:
+        key = (type(self), )
+        if any(attr in self.__dict__
+               for attr in ('name', 'description', 'parameters')):
+            # the tool is customized per instance, so the content is part of the key
+            key += (self.name, self.description,
+                    json.dumps(self.parameters, sort_keys=True))
+        return key
+
+    def _get_cached_function(self):
+        schema = getattr(self, '_function_schema', self.schema)
+        key = self._cache_key() + (schema, )
+        cached = _FUNCTION_CACHE.get(key)
+        if cached is None:
+            function = self._build_function(schema)
+            cached = (function, self._parser_function(function))
+            _FUNCTION_CACHE[key] = cached
+        return cached
 
     @abstractmethod
     def call(self, params: str, **kwargs):
@@ -47,29 +91,38 @@ class BaseTool(ABC):
         """
         raise NotImplementedError
 
-    def _verify_args(self, params: str) -> Union[str, dict]:
+    def _get_validator(self) -> ArgumentValidator:
+        """
+        The validator compiled from parameters, built once per tool class
+        """
+        key = self._cache_key()
+        validator = _VALIDATOR_CACHE.get(key)
+        if validator is None:
+            validator = ArgumentValidator(self.parameters)
+            _VALIDATOR_CACHE[key] = validator
+        return validator
+
+    def _verify_args(self, params: str) -> Union[dict, ToolArgumentError]:
         """
         Verify the parameters of the function call
 
         :param params: the parameters of func_call
-        :return: the str params or the legal dict params
+        :return: the legal dict params with values coerced to their declared types,
+            or a ToolArgumentError describing what is wrong
         """
         try:
-            params_json = json5.loads(params)
-            for param in self.parameters:
-                if 'required' in param and param['required']:
-                    if param['name'] not in params_json:
-                        return params # params is a string means it's an error message
-            return params_json
-        except Exception:
-            return params
+            return self._get_validator().validate(params)
+        except ToolArgumentError as e:
+            return e
 
-    def _build_function(self):
+    def _build_function(self, schema: Optional[str] = None):
         """
         The dict format after applying the template to the function, such as oai format
 
         """
-        if self.schema == 'oai':
+        if schema is None:
+            schema = self.schema
+        if schema == 'oai':
             function = {
                 'name': self.name,
                 'description': self.description,
@@ -101,11 +154,12 @@ class BaseTool(ABC):
 
         return function
 
-    def _parser_function(self):
+    def _parser_function(self, function: Optional[dict] = None):
         """
         Text description of function
 
         """
+        function = function or self.function
         tool_desc_template = {
             'zh':
             '{name}: {name} API。{description} 输入参数: {parameters} Format the arguments as a JSON object.',
@@ -113,14 +167,11 @@ class BaseTool(ABC):
             '{name}: {name} API. {description} Parameters: {parameters} Format the arguments as a JSON object.'
         }
 
-        if has_chinese_chars(self.function['description']):
-            tool_desc = tool_desc_template['zh']
-        else:
-            tool_desc = tool_desc_template['en']
+        tool_desc = tool_desc_template[detect_lang(function['description'])]
 
         return tool_desc.format(
-            name=self.function['name'],
-            description=self.function['description'],
+            name=function['name'],
+            description=function['description'],
             parameters=json.dumps(
-                self.function['parameters'], ensure_ascii=False),
+                function['parameters'], ensure_ascii=False),
         )
@@ -1,14 +1,34 @@
-import os
+from concurrent.futures import TimeoutError
+from typing import Dict, Optional
 
-import dashscope
-from dashscope import ImageSynthesis
+from Agent.tools.arg_validator import ToolArgumentError
 from Agent.tools.base import BaseTool, register_tool
 
+from .image_synthesis import get_image_job_manager
+
+# the seconds a call waits for the image by default, so a fast or cached image is
+# returned at once while a slow one does not hold the run
+DEFAULT_WAIT_SECONDS = 3
+
+PENDING_TEMPLATE = {
+    'zh': '图片正在生成中（任务{job_id}），请稍后使用相同的参数再次调用本工具获取图片。',
+    'en': 'The image is being generated (job {job_id}), call this tool again with the same arguments later to get it.',
+}
+
+FAILED_TEMPLATE = {
+    'zh': '图片生成失败：{error}',
+    'en': 'Failed to generate the image: {error}',
+}
+
 
 @register_tool('image_gen')
 class TextToImageTool(BaseTool):
     description = 'AI绘画（图像生成）服务，输入文本描述和图像分辨率，返回根据文本信息绘制的图片URL。'
     name = 'image_gen'
+    # a pending image is fetched by calling again with the same arguments
+    repeatable = True
+    # the urls of the images expire, so the responses with them are not cached
+    side_effects = True
     parameters: list = [{
         'name': 'text',
         'description': '详细描述了希望生成的图像具有什么内容，例如人物、环境、动作等细节描述',
@@ -22,10 +42,28 @@ class TextToImageTool(BaseTool):
         'type': 'string'
     }]
 
+    def __init__(self, cfg: Optional[Dict] = {}):
+        """
+        The cfg of the tool supports:
+            wait_seconds: the seconds a call waits for the image, DEFAULT_WAIT_SECONDS
+                by default, 0 returns at once, a pending image is fetched by calling
+                the tool again with the same arguments
+            endpoint: the synthesis endpoint, dashscope or local
+            endpoint_cfg: the config of the endpoint, such as api_key
+            job_cfg: the config of the shared ImageJobManager, such as max_concurrency
+                and download_dir
+        """
+        super().__init__(cfg)
+        self.wait_seconds = self.cfg.get('wait_seconds', DEFAULT_WAIT_SECONDS)
+        self.job_manager = get_image_job_manager(
+            endpoint=self.cfg.get('endpoint'),
+            endpoint_cfg=self.cfg.get('endpoint_cfg'),
+            **self.cfg.get('job_cfg', {}))
+
     def call(self, params: str, **kwargs) -> str:
         params = self._verify_args(params)
-        if isinstance(params, str):
-            return 'Parameter Error'
+        if isinstance(params, ToolArgumentError):
+            return f'Parameter Error: {params}'
 
         if params['resolution'] in ['1024*1024', '720*1280', '1280*720']:
             resolution = params['resolution']
@@ -35,16 +73,24 @@ class TextToImageTool(BaseTool):
         prompt = params['text']
         if prompt is None:
             return None
+        lang = kwargs.get('lang', 'zh')
         seed = kwargs.get('seed', None)
         model = kwargs.get('model', 'wanx-v1')
-        dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
-
-        response = ImageSynthesis.call(
-            model=model,
-            prompt=prompt,
-            n=1,
-            size=resolution,
-            steps=10,
-            seed=seed)
-        image_url = response.output['results'][0]['url']
+
+        # a call with the same arguments joins the running job or hits the cache
+        job = self.job_manager.submit(
+            prompt=prompt, size=resolution, seed=seed, model=model)
+        wait_seconds = self.wait_seconds
+        cancel_token = kwargs.get('cancel_token')
+        if cancel_token is not None and cancel_token.remaining() is not None:
+            # the job goes on for a later call, only the wait is cut to the budget
+            wait_seconds = min(wait_seconds, cancel_token.remaining())
+        try:
+            image_url = job.result(timeout=wait_seconds)
+        except TimeoutError:
+            return PENDING_TEMPLATE.get(lang, PENDING_TEMPLATE['zh']).format(
+                job_id=job.job_id)
+        except Exception as e:
+            return FAILED_TEMPLATE.get(lang, FAILED_TEMPLATE['zh']).format(
+                error=e)
         return f'![IMAGEGEN]({image_url})'
@@ -0,0 +1,304 @@
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from html import escape
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+
+import json
+
+from Agent.utils.logger import agent_logger as logger
+
+IMAGE_SYNTHESIS_ENDPOINT = 'IMAGE_SYNTHESIS_ENDPOINT'
+
+TASK_SUCCEEDED = 'SUCCEEDED'
+TASK_FAILED = 'FAILED'
+TASK_RUNNING = 'RUNNING'
+
+IMAGE_ENDPOINT_REGISTRY = {}
+
+
+def register_image_endpoint(name):
+
+    def decorator(cls):
+        IMAGE_ENDPOINT_REGISTRY[name] = cls
+        return cls
+
+    return decorator
+
+
+class BaseImageEndpoint(ABC):
+    """
+    The asynchronous text-to-image endpoint, a task is submitted and then polled
+    """
+
+    @abstractmethod
+    def submit(self, model: str, prompt: str, size: str,
+               seed: Optional[int]) -> str:
+        """
+        Submit a task and return its task id
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def fetch(self, task_id: str) -> Tuple[str, Optional[str]]:
+        """
+        Fetch the status of a task
+
+        Returns:
+            the task status, and the image url when the task succeeded or the error
+            message when it failed
+        """
+        raise NotImplementedError
+
+
+@register_image_endpoint('dashscope')
+class DashScopeImageEndpoint(BaseImageEndpoint):
+
+    def __init__(self, api_key: Optional[str] = None, **kwargs):
+        # the key is sent per request instead of set globally on every call
+        self.api_key = (api_key
+                        or os.getenv('DASHSCOPE_API_KEY', default='')).strip()
+
+    def submit(self, model: str, prompt: str, size: str,
+               seed: Optional[int]) -> str:
+        from dashscope import ImageSynthesis
+        response = ImageSynthesis.async_call(
+            model=model,
+            prompt=prompt,
+            n=1,
+            size=size,
+            steps=10,
+            seed=seed,
+            api_key=self.api_key)
+        if response.status_code != HTTPStatus.OK:
+            raise RuntimeError('Error code: %s, error message: %s' %
+                               (response.code, response.message))
+        return response.output['task_id']
+
+    def fetch(self, task_id: str) -> Tuple[str, Optional[str]]:
+        from dashscope import ImageSynthesis
+        response = ImageSynthesis.fetch(task_id, api_key=self.api_key)
+        if response.status_code != HTTPStatus.OK:
+            return TASK_FAILED, 'Error code: %s, error message: %s' % (
+                response.code, response.message)
+        status = response.output['task_status']
+        if status == TASK_SUCCEEDED:
+            return status, response.output['results'][0]['url']
+        if status in (TASK_FAILED, 'CANCELED', 'UNKNOWN'):
+            return TASK_FAILED, response.output.get('message', status)
+        return status, None
+
+
+@register_image_endpoint('local')
+class LocalImageEndpoint(BaseImageEndpoint):
+    """
+    An offline stand-in of the synthesis endpoint, which renders a placeholder svg
+    with the prompt after a delay, for development and tests
+    """
+
+    def __init__(self,
+                 output_dir: Optional[str] = None,
+                 delay: float = 1.0,
+                 **kwargs):
+        self.output_dir = output_dir or tempfile.mkdtemp(
+            prefix='local_image_')
+        self.delay = delay
+        self._tasks: Dict[str, Dict] = {}
+
+    def submit(self, model: str, prompt: str, size: str,
+               seed: Optional[int]) -> str:
+        task_id = uuid.uuid4().hex
+        self._tasks[task_id] = {
+            'prompt': prompt,
+            'size': size,
+            'submitted': time.time()
+        }
+        return task_id
+
+    def fetch(self, task_id: str) -> Tuple[str, Optional[str]]:
+        task = self._tasks.get(task_id)
+        if task is None:
+            return TASK_FAILED, f'Unknown task: {task_id}'
+        if time.time() - task['submitted'] < self.delay:
+            return TASK_RUNNING, None
+        path = os.path.join(self.output_dir, f'{task_id}.svg')
+        if not os.path.exists(path):
+            width, height = task['size'].split('*')
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(
+                    f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+                    f'<rect width="100%" height="100%" fill="#ddd"/>'
+                    f'<text x="10" y="30">{escape(task["prompt"])}</text></svg>'
+                )
+        return TASK_SUCCEEDED, f'file://{path}'
+
+
+class ImageJob:
+    """
+    A submitted image generation, jobs of the same key share one instance
+    """
+
+    def __init__(self, key: Tuple, future: Future):
+        self.key = key
+        self.job_id = uuid.uuid4().hex[:12]
+        self.future = future
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        """
+        Wait for the image url or local path
+
+        Raises:
+            concurrent.futures.TimeoutError: when the image is not ready within timeout
+        """
+        return self.future.result(timeout=timeout)
+
+
+class ImageJobManager:
+    """
+    Run image generations in the background with bounded concurrency, and cache the
+    results by (prompt, resolution, seed, model). A request for an image being rendered
+    joins the running job instead of submitting a new one.
+    """
+
+    def __init__(self,
+                 endpoint: BaseImageEndpoint,
+                 max_concurrency: int = 2,
+                 poll_interval: float = 1.0,
+                 timeout: float = 300,
+                 cache_ttl: float = 20 * 3600,
+                 cache_size: int = 1024,
+                 download_dir: Optional[str] = None):
+        """
+        Args:
+            endpoint: the synthesis endpoint
+            max_concurrency: the number of generations running at the same time
+            poll_interval: the seconds between two polls of a task
+            timeout: the seconds after which a generation is given up
+            cache_ttl: the seconds an image url is cached, the url of dashscope expires in 24 hours
+            cache_size: the number of cached images
+            download_dir: download the images here, and cache the local paths which never expire
+        """
+        self.endpoint = endpoint
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.download_dir = download_dir
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix='image_gen')
+        self._lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()
+        self._running: Dict[Tuple, ImageJob] = {}
+
+    def submit(self,
+               prompt: str,
+               size: str,
+               seed: Optional[int] = None,
+               model: str = 'wanx-v1') -> ImageJob:
+        key = (prompt, size, seed, model)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                value, expire_at = cached
+                if (expire_at is None or expire_at > time.time()) and (
+                        not value.startswith('/') or os.path.exists(value)):
+                    self._cache.move_to_end(key)
+                    future = Future()
+                    future.set_result(value)
+                    return ImageJob(key, future)
+                del self._cache[key]
+
+            job = self._running.get(key)
+            if job is None:
+                job = ImageJob(key, self._executor.submit(self._run, key))
+                self._running[key] = job
+                job.future.add_done_callback(
+                    lambda f, key=key: self._on_done(key, f))
+            return job
+
+    def _run(self, key: Tuple) -> str:
+        prompt, size, seed, model = key
+        task_id = self.endpoint.submit(
+            model=model, prompt=prompt, size=size, seed=seed)
+        deadline = time.time() + self.timeout
+        while True:
+            status, value = self.endpoint.fetch(task_id)
+            if status == TASK_SUCCEEDED:
+                break
+            if status == TASK_FAILED:
+                raise RuntimeError(value)
+            if time.time() > deadline:
+                raise RuntimeError(
+                    f'The image generation timed out after {self.timeout}s')
+            time.sleep(self.poll_interval)
+
+        if self.download_dir:
+            value = self._download(value, task_id)
+        return value
+
+    def _download(self, url: str, task_id: str) -> str:
+        os.makedirs(self.download_dir, exist_ok=True)
+        ext = os.path.splitext(url.split('?')[0])[1] or '.png'
+        path = os.path.abspath(os.path.join(self.download_dir, task_id + ext))
+        urllib.request.urlretrieve(url, path)
+        return path
+
+    def _on_done(self, key: Tuple, future: Future):
+        with self._lock:
+            self._running.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                if not future.cancelled():
+                    logger.warning(
+                        f'Failed to generate the image: {future.exception()}')
+                return
+            value = future.result()
+            expire_at = None if self.download_dir else time.time(
+            ) + self.cache_ttl
+            self._cache[key] = (value, expire_at)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+_JOB_MANAGERS: Dict[Tuple, ImageJobManager] = {}
+_JOB_MANAGERS_LOCK = threading.Lock()
+
+
+def get_image_job_manager(endpoint: Optional[str] = None,
+                          endpoint_cfg: Optional[Dict] = None,
+                          **kwargs) -> ImageJobManager:
+    """
+    Get the job manager shared by all the tools with the same config in this process,
+    so that the concurrency bound and the cache cover all sessions
+
+    Args:
+        endpoint: the registered endpoint name, such as dashscope or local. Defaults to
+            the IMAGE_SYNTHESIS_ENDPOINT environment variable, or dashscope
+        endpoint_cfg: the config of the endpoint
+        kwargs: the config of the ImageJobManager
+    """
+    endpoint = endpoint or os.getenv(IMAGE_SYNTHESIS_ENDPOINT, 'dashscope')
+    endpoint_cfg = endpoint_cfg or {}
+    key = (endpoint, json.dumps(endpoint_cfg, sort_keys=True, default=str),
+           json.dumps(kwargs, sort_keys=True, default=str))
+    with _JOB_MANAGERS_LOCK:
+        manager = _JOB_MANAGERS.get(key)
+        if manager is None:
+            if endpoint not in IMAGE_ENDPOINT_REGISTRY:
+                raise NotImplementedError(
+                    f'Unknown image synthesis endpoint: {endpoint}')
+            manager = ImageJobManager(
+                IMAGE_ENDPOINT_REGISTRY[endpoint](**endpoint_cfg), **kwargs)
+            _JOB_MANAGERS[key] = manager
+        return manager
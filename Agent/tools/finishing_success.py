@@ -1,3 +1,4 @@
+from .arg_validator import ToolArgumentError
 from .base import BaseTool, register_tool
 
 
@@ -14,7 +15,7 @@ class FinishingSuccessTool(BaseTool):
 
     def call(self, params: str, **kwargs):
         params = self._verify_args(params)
-        if isinstance(params, str):
-            return "Parameter Error"
+        if isinstance(params, ToolArgumentError):
+            return f'Parameter Error: {params}'
         
         return f"任务成功：{params['result']}"
@@ -0,0 +1,167 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+_SEPARATOR_PATTERN = re.compile(r'[\s\-_./:]+')
+_STRIP_CHARS = ' \t\n\'"`[](){}'
+
+
+def normalize_tool_name(name: str) -> str:
+    """
+    Normalize a tool name, such as ` Quick-Sort ` -> quick_sort
+    """
+    name = name.strip(_STRIP_CHARS).lower()
+    return _SEPARATOR_PATTERN.sub('_', name).strip('_')
+
+
+def compact_tool_name(name: str) -> str:
+    """
+    Remove all separators of a tool name, such as quick_sort -> quicksort
+    """
+    return normalize_tool_name(name).replace('_', '')
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Damerau-Levenshtein distance (optimal string alignment) of two strings,
+    returns max_distance + 1 when it is larger than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev_prev = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if (prev_prev is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                cur[j] = min(cur[j], prev_prev[j - 2] + 1)
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev_prev, prev = prev, cur
+    return prev[-1]
+
+
+def _deletes(word: str, distance: int) -> Set[str]:
+    """
+    All the strings generated by deleting at most `distance` chars from word
+    """
+    result = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {
+            w[:i] + w[i + 1:]
+            for w in frontier for i in range(len(w))
+        } - result
+        result |= frontier
+    return result
+
+
+class ToolNameIndex:
+    """
+    The name index of the tools registered in one agent, which resolves a possibly
+    hallucinated tool name given by llm to a registered tool name.
+
+    The lookups are tried in order, and all of them are dict lookups prepared when
+    the tool is added, so the cost does not grow with the number of tools:
+        1. exact name
+        2. alias, including the normalized and compacted names, such as quicksort
+        3. unambiguous suffix, such as sort -> quick_sort
+        4. bounded edit distance through a symmetric deletion index, such as quik_sort
+    """
+
+    def __init__(self, max_edit_distance: int = 2):
+        self.max_edit_distance = max_edit_distance
+        self._names: Set[str] = set()
+        self._aliases: Dict[str, Set[str]] = defaultdict(set)
+        self._suffixes: Dict[str, Set[str]] = defaultdict(set)
+        self._deletes: Dict[str, Set[str]] = defaultdict(set)
+        self._keys: Dict[str, List[Set[str]]] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, name: str, aliases: Iterable[str] = ()):
+        if name in self._names:
+            self.remove(name)
+        self._names.add(name)
+
+        alias_keys = {normalize_tool_name(name), compact_tool_name(name)}
+        for alias in aliases:
+            alias_keys.add(normalize_tool_name(alias))
+            alias_keys.add(compact_tool_name(alias))
+        alias_keys.discard('')
+
+        normalized = normalize_tool_name(name)
+        suffix_keys = {normalized[i:] for i in range(1, len(normalized))}
+        suffix_keys.discard('')
+
+        delete_keys = _deletes(compact_tool_name(name), self.max_edit_distance)
+
+        for keys, table in ((alias_keys, self._aliases),
+                            (suffix_keys, self._suffixes),
+                            (delete_keys, self._deletes)):
+            for key in keys:
+                table[key].add(name)
+        self._keys[name] = [alias_keys, suffix_keys, delete_keys]
+
+    def remove(self, name: str):
+        if name not in self._names:
+            return
+        self._names.discard(name)
+        for keys, table in zip(self._keys.pop(name),
+                               (self._aliases, self._suffixes, self._deletes)):
+            for key in keys:
+                table[key].discard(name)
+                if not table[key]:
+                    del table[key]
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """
+        Resolve a tool name to a registered tool name
+
+        Args:
+            name: the tool name given by llm
+
+        Returns:
+            The registered tool name, or None if it can not be resolved unambiguously
+        """
+        if not name:
+            return None
+        if name in self._names:
+            return name
+
+        normalized = normalize_tool_name(name)
+        compact = normalized.replace('_', '')
+        for key in (normalized, compact):
+            matched = self._aliases.get(key)
+            if matched and len(matched) == 1:
+                return next(iter(matched))
+
+        matched = self._suffixes.get(normalized)
+        if matched and len(matched) == 1:
+            return next(iter(matched))
+
+        # short names tolerate fewer typos to avoid false corrections
+        max_distance = min(self.max_edit_distance, len(compact) // 5)
+        if max_distance <= 0:
+            return None
+        candidates = set()
+        for key in _deletes(compact, max_distance):
+            candidates |= self._deletes.get(key, set())
+        best, best_distance, ambiguous = None, max_distance + 1, False
+        for candidate in candidates:
+            distance = edit_distance(compact, compact_tool_name(candidate),
+                                     max_distance)
+            if distance < best_distance:
+                best, best_distance, ambiguous = candidate, distance, False
+            elif distance == best_distance:
+                ambiguous = True
+        if best is None or ambiguous:
+            return None
+        return best
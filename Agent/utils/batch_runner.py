@@ -0,0 +1,298 @@
+import gc
+import importlib
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+import json
+from Agent.utils.logger import agent_logger as logger
+
+AGENT_CLASSES = {
+    'RolePlay': 'Agent.agents.role_play.RolePlay',
+    'AlphaUmi': 'Agent.agents.multi_role.AlphaUmi',
+}
+
+# the arguments of the agents which hold an llm config
+LLM_KEYS = ('llm', 'llm_planner', 'llm_caller', 'llm_summarizer')
+
+# the fields of a request which are not passed to run
+REQUEST_FIELDS = ('id', 'query', 'user_request', 'uuid_str', 'user_id')
+
+# the state of a worker process, the agent is built once and kept warm
+_worker: Dict = {}
+
+
+def load_done_ids(output_path: str,
+                  retry_errors: bool = False) -> Tuple[Set[str], bool]:
+    """
+    Read the checkpoint, which is the output written so far
+
+    Returns:
+        the ids of the finished requests, and whether the file ends with a complete line
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done, True
+    with open(output_path, 'r', encoding='utf-8') as f:
+        data = f.read()
+    for line in data.splitlines():
+        try:
+            result = json.loads(line)
+        except ValueError:
+            # the last line may be cut by an interruption
+            continue
+        if retry_errors and 'error' in result:
+            continue
+        done.add(str(result['id']))
+    return done, not data or data.endswith('\n')
+
+
+def read_requests(input_path: str, done: Set[str]) -> Iterator[Dict]:
+    """
+    Read the requests not finished yet, the line number is the id of a request
+    without one
+    """
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            request['id'] = str(request.get('id', line_no))
+            if request['id'] not in done:
+                yield request
+
+
+def build_agent(config: Dict, semaphores: Optional[Dict] = None):
+    """
+    Build the agent of a worker from the batch config
+
+    Args:
+        config: such as {'agent': 'RolePlay', 'agent_cfg': {'llm': {...}, 'function_list': [...]}}
+        semaphores: the semaphores capping the concurrent requests, keyed by
+            model_server/model or model_server
+    """
+    from Agent.llm import get_chat_model
+    from Agent.llm.limiter import ConcurrencyLimitedLLM
+
+    module_name, class_name = AGENT_CLASSES[config.get(
+        'agent', 'RolePlay')].rsplit('.', 1)
+    agent_cls = getattr(importlib.import_module(module_name), class_name)
+
+    agent_cfg = dict(config.get('agent_cfg', {}))
+    llms = {}
+    for key in LLM_KEYS:
+        llm_cfg = agent_cfg.get(key)
+        if not isinstance(llm_cfg, Dict):
+            continue
+        # the roles with the same config share one client
+        cache_key = json.dumps(llm_cfg, sort_keys=True)
+        if cache_key not in llms:
+            llm = get_chat_model(**llm_cfg)
+            semaphore = (semaphores or {}).get(
+                f'{llm.model_server}/{llm.model}',
+                (semaphores or {}).get(llm.model_server))
+            if semaphore is not None:
+                llm = ConcurrencyLimitedLLM(llm, semaphore)
+            llms[cache_key] = llm
+        agent_cfg[key] = llms[cache_key]
+    return agent_cls(**agent_cfg)
+
+
+def _init_worker(config: Dict, semaphores: Optional[Dict] = None):
+    _worker['agent'] = build_agent(config, semaphores)
+    _worker['run_cfg'] = config.get('run_cfg', {})
+    _worker['user_id'] = _worker['agent'].user_id
+    if _worker['run_cfg'].get('use_vs'):
+        _worker['agent'].load_function_retriever(_worker['run_cfg']['vs_cfg'])
+    _register_close()
+
+
+def _register_close():
+    # atexit does not run in the workers of a pool, the finalizers do
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    """
+    Write what the agent of this worker keeps in memory, such as the pending turns
+    """
+    agent = _worker.get('agent')
+    if agent is None:
+        return
+    if agent.session_store is not None:
+        agent.session_store.close()
+    if agent.long_term_memory is not None:
+        agent.long_term_memory.close()
+
+
+def warm_shared_state():
+    """
+    Load the state which is only read by the workers and loaded lazily otherwise, such
+    as the embedding models
+    """
+    from Agent.storage.embedding_service import warmup_embedding_services
+    warmup_embedding_services()
+
+
+def _after_fork():
+    # the gc is disabled while the supervisor forks, the frozen objects it shares are
+    # not scanned by the collections of the workers
+    gc.enable()
+    _register_close()
+
+
+def create_pool(num_workers: int,
+                initializer: Callable,
+                initargs: Tuple = (),
+                prefork: bool = False,
+                freeze: bool = True):
+    """
+    Create the pool of worker processes
+
+    Args:
+        num_workers: the number of worker processes
+        initializer: builds the state of a worker, such as _init_worker
+        initargs: the arguments of the initializer
+        prefork: build the state once in this process as the supervisor and fork the
+            workers after it, so they share its pages copy-on-write instead of each
+            importing and loading everything again
+        freeze: move the state of the supervisor out of the gc before forking, so the
+            collections of the workers do not write to the shared pages
+
+    Returns:
+        the multiprocessing pool
+    """
+    if not prefork:
+        return multiprocessing.Pool(
+            num_workers, initializer=initializer, initargs=initargs)
+
+    start = time.time()
+    # no collection between the warmup and the fork, as recommended with gc.freeze
+    gc.disable()
+    initializer(*initargs)
+    warm_shared_state()
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    logger.info(f'Warmed the supervisor in {time.time() - start:.1f}s, '
+                f'{gc.get_freeze_count()} objects frozen')
+    pool = multiprocessing.get_context('fork').Pool(
+        num_workers, initializer=_after_fork)
+    gc.enable()
+    return pool
+
+
+def _run_one(request: Dict) -> Dict:
+    agent = _worker['agent']
+    kwargs = dict(_worker['run_cfg'])
+    kwargs.update(
+        {k: v
+         for k, v in request.items() if k not in REQUEST_FIELDS})
+    query = request.get('query', request.get('user_request', ''))
+    # a request without uuid_str is a session of its own
+    agent.uuid_str = request.get('uuid_str') or str(request['id'])
+    # the long-term memory of the user of the request, the one of the config by default
+    agent.user_id = request.get('user_id', _worker['user_id'])
+
+    start = time.time()
+    result = {'id': request['id']}
+    try:
+        response = agent.run(query, **kwargs)
+        if not isinstance(response, str):
+            response = ''.join(
+                chunk for chunk in response if isinstance(chunk, str))
+        result['response'] = response
+        if agent.continuation_id:
+            result['continuation_id'] = agent.continuation_id
+        if agent.cancel_reason:
+            result['cancelled'] = agent.cancel_reason
+        if agent.cache_hit is not None and not agent.cache_hit['sampled']:
+            result['cache_hit'] = round(agent.cache_hit['similarity'], 4)
+        if agent.usage is not None:
+            result['usage'] = agent.usage.summary()['run']
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
+def run_batch(input_path: str,
+              output_path: str,
+              config: Dict,
+              num_workers: int = 4,
+              caps: Optional[Dict[str, int]] = None,
+              retry_errors: bool = False,
+              fsync_every: int = 100,
+              prefork: bool = False) -> Dict:
+    """
+    Run the requests of a jsonl file with a pool of worker processes, each holding a
+    warm agent. The results are appended to the output jsonl as they finish, which is
+    also the checkpoint: an interrupted run resumes with the unfinished requests.
+
+    Args:
+        input_path: the jsonl of requests, such as {"id": "1", "query": "..."}, the
+            other fields are passed to run
+        output_path: the jsonl of results
+        config: the config of the agent, see build_agent, with the optional run_cfg
+            passed to every run
+        num_workers: the number of worker processes, 0 runs in this process
+        caps: the maximum concurrent requests per backend, keyed by model_server/model
+            or model_server, such as {'dashscope': 4}
+        retry_errors: run the requests which failed in the former runs again
+        fsync_every: sync the output to disk every this number of results
+        prefork: warm the agent once and fork the workers after it, see create_pool
+
+    Returns:
+        the number of finished, failed and skipped requests
+    """
+    done, complete = load_done_ids(output_path, retry_errors)
+    requests = read_requests(input_path, done)
+    semaphores = {
+        key: multiprocessing.BoundedSemaphore(value)
+        for key, value in (caps or {}).items()
+    }
+    summary = {'finished': 0, 'failed': 0, 'skipped': len(done)}
+    if done:
+        logger.info(f'Resume from {output_path}, skip {len(done)} requests')
+
+    pool = None
+    if num_workers > 0:
+        pool = create_pool(
+            num_workers,
+            _init_worker,
+            initargs=(config, semaphores),
+            prefork=prefork)
+        results = pool.imap_unordered(_run_one, requests, chunksize=1)
+    else:
+        _init_worker(config, semaphores)
+        results = map(_run_one, requests)
+
+    start = time.time()
+    completed = False
+    try:
+        with open(output_path, 'a', encoding='utf-8') as writer:
+            if not complete:
+                writer.write('\n')
+            for result in results:
+                writer.write(json.dumps(result, ensure_ascii=False) + '\n')
+                writer.flush()
+                summary['failed' if 'error' in result else 'finished'] += 1
+                count = summary['finished'] + summary['failed']
+                if count % fsync_every == 0:
+                    os.fsync(writer.fileno())
+                    logger.info(f'{count} requests done in '
+                                f'{time.time() - start:.1f}s')
+        completed = True
+    finally:
+        if pool is not None:
+            # the workers exit on their own when done, so they write their pending state
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        elif _worker:
+            _close_worker()
+    return summary
@@ -0,0 +1,175 @@
+import threading
+import time
+from functools import wraps
+from typing import Callable, Iterator, List, Optional
+
+from Agent.utils.logger import agent_logger as logger
+
+
+class RunCancelled(Exception):
+    """
+    The run was cancelled or ran out of its time budget
+    """
+
+    def __init__(self, reason: str = 'cancelled'):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancellationToken:
+    """
+    The cancellation and the deadline of one run, passed to the llm calls, the tools
+    and the retries of the run as cancel_token.
+
+    A child token, such as the one of a turn, has its own deadline within the one of its
+    parent and is cancelled together with the parent. The callbacks, such as closing
+    the streams of the llm, are called once when the token is cancelled.
+    """
+
+    def __init__(self,
+                 timeout: Optional[float] = None,
+                 parent: Optional['CancellationToken'] = None):
+        """
+        Args:
+            timeout: the seconds from now to the deadline, None for no deadline
+            parent: the token whose cancellation and deadline also apply to this one
+        """
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + max(0.0, timeout)
+        if parent is not None and parent.deadline is not None:
+            self.deadline = parent.deadline if self.deadline is None else min(
+                self.deadline, parent.deadline)
+        self.reason: Optional[str] = None
+        self._parent = parent
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable] = []
+        if parent is not None:
+            parent.add_callback(self._on_parent_cancelled)
+            if parent.cancelled:
+                self.cancel(parent.reason)
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None \
+                and time.monotonic() >= self.deadline:
+            self.cancel('deadline exceeded')
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        """
+        The seconds left before the deadline, None for no deadline
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def child(self, timeout: Optional[float] = None) -> 'CancellationToken':
+        return CancellationToken(timeout, parent=self)
+
+    def cancel(self, reason: str = 'cancelled'):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f'Cancel callback failed: {e}')
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RunCancelled(self.reason)
+
+    def wait(self, seconds: float) -> bool:
+        """
+        Sleep for the seconds unless cancelled before
+
+        Returns:
+            whether the token is cancelled
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self._event.wait(remaining)
+        else:
+            self._event.wait(seconds)
+        return self.cancelled
+
+    def add_callback(self, callback: Callable):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def _on_parent_cancelled(self):
+        self.cancel(self._parent.reason or 'cancelled')
+
+
+class CancellableStream:
+    """
+    A streamed output which stops with RunCancelled once the token is cancelled, and
+    closes the stream of the llm so the backend stops generating
+    """
+
+    def __init__(self, output: Iterator, token: CancellationToken):
+        self._output = output
+        self._iterator = iter(output)
+        self._token = token
+        self._closed = False
+        token.add_callback(self.close)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._token.cancelled:
+            self.close()
+            raise RunCancelled(self._token.reason)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self._token.remove_callback(self.close)
+            raise
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._token.remove_callback(self.close)
+        if hasattr(self._output, 'close'):
+            try:
+                self._output.close()
+            except ValueError:
+                # the stream is being read by another thread, which stops at the next
+                # chunk
+                pass
+
+
+def cancellable(func):
+    """
+    Make an llm call take the cancel_token keyword: the call is not made once the token
+    is cancelled, and a streamed output stops when it is
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = kwargs.pop('cancel_token', None)
+        if token is None:
+            return func(*args, **kwargs)
+        token.raise_if_cancelled()
+        output = func(*args, **kwargs)
+        if isinstance(output, (str, dict)) or not hasattr(output, '__next__'):
+            return output
+        return CancellableStream(output, token)
+
+    return wrapper
@@ -0,0 +1,238 @@
+import cProfile
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from functools import wraps
+from typing import Dict, Iterator, List, Optional
+
+from Agent.utils.logger import agent_logger as logger
+
+import json
+
+# environ params
+PROFILE_ENABLE = 'PROFILE_ENABLE'
+PROFILE_SAMPLE_RATE = 'PROFILE_SAMPLE_RATE'
+PROFILE_PATH = 'PROFILE_PATH'
+PROFILE_TRACE_FRAMES = 'PROFILE_TRACE_FRAMES'
+
+# the number of functions and allocation sites in the summary of a profile
+TOP_ENTRIES = 20
+
+# one run is profiled at a time in a process, since tracemalloc traces the whole
+# process and a newer cProfile can not run twice
+_profile_lock = threading.Lock()
+_profile_counter = itertools.count()
+
+
+class RunProfiler:
+    """
+    The CPU profile and the memory allocations of one run.
+
+    The profiler is only active while the code of the run executes, not while the
+    caller handles the streamed output. When the run ends, the cProfile stats (.prof,
+    read with pstats), the tracemalloc snapshot (.tracemalloc, read with
+    tracemalloc.Snapshot.load) and a json summary of the top functions and allocation
+    sites are written to {path}/{session_id}/.
+    """
+
+    def __init__(self,
+                 session_id: Optional[str],
+                 path: Optional[str] = None,
+                 frames: int = 8):
+        """
+        Args:
+            session_id: the uuid_str of the run, which names the directory of its profiles
+            path: the root directory of the profiles, PROFILE_PATH or ./profiles by default
+            frames: the number of frames of the traceback of an allocation
+        """
+        self.session_id = session_id or 'default'
+        path = path or os.getenv(PROFILE_PATH, f'{os.getcwd()}/profiles')
+        self.output_dir = os.path.join(path, self.session_id)
+        self.frames = frames
+        self._profile: Optional[cProfile.Profile] = cProfile.Profile()
+        self._started_at = time.time()
+        self._active_seconds = 0.0
+        self._resumed_at: Optional[float] = None
+        self._started_tracing = False
+        self._finished = False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._started_tracing = True
+        tracemalloc.reset_peak()
+
+    def resume(self):
+        if self._profile is not None:
+            try:
+                self._profile.enable()
+            except ValueError as e:
+                # another profiler is active, such as a debugger
+                logger.warning(f'Failed to start the CPU profile: {e}')
+                self._profile = None
+        self._resumed_at = time.perf_counter()
+
+    def pause(self):
+        if self._profile is not None:
+            self._profile.disable()
+        if self._resumed_at is not None:
+            self._active_seconds += time.perf_counter() - self._resumed_at
+            self._resumed_at = None
+
+    def finish(self) -> Optional[str]:
+        """
+        Write the profiles of the run
+
+        Returns:
+            the path of the profiles without extension, None if they are not written
+        """
+        if self._finished:
+            return None
+        self._finished = True
+        try:
+            return self._write()
+        except Exception as e:
+            logger.warning(f'Failed to write the profile of {self.session_id}: {e}')
+            return None
+        finally:
+            if self._started_tracing:
+                tracemalloc.stop()
+            _profile_lock.release()
+
+    def _write(self) -> str:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = os.path.join(
+            self.output_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-'
+            f'{next(_profile_counter)}')
+        snapshot.dump(f'{name}.tracemalloc')
+        summary = {
+            'uuid_str': self.session_id,
+            'started_at': self._started_at,
+            'elapsed': round(time.time() - self._started_at, 4),
+            'active': round(self._active_seconds, 4),
+            'memory_current': current,
+            'memory_peak': peak,
+            'top_functions': [],
+            'top_allocations': [{
+                'site': str(stat.traceback[0]),
+                'size': stat.size,
+                'count': stat.count,
+            } for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]],
+        }
+        if self._profile is not None:
+            self._profile.dump_stats(f'{name}.prof')
+            summary['top_functions'] = _top_functions(self._profile)
+        with open(f'{name}.json', 'w') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        logger.info(f'Profiled the run of {self.session_id} in '
+                    f'{summary["active"]}s, peak memory {peak} bytes: {name}')
+        return name
+
+
+def _top_functions(profile: cProfile.Profile) -> List[Dict]:
+    stats = pstats.Stats(profile).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3],
+                 reverse=True)[:TOP_ENTRIES]
+    return [{
+        'function': f'{filename}:{line}({func})',
+        'calls': calls,
+        'self': round(self_time, 6),
+        'cumulative': round(cumulative, 6),
+    } for (filename, line, func), (_, calls, self_time, cumulative,
+                                     _) in top]
+
+
+def start_profiler(session_id: Optional[str],
+                   profile: Optional[bool] = None) -> Optional[RunProfiler]:
+    """
+    Start the profiler of a run when it is profiled: always when profile is True,
+    never when it is False, otherwise when PROFILE_ENABLE is on for a sample of
+    PROFILE_SAMPLE_RATE of the runs. A run is not profiled while another one is.
+    """
+    if profile is None:
+        if os.environ.get(PROFILE_ENABLE, 'off').lower() != 'on':
+            return None
+        profile = random.random() < float(
+            os.environ.get(PROFILE_SAMPLE_RATE, 1.0))
+    if not profile:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        logger.info(f'Skip the profile of {session_id}, another run is profiled')
+        return None
+    try:
+        return RunProfiler(
+            session_id, frames=int(os.environ.get(PROFILE_TRACE_FRAMES, 8)))
+    except BaseException:
+        _profile_lock.release()
+        raise
+
+
+class ProfiledStream:
+    """
+    A streamed run which is profiled while the caller pulls its output, the profiles
+    are written when it is exhausted, closed or collected, even before it is started
+    """
+
+    def __init__(self, profiler: RunProfiler, output: Iterator):
+        self._profiler = profiler
+        self._output = output
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._profiler.resume()
+        try:
+            chunk = next(self._output)
+        except BaseException:
+            self._profiler.pause()
+            self.close()
+            raise
+        self._profiler.pause()
+        return chunk
+
+    def close(self):
+        try:
+            if hasattr(self._output, 'close'):
+                self._output.close()
+        finally:
+            self._profiler.finish()
+
+    def __del__(self):
+        # a dropped run still releases the profile lock and stops tracemalloc
+        self._profiler.finish()
+
+
+def profiled(func):
+    """
+    Make a run of an agent take the profile keyword, see start_profiler
+    """
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        profiler = start_profiler(
+            getattr(self, 'uuid_str', None), kwargs.pop('profile', None))
+        if profiler is None:
+            return func(self, *args, **kwargs)
+        profiler.resume()
+        try:
+            output = func(self, *args, **kwargs)
+        except BaseException:
+            profiler.pause()
+            profiler.finish()
+            raise
+        profiler.pause()
+        if isinstance(output, (str, dict)) or not hasattr(output, '__next__'):
+            profiler.finish()
+            return output
+        return ProfiledStream(profiler, output)
+
+    return wrapper
@@ -1,12 +1,14 @@
 import time
 from functools import wraps
 
+from Agent.utils.cancellation import RunCancelled
 from Agent.utils.logger import agent_logger as logger
 
 
 def retry(max_retries=3, delay_seconds=1, return_str=False):
     """
     Retry decorator with exponential backoff.
+    The retries stop once the cancel_token in the kwargs of the call is cancelled.
     Args:
         max_retries: max retry times
         delay_seconds: delay seconds between retries
@@ -20,18 +22,24 @@ def retry(max_retries=3, delay_seconds=1, return_str=False):
 
         @wraps(func)
         def wrapper(*args, **kwargs):
+            token = kwargs.get('cancel_token')
             attempts = 0
             while attempts < max_retries:
                 try:
                     return func(*args, **kwargs)
                 except AssertionError as e:
                     raise AssertionError(e)
+                except RunCancelled:
+                    raise
                 except Exception as e:
                     logger.warning(
                         f'Attempt to run {func.__name__} {attempts + 1} failed: {e}'
                     )
                     attempts += 1
-                    time.sleep(delay_seconds)
+                    if token is None:
+                        time.sleep(delay_seconds)
+                    elif token.wait(delay_seconds):
+                        raise RunCancelled(token.reason)
             if return_str:
                 return f'Max retries reached. Attempt to run {func.__name__} failed after {max_retries} times'
             else:
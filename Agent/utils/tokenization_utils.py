@@ -0,0 +1,65 @@
+import re
+from typing import Callable, Optional
+
+TOKEN_COUNTER_REGISTRY = {}
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def register_token_counter(name):
+
+    def decorator(func):
+        TOKEN_COUNTER_REGISTRY[name] = func
+        return func
+
+    return decorator
+
+
+@register_token_counter('approx')
+def approx_token_count(text: str) -> int:
+    """
+    A dependency-free estimation of the token count of a text.
+
+    CJK characters are usually encoded as about one token each, while the
+    rest of the text averages about four characters per token.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+_tiktoken_encoding = None
+
+
+@register_token_counter('tiktoken')
+def tiktoken_token_count(text: str) -> int:
+    global _tiktoken_encoding
+    if not text:
+        return 0
+    if _tiktoken_encoding is None:
+        import tiktoken
+        _tiktoken_encoding = tiktoken.get_encoding('cl100k_base')
+    return len(_tiktoken_encoding.encode(text, disallowed_special=()))
+
+
+def get_token_counter(name: Optional[str] = None) -> Callable[[str], int]:
+    """
+    Get a registered local token counter.
+
+    Args:
+        name: the name of the counter, such as approx, tiktoken. When not
+            specified, tiktoken is used if it is installed, otherwise approx.
+
+    Returns:
+        A callable mapping a text to its token count
+    """
+    if name is None:
+        try:
+            import tiktoken  # noqa
+            name = 'tiktoken'
+        except ImportError:
+            name = 'approx'
+    if name not in TOKEN_COUNTER_REGISTRY:
+        raise NotImplementedError(f'Unknown token counter: {name}')
+    return TOKEN_COUNTER_REGISTRY[name]
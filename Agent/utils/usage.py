@@ -0,0 +1,372 @@
+import inspect
+import os
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict, defaultdict
+from functools import wraps
+from typing import Dict, Iterator, Optional
+
+from Agent.utils.logger import agent_logger as logger
+from Agent.utils.tokenization_utils import get_token_counter
+
+import json
+
+# the number of sessions whose usage is kept in one process
+MAX_TRACKED_SESSIONS = 1024
+
+
+class CallUsage:
+    """
+    The usage of one llm call. The backend reports the token counts of the provider
+    to it, the missing ones are counted locally when the call ends.
+    """
+
+    def __init__(self, model: Optional[str], role: Optional[str]):
+        self.model = model
+        self.role = role
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        # the prompt tokens served from the cache of the provider, when it tells
+        self.cached_tokens: Optional[int] = None
+        # the tokens of the prompt shared with the last prompt of the same role
+        self.reused_prefix_tokens = 0
+        self.counted_locally = False
+        self.started_at = time.time()
+        self.first_token_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+
+    def report(self,
+               prompt_tokens: Optional[int] = None,
+               completion_tokens: Optional[int] = None,
+               cached_tokens: Optional[int] = None):
+        """
+        Report the token counts returned by the provider
+        """
+        if prompt_tokens is not None:
+            self.prompt_tokens = prompt_tokens
+        if completion_tokens is not None:
+            self.completion_tokens = completion_tokens
+        if cached_tokens is not None:
+            self.cached_tokens = cached_tokens
+
+    @property
+    def latency(self) -> float:
+        return (self.ended_at or time.time()) - self.started_at
+
+
+class UsageMeter:
+    """
+    The usage kwarg of an llm call, which records the call for one role into a tracker
+    """
+
+    def __init__(self, tracker: 'UsageTracker', role: str):
+        self.tracker = tracker
+        self.role = role
+
+
+class UsageTracker:
+    """
+    The token usage, cost and latency of one session, in total, for the current run,
+    per model, per role of the agent (such as planner, caller and summarizer) and per
+    tool.
+
+    The quotas apply to the whole session: once max_tokens or max_cost is exceeded,
+    the tokens of the runs being watched are cancelled, so the runs stop early.
+
+    The prompt of each call is compared with the last prompt of the same role, the
+    length of their common prefix is what a provider can serve from its prompt cache.
+    """
+
+    def __init__(self, session_id: str, **kwargs):
+        self.session_id = session_id
+        self.total = Counter()
+        self.run = Counter()
+        self.by_model: Dict[str, Counter] = defaultdict(Counter)
+        self.by_role: Dict[str, Counter] = defaultdict(Counter)
+        self.by_tool: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._tokens = weakref.WeakSet()
+        self._last_prompts: Dict[str, str] = {}
+        self.configure(**kwargs)
+
+    def configure(self,
+                  prices: Optional[Dict[str, Dict[str, float]]] = None,
+                  max_tokens: Optional[int] = None,
+                  max_cost: Optional[float] = None,
+                  token_counter: Optional[str] = None,
+                  **kwargs):
+        """
+        Args:
+            prices: the prices per 1000 tokens of each model, such as
+                {'qwen-max': {'prompt': 0.02, 'completion': 0.06}}
+            max_tokens: the quota of prompt and completion tokens of the session
+            max_cost: the quota of the cost of the session
+            token_counter: the local counter of the tokens the provider does not return
+        """
+        self.prices = prices or {}
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.count_tokens = get_token_counter(token_counter)
+
+    def meter(self, role: str) -> UsageMeter:
+        return UsageMeter(self, role)
+
+    def start_run(self, token=None):
+        """
+        Reset the usage of the current run, and watch its cancellation token, which
+        is cancelled right away when the session is already over its quota
+        """
+        with self._lock:
+            self.run = Counter()
+            if token is not None:
+                self._tokens.add(token)
+        self._enforce_quota()
+
+    def reuse_prefix(self, role: Optional[str], prompt: str) -> int:
+        """
+        The tokens of the prompt shared with the last prompt of the role, which
+        becomes the prompt
+        """
+        with self._lock:
+            last = self._last_prompts.get(role, '')
+            self._last_prompts[role] = prompt
+        return self.count_tokens(os.path.commonprefix([last, prompt]))
+
+    def cost(self, model: Optional[str], prompt_tokens: int,
+             completion_tokens: int) -> float:
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        return (prompt_tokens * price.get('prompt', 0.0)
+                + completion_tokens * price.get('completion', 0.0)) / 1000
+
+    def record(self, call: CallUsage):
+        prompt_tokens = call.prompt_tokens or 0
+        completion_tokens = call.completion_tokens or 0
+        usage = {
+            'calls': 1,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': self.cost(call.model, prompt_tokens, completion_tokens),
+            'latency': call.latency,
+            'counted_locally': int(call.counted_locally),
+            'reused_prefix_tokens': call.reused_prefix_tokens,
+        }
+        if call.cached_tokens is not None:
+            usage['cached_tokens'] = call.cached_tokens
+        if call.first_token_at is not None:
+            usage['first_token_latency'] = call.first_token_at - call.started_at
+        with self._lock:
+            for counter in (self.total, self.run, self.by_model[call.model],
+                            self.by_role[call.role]):
+                counter.update(usage)
+        self._enforce_quota()
+
+    def record_tool(self, tool_name: str, latency: float, observation):
+        """
+        Record a tool call, whose observation is sent to the llm in the later prompts
+        """
+        with self._lock:
+            self.by_tool[tool_name].update({
+                'calls': 1,
+                'latency': latency,
+                'observation_tokens': self.count_tokens(str(observation)),
+            })
+
+    def exceeded(self) -> Optional[str]:
+        """
+        The reason why the session is over its quota, None if it is not
+        """
+        tokens = self.total['prompt_tokens'] + self.total['completion_tokens']
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            return f'quota exceeded: {tokens} tokens > {self.max_tokens}'
+        if self.max_cost is not None and self.total['cost'] > self.max_cost:
+            return (f'quota exceeded: cost {self.total["cost"]:.4f} > '
+                    f'{self.max_cost}')
+        return None
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'session': _format(self.total),
+                'run': _format(self.run),
+                'models': {
+                    model: _format(counter)
+                    for model, counter in self.by_model.items()
+                },
+                'roles': {
+                    role: _format(counter)
+                    for role, counter in self.by_role.items()
+                },
+                'tools': {
+                    tool: _format(counter)
+                    for tool, counter in self.by_tool.items()
+                },
+            }
+
+    def _enforce_quota(self):
+        reason = self.exceeded()
+        if reason is None:
+            return
+        for token in list(self._tokens):
+            if not token.cancelled:
+                logger.warning(f'The session {self.session_id} is over its '
+                               f'quota: {reason}')
+                token.cancel(reason)
+
+
+def _format(counter: Counter) -> Dict:
+    usage = {
+        key: round(value, 4) if isinstance(value, float) else value
+        for key, value in counter.items()
+    }
+    calls = counter.get('calls')
+    if calls:
+        usage['mean_latency'] = round(counter['latency'] / calls, 4)
+    if counter.get('prompt_tokens'):
+        usage['prefix_reuse'] = round(
+            min(1.0,
+                counter['reused_prefix_tokens'] / counter['prompt_tokens']), 4)
+    return usage
+
+
+_trackers: OrderedDict = OrderedDict()
+_trackers_lock = threading.Lock()
+
+
+def get_usage_tracker(session_id: str, **usage_cfg) -> UsageTracker:
+    """
+    Get the usage tracker of a session shared in the process, so the quotas hold
+    across the runs of the session. The least recently used sessions beyond
+    MAX_TRACKED_SESSIONS are forgotten.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(session_id)
+        if tracker is None:
+            tracker = UsageTracker(session_id, **usage_cfg)
+            _trackers[session_id] = tracker
+        else:
+            tracker.configure(**usage_cfg)
+            _trackers.move_to_end(session_id)
+        while len(_trackers) > MAX_TRACKED_SESSIONS:
+            _trackers.popitem(last=False)
+    return tracker
+
+
+class MeteredStream:
+    """
+    A streamed output whose call is recorded when it is exhausted, closed or collected
+    """
+
+    def __init__(self, output: Iterator, call: CallUsage, finish):
+        self._output = output
+        self._iterator = iter(output)
+        self._call = call
+        self._finish = finish
+        self._text = []
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except BaseException:
+            self._end()
+            raise
+        if self._call.first_token_at is None:
+            self._call.first_token_at = time.time()
+        self._text.append(_output_text(chunk))
+        return chunk
+
+    def close(self):
+        try:
+            if hasattr(self._output, 'close'):
+                self._output.close()
+        finally:
+            self._end()
+
+    def _end(self):
+        if not self._finished:
+            self._finished = True
+            self._finish(''.join(self._text))
+
+    def __del__(self):
+        self._end()
+
+
+def _output_text(output) -> str:
+    if output is None:
+        return ''
+    if isinstance(output, str):
+        return output
+    if isinstance(output, dict):
+        return json.dumps(output, ensure_ascii=False, default=str)
+    return str(getattr(output, 'content', None) or '') + str(
+        getattr(output, 'function_call', None) or '')
+
+
+def _prompt_text(arguments: Dict) -> str:
+    # in the order the prompt grows: the functions and the messages are fixed within
+    # a turn, and a raw prompt is built from the messages and extended
+    texts = []
+    if arguments.get('functions'):
+        texts.append(
+            json.dumps(arguments['functions'], ensure_ascii=False, default=str))
+    for message in arguments.get('messages') or []:
+        if isinstance(message, dict):
+            texts.append(f'{message.get("role")}: '
+                         + _output_text(message.get('content')))
+    if arguments.get('prompt'):
+        texts.append(arguments['prompt'])
+    return '\n'.join(texts)
+
+
+def metered(func):
+    """
+    Make an llm call take the usage keyword, a UsageMeter into which the call is
+    recorded. The backend gets a CallUsage as usage instead, to report the token
+    counts of the provider.
+    """
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        meter = kwargs.pop('usage', None)
+        if not isinstance(meter, UsageMeter):
+            # not metered, or called inside a metered call which records it already
+            if meter is not None:
+                kwargs['usage'] = meter
+            return func(self, *args, **kwargs)
+
+        call = CallUsage(getattr(self, 'model', None), meter.role)
+        try:
+            arguments = inspect.signature(func).bind_partial(
+                self, *args, **kwargs).arguments
+        except TypeError:
+            arguments = kwargs
+        prompt = _prompt_text(arguments)
+        call.reused_prefix_tokens = meter.tracker.reuse_prefix(
+            meter.role, prompt)
+        logger.info(f'The prompt of {meter.role} reuses '
+                    f'{call.reused_prefix_tokens} prefix tokens')
+
+        def finish(text: str):
+            call.ended_at = time.time()
+            if call.prompt_tokens is None:
+                call.prompt_tokens = meter.tracker.count_tokens(prompt)
+                call.counted_locally = True
+            if call.completion_tokens is None:
+                call.completion_tokens = meter.tracker.count_tokens(text)
+                call.counted_locally = True
+            meter.tracker.record(call)
+
+        output = func(self, *args, usage=call, **kwargs)
+        if isinstance(output, (str, dict)) or not hasattr(output, '__next__'):
+            finish(_output_text(output))
+            return output
+        return MeteredStream(output, call, finish)
+
+    return wrapper
+
@@ -8,6 +8,21 @@ def print_traceback():
     logger.error(''.join(traceback.format_exception(*sys.exc_info())))
 
 
+_CHINESE_CHAR_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+
+
 def has_chinese_chars(data) -> bool:
-    text = f'{data}'
-    return len(re.findall(r'[\u4e00-\u9fff]+', text)) > 0
\ No newline at end of file
+    text = data if isinstance(data, str) else f'{data}'
+    return _CHINESE_CHAR_PATTERN.search(text) is not None
+
+
+def detect_lang(text: str) -> str:
+    """
+    Detect the language of a text, which stops at the first chinese char
+
+    Returns:
+        zh or en
+    """
+    if isinstance(text, str) and _CHINESE_CHAR_PATTERN.search(text):
+        return 'zh'
+    return 'en'
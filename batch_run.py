@@ -0,0 +1,65 @@
+"""
+Run a jsonl of requests through an agent with a pool of worker processes.
+
+    python batch_run.py --input requests.jsonl --output results.jsonl \
+        --config agent.json --workers 8 --cap dashscope=4 --prefork
+
+The config is a json file such as
+    {
+        "agent": "RolePlay",
+        "agent_cfg": {"llm": {"model": "qwen-max", "model_server": "dashscope"},
+                      "function_list": ["quick_sort", "binary_search"]},
+        "run_cfg": {"use_vs": true, "vs_cfg": {"storage_path": "tool_vector_store"},
+                    "timeout": 120}
+    }
+
+Run the same command again to resume an interrupted run.
+"""
+import argparse
+
+import json
+from Agent.utils.batch_runner import run_batch
+
+
+def parse_caps(caps):
+    result = {}
+    for cap in caps:
+        key, value = cap.rsplit('=', 1)
+        result[key] = int(value)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument(
+        '--cap',
+        action='append',
+        default=[],
+        help='the maximum concurrent requests of a backend, such as '
+        'dashscope=4 or dashscope/qwen-max=2')
+    parser.add_argument('--retry-errors', action='store_true')
+    parser.add_argument(
+        '--prefork',
+        action='store_true',
+        help='warm the agent once and fork the workers, which share its memory')
+    args = parser.parse_args()
+
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    summary = run_batch(
+        args.input,
+        args.output,
+        config,
+        num_workers=args.workers,
+        caps=parse_caps(args.cap),
+        retry_errors=args.retry_errors,
+        prefork=args.prefork)
+    print(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Benchmark the approximate and quantized indexes of VectorStorage against the exact
+flat index.
+
+Synthetic catalogs of clustered vectors stand in for the embeddings of tool docs, and
+each index type and quantizer is measured by recall@k against the flat index, the
+p50/p99 latency of single queries, the serialized size and the time to load it.
+
+    python benchmarks/ann_index.py --sizes 1000 10000 100000 1000000 \
+        --index-types flat ivf hnsw --quantizers none sq8 pq --rerank 4 \
+        --dim 768 --k 5 --mmap
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Agent.storage.ann_index import build_faiss_index, read_faiss_index  # noqa
+
+
+def synthetic_catalog(size: int, dim: int, num_queries: int, seed: int = 0):
+    """
+    Vectors around random centers, queries are perturbed catalog vectors, both
+    normalized like sentence embeddings
+    """
+    rng = np.random.default_rng(seed)
+    # wide overlapping clusters, so that the neighbors are not trivially separated
+    num_clusters = max(1, size // 1000)
+    centers = rng.standard_normal((num_clusters, dim), dtype=np.float32)
+    labels = rng.integers(0, num_clusters, size)
+    vectors = centers[labels] + 2 * rng.standard_normal(
+        (size, dim), dtype=np.float32)
+    picks = rng.integers(0, size, num_queries)
+    queries = vectors[picks] + 0.5 * rng.standard_normal(
+        (num_queries, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return vectors, queries
+
+
+def measure(index, queries, k: int):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids[0])
+    return np.array(results), np.array(latencies)
+
+
+def recall_at_k(results, truth) -> float:
+    hits = sum(
+        len(set(found) & set(expected))
+        for found, expected in zip(results, truth))
+    return hits / truth.size
+
+
+def measure_load(index, mmap: bool) -> float:
+    import faiss
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_file = os.path.join(tmp_dir, 'index.faiss')
+        faiss.write_index(index, index_file)
+        start = time.perf_counter()
+        read_faiss_index(index_file, mmap=mmap)
+        return time.perf_counter() - start
+
+
+def main():
+    import faiss
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument(
+        '--index-types', nargs='+', default=['flat', 'ivf', 'hnsw'])
+    parser.add_argument(
+        '--quantizers',
+        nargs='+',
+        default=['none'],
+        help='none for float32 vectors, sq8 or pq')
+    parser.add_argument(
+        '--rerank',
+        type=int,
+        default=0,
+        help='re-rank rerank * k candidates of the quantized indexes exactly')
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--ef-search', type=int, default=64)
+    args = parser.parse_args()
+
+    print(f'{"size":>8} {"index":>6} {"quant":>5} {"build(s)":>9} '
+          f'{"recall@k":>9} {"p50(ms)":>8} {"p99(ms)":>8} {"size(MB)":>9} '
+          f'{"load(ms)":>9}')
+    for size in args.sizes:
+        vectors, queries = synthetic_catalog(size, args.dim, args.queries)
+        exact = faiss.IndexFlatL2(args.dim)
+        exact.add(vectors)
+        _, truth = exact.search(queries, args.k)
+
+        for index_type in args.index_types:
+            for quantizer in args.quantizers:
+                quantizer = None if quantizer == 'none' else quantizer
+                start = time.perf_counter()
+                index = build_faiss_index(
+                    vectors,
+                    index_type=index_type,
+                    nprobe=args.nprobe,
+                    ef_search=args.ef_search,
+                    quantizer=quantizer,
+                    rerank=args.rerank if quantizer else 0)
+                index.add(vectors)
+                build_time = time.perf_counter() - start
+
+                results, latencies = measure(index, queries, args.k)
+                nbytes = faiss.serialize_index(index).nbytes
+                load_time = measure_load(index, args.mmap)
+                print(f'{size:>8} {index_type:>6} {quantizer or "none":>5} '
+                      f'{build_time:>9.2f} '
+                      f'{recall_at_k(results, truth):>9.3f} '
+                      f'{np.percentile(latencies, 50) * 1000:>8.3f} '
+                      f'{np.percentile(latencies, 99) * 1000:>8.3f} '
+                      f'{nbytes / 2**20:>9.1f} {load_time * 1000:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark the shared embedding service against calling the embedding model directly.
+
+Concurrent threads stand in for the agents of a process, each embedding queries one at
+a time, a part of which repeat earlier ones. A simulated model costs a fixed time per
+call and a time per text, and runs one call at a time like a single model copy, so the
+gain of micro-batching shows without downloading a model; --modelscope uses the real
+GTE model instead.
+
+    python benchmarks/embedding_service.py --threads 32 --requests 2000 \
+        --max-batch-size 32 --max-wait-ms 5
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Agent.storage.embedding_service import EmbeddingService  # noqa
+
+
+class SimulatedEmbeddings(Embeddings):
+
+    def __init__(self, call_ms: float, text_ms: float, dim: int = 768):
+        self.call_ms = call_ms
+        self.text_ms = text_ms
+        self.dim = dim
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            time.sleep((self.call_ms + self.text_ms * len(texts)) / 1000)
+        return [[float(hash(text) % 1000)] * self.dim for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def make_queries(num_requests: int, duplicate_rate: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in range(num_requests):
+        if queries and rng.random() < duplicate_rate:
+            queries.append(queries[rng.integers(0, len(queries))])
+        else:
+            queries.append(f'帮我对数组[{i}, 2, 3, 5, 2, 4]进行排序')
+    return queries
+
+
+def run(embedding: Embeddings, queries: List[str], num_threads: int):
+    latencies = []
+
+    def embed(query):
+        start = time.perf_counter()
+        embedding.embed_query(query)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(embed, queries))
+    return time.perf_counter() - start, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--duplicate-rate', type=float, default=0.2)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument(
+        '--call-ms',
+        type=float,
+        default=8,
+        help='the fixed cost of a call of the simulated model')
+    parser.add_argument(
+        '--text-ms',
+        type=float,
+        default=0.5,
+        help='the cost per text of the simulated model')
+    parser.add_argument('--modelscope', action='store_true')
+    args = parser.parse_args()
+
+    if args.modelscope:
+        from langchain_community.embeddings import ModelScopeEmbeddings
+        from Agent.storage.embedding_service import DEFAULT_EMBEDDING_MODEL
+        model = ModelScopeEmbeddings(model_id=DEFAULT_EMBEDDING_MODEL)
+    else:
+        model = SimulatedEmbeddings(args.call_ms, args.text_ms)
+    queries = make_queries(args.requests, args.duplicate_rate)
+    service = EmbeddingService(
+        model=model,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        cache_size=args.cache_size)
+
+    print(f'{"mode":>8} {"qps":>8} {"p50(ms)":>8} {"p99(ms)":>8} '
+          f'{"batch":>6} {"dedup":>6}')
+    for mode, embedding in (('direct', model), ('service', service)):
+        elapsed, latencies = run(embedding, queries, args.threads)
+        stats = service.get_stats() if embedding is service else {}
+        print(f'{mode:>8} {len(queries) / elapsed:>8.1f} '
+              f'{np.percentile(latencies, 50) * 1000:>8.2f} '
+              f'{np.percentile(latencies, 99) * 1000:>8.2f} '
+              f'{stats.get("mean_batch_size", 1):>6.1f} '
+              f'{stats.get("deduplicated", 0):>6}')
+    service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark the pre-fork worker model of the batch runner against workers which warm
+themselves.
+
+A synthetic tool index stands in for the retriever of a deployment. In the cold mode
+every worker imports the stack, builds the agent and loads the index itself; in the
+prefork modes the supervisor does it once and forks the workers, with and without
+gc.freeze. Each worker runs a gc collection and a search before its memory is read
+from /proc/self/smaps_rollup (Linux only). The spawn time lasts until every worker
+answered its probe, which holds the worker for 0.5s.
+
+    python benchmarks/prefork.py --workers 4 --size 50000 --dim 768
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Agent.utils.batch_runner import create_pool  # noqa
+
+CONFIG = {
+    'agent': 'RolePlay',
+    'agent_cfg': {
+        'llm': {
+            'model': 'qwen-max',
+            'model_server': 'dashscope',
+            'api_key': 'benchmark'
+        },
+        'function_list': ['quick_sort', 'binary_search']
+    }
+}
+
+# the state of a worker, as in the batch runner
+_state: Dict = {}
+
+
+def random_embeddings(dim: int):
+    from langchain_core.embeddings import Embeddings
+
+    class RandomEmbeddings(Embeddings):
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return [self.embed_query(text) for text in texts]
+
+        def embed_query(self, text: str) -> List[float]:
+            rng = np.random.default_rng(abs(hash(text)) % 2**32)
+            return rng.standard_normal(dim).tolist()
+
+    return RandomEmbeddings()
+
+
+def build_index(index_dir: str, size: int, dim: int):
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    import faiss
+
+    rng = np.random.default_rng(0)
+    texts = [
+        f'{{"name": "tool_{i}", "description": "synthetic tool {i}"}}'
+        for i in range(size)
+    ]
+    vectors = rng.standard_normal((size, dim), dtype=np.float32)
+    vs = FAISS(random_embeddings(dim), faiss.IndexFlatL2(dim), InMemoryDocstore(),
+               {})
+    vs.add_embeddings(list(zip(texts, vectors.tolist())))
+    vs.save_local(index_dir, 'tool')
+
+
+def warm(index_dir: str, dim: int):
+    from Agent.storage.vector_storage import VectorStorage
+    from Agent.utils.batch_runner import build_agent
+
+    agent = build_agent(CONFIG)
+    agent.function_retriever = VectorStorage(
+        index_dir, 'tool', embedding=random_embeddings(dim), use_cache=False)
+    # the docstore pickle was written by build_index
+    agent.function_retriever.vs = agent.function_retriever.vs_cls.load_local(
+        index_dir,
+        agent.function_retriever.embedding,
+        'tool',
+        allow_dangerous_deserialization=True)
+    _state['agent'] = agent
+
+
+def probe(_) -> Dict:
+    import gc
+    gc.collect()
+    _state['agent'].function_retriever.search('sort an array', top_k=2)
+    # hold the worker, so that every worker answers one probe
+    time.sleep(0.5)
+    memory = {'pid': os.getpid()}
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                memory[key] = int(value.split()[0]) / 1024
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=768)
+    args = parser.parse_args()
+
+    index_dir = tempfile.mkdtemp()
+    try:
+        build_index(index_dir, args.size, args.dim)
+        print(f'{"mode":>15} {"warm(s)":>8} {"spawn(s)":>9} {"rss(MB)":>8} '
+              f'{"pss(MB)":>8} {"private(MB)":>12}')
+        for mode in ('cold', 'prefork-nofreeze', 'prefork'):
+            prefork = mode != 'cold'
+            start = time.time()
+            pool = create_pool(
+                args.workers,
+                warm,
+                initargs=(index_dir, args.dim),
+                prefork=prefork,
+                freeze=mode == 'prefork')
+            forked_at = time.time()
+            results = pool.map(probe, range(args.workers), chunksize=1)
+            ready_at = time.time()
+            pool.terminate()
+            pool.join()
+
+            workers = {result['pid']: result for result in results}.values()
+            private = [w['Private_Clean'] + w['Private_Dirty'] for w in workers]
+            print(f'{mode:>15} {forked_at - start if prefork else 0:>8.2f} '
+                  f'{ready_at - forked_at:>9.2f} '
+                  f'{np.mean([w["Rss"] for w in workers]):>8.1f} '
+                  f'{np.mean([w["Pss"] for w in workers]):>8.1f} '
+                  f'{np.mean(private):>12.1f}')
+            _state.clear()
+    finally:
+        shutil.rmtree(index_dir)
+
+
+if __name__ == '__main__':
+    main()
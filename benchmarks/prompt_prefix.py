@@ -0,0 +1,168 @@
+"""
+Benchmark how much of the prompts of multi-turn sessions a provider can serve from its
+prompt cache, with the current prompt layout of AlphaUmi against the legacy one which
+puts the history in the middle of the templates.
+
+A simulated llm keeps the prompts it was sent, reports the longest prefix shared with
+any of them as the cached tokens, like a provider with prompt caching, and models the
+time to first token as a fixed time plus a prefill time per uncached prompt token.
+
+    python benchmarks/prompt_prefix.py --sessions 20 --runs 3 --tool-turns 3
+"""
+import argparse
+import os
+import sys
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Agent.agents.multi_role as multi_role  # noqa
+from Agent.agents.multi_role import AlphaUmi  # noqa
+from Agent.llm.base import BaseChatModel  # noqa
+from Agent.llm.dashscope import DashScopeLLM  # noqa
+from Agent.utils.tokenization_utils import approx_token_count  # noqa
+from Agent.utils.usage import get_usage_tracker  # noqa
+
+PLANNER_TEMPLATE = multi_role.PLANNER_TEMPLATE
+CALLER_TEMPLATE = multi_role.CALLER_TEMPLATE
+
+LEGACY_PLANNER_TEMPLATE = """You have assess to the following apis:
+{doc}
+The conversation history is:
+{history}
+You are the assistant to plan what to do next and whether is caller's or conclusion's turn to answer. If you find the historical called api is inappropriate, you can give some advice to the caller.
+Answer with a following format:
+The thought of the next step, followed by Next: caller or conclusion or give up."""
+
+LEGACY_CALLER_TEMPLATE = """You have assess to the following apis:
+{doc}
+The conversation history is:
+{history}
+The thought of this step is:
+{thought}
+Base on the thought make an api call in the following format:
+Action: the name of api that should be called in this step, should be exactly in [{tool_names}],
+Action Input: the api call request."""
+
+
+class CachingLLM(BaseChatModel):
+    """
+    A scripted llm with a simulated prompt cache
+    """
+
+    def __init__(self, model: str, script, first_token_ms: float,
+                 prefill_ms: float):
+        super().__init__(model, 'simulated')
+        self._script = script
+        self._prompts: List[str] = []
+        self.first_token_ms = first_token_ms
+        self.prefill_ms = prefill_ms
+        self.ttft_ms: List[float] = []
+
+    def chat_with_raw_prompt(self, prompt, stop=None, **kwargs):
+        return '' if prompt == '' else self._reply(prompt, **kwargs)
+
+    def _chat_stream(self, messages, stop=None, **kwargs):
+        yield self._reply(messages[-1]['content'], **kwargs)
+
+    def _chat_no_stream(self, messages, stop=None, **kwargs):
+        return self._reply(messages[-1]['content'], **kwargs)
+
+    def _reply(self, prompt: str, usage=None, **kwargs) -> str:
+        cached = max((len(os.path.commonprefix([prompt, p]))
+                      for p in self._prompts),
+                     default=0)
+        self._prompts.append(prompt)
+        prompt_tokens = approx_token_count(prompt)
+        cached_tokens = approx_token_count(prompt[:cached])
+        self.ttft_ms.append(self.first_token_ms + self.prefill_ms *
+                            (prompt_tokens - cached_tokens))
+        if usage is not None:
+            usage.report(prompt_tokens, None, cached_tokens)
+        return self._script(len(self._prompts))
+
+    _detect_tool = DashScopeLLM._detect_tool
+
+
+def run_sessions(args, legacy: bool) -> Dict:
+    if legacy:
+        multi_role.PLANNER_TEMPLATE = LEGACY_PLANNER_TEMPLATE
+        multi_role.CALLER_TEMPLATE = LEGACY_CALLER_TEMPLATE
+    else:
+        multi_role.PLANNER_TEMPLATE = PLANNER_TEMPLATE
+        multi_role.CALLER_TEMPLATE = CALLER_TEMPLATE
+    AlphaUmi._role_prompt_cache.clear()
+
+    turns = args.tool_turns + 1
+    llms = {
+        'planner':
+        CachingLLM(
+            'planner', lambda i: 'Next: conclusion.'
+            if i % turns == 0 else 'Call the sort api. Next: caller.',
+            args.first_token_ms, args.prefill_ms),
+        'caller':
+        CachingLLM(
+            'caller', lambda i:
+            f'Action: quick_sort\nAction Input: {{"array": [{i}, 2, 1]}}',
+            args.first_token_ms, args.prefill_ms),
+        'summarizer':
+        CachingLLM('summarizer', lambda i: 'The arrays are sorted.',
+                   args.first_token_ms, args.prefill_ms),
+    }
+    reused = cached = prompt = 0
+    for session in range(args.sessions):
+        uuid_str = f'{"legacy" if legacy else "stable"}-{session}'
+        agent = AlphaUmi(
+            llm_planner=llms['planner'],
+            llm_caller=llms['caller'],
+            llm_summarizer=llms['summarizer'],
+            function_list=['quick_sort', 'binary_search'],
+            uuid_str=uuid_str,
+            lang='en')
+        history = []
+        for run in range(args.runs):
+            query = f'sort the arrays of batch {run} of session {session}'
+            response = ''.join(
+                chunk for chunk in agent.run(query, history=list(history))
+                if isinstance(chunk, str))
+            history += [{
+                'role': 'user',
+                'content': query
+            }, {
+                'role': 'assistant',
+                'content': response[-200:]
+            }]
+        usage = get_usage_tracker(uuid_str).summary()['session']
+        reused += usage['reused_prefix_tokens']
+        cached += usage['cached_tokens']
+        prompt += usage['prompt_tokens']
+    ttft = [ms for llm in llms.values() for ms in llm.ttft_ms]
+    return {
+        'calls': len(ttft),
+        'prompt_tokens': prompt,
+        'cached': cached / prompt,
+        'reused_last': reused / prompt,
+        'ttft_ms': sum(ttft) / len(ttft),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--tool-turns', type=int, default=3)
+    parser.add_argument('--first-token-ms', type=float, default=100.0)
+    parser.add_argument('--prefill-ms', type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f'{"layout":>8} {"calls":>6} {"prompt":>8} {"cached":>7} '
+          f'{"reused":>7} {"ttft(ms)":>9}')
+    for legacy in (True, False):
+        result = run_sessions(args, legacy)
+        print(f'{"legacy" if legacy else "stable":>8} {result["calls"]:>6} '
+              f'{result["prompt_tokens"]:>8} {result["cached"]:>7.1%} '
+              f'{result["reused_last"]:>7.1%} {result["ttft_ms"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
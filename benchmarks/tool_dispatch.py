@@ -0,0 +1,63 @@
+"""
+Benchmark the dispatch of tool calls with large array arguments.
+
+The legacy path parses the arguments with json5 and the tools parse the array again,
+the current path parses them once with the stdlib json through the compiled validator.
+
+    python benchmarks/tool_dispatch.py --sizes 100 1000 10000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import json
+import json5
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Agent.tools import TOOL_REGISTRY  # noqa
+
+
+def legacy_dispatch(tool, params: str):
+    params_json = json5.loads(params)
+    for param in tool.parameters:
+        if param.get('required') and param['name'] not in params_json:
+            return params
+    arr = params_json['arr']
+    # the tools used to parse the already parsed values again
+    return json5.loads(arr) if isinstance(arr, str) else arr
+
+
+def timeit(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    tool = TOOL_REGISTRY['quick_sort']()
+    print(f'{"size":>8} {"format":>8} {"legacy(ms)":>12} '
+          f'{"current(ms)":>12} {"speedup":>8}')
+    for size in args.sizes:
+        arr = [random.randint(-10**6, 10**6) for _ in range(size)]
+        for fmt, params in (('list', json.dumps({'arr': arr})),
+                            ('str', json.dumps({'arr': json.dumps(arr)}))):
+            legacy = timeit(lambda: legacy_dispatch(tool, params), args.repeat)
+            current = timeit(lambda: tool._verify_args(params), args.repeat)
+            print(f'{size:>8} {fmt:>8} {legacy * 1000:>12.3f} '
+                  f'{current * 1000:>12.3f} {legacy / current:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,3 +17,9 @@ response = bot.run("帮我对数组进行排序，然后给出4在排序后的
 text = ''
 for chunk in response:
     text += chunk
+
+# ask_human_for_help suspends the session, answer in the terminal to resume it
+while bot.continuation_id:
+    answer = input('\n')
+    for chunk in bot.resume(answer, bot.continuation_id):
+        text += chunk